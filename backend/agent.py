@@ -1,7 +1,8 @@
-from collections.abc import AsyncGenerator
+from collections.abc import AsyncGenerator, Callable
 from typing import TYPE_CHECKING, List, TypedDict, Optional, Annotated
 from typing_extensions import TypeVar
 import json
+import sys
 
 from dotenv import load_dotenv
 from langchain.prompts import ChatPromptTemplate
@@ -19,12 +20,22 @@ from templates import (
     GENERATE_REPORT_TEMPLATE,
     GENERATE_DETAILED_REPORT_TEMPLATE,
     INVESTIGATE_CASES_TEMPLATE,
+    REGENERATE_POINTS_TEMPLATE,
 )
 from retrievers import create_news_retriever, create_general_retriever
+from docstore import DedupRetriever, DocumentStore, format_context
+from hedging import HedgedExecutor, warming
+from prefetch import RetrievalPrefetcher, case_query, expand_case_queries
+from regeneration import GenerationLog, context_sources, render_points, stale_points
+from retrieval_policy import AdaptiveRetriever, RetrievalPolicy, retrieval_policy_from_env
+from report_tree import ReportTree
+from scheduler import Scheduler, create_default_scheduler
 
 if TYPE_CHECKING:
     from langchain_core.runnables import Runnable
 
+    from storage import SQLiteStore
+
 
 class Source(BaseModel):
     name: str
@@ -62,82 +73,310 @@ class PointSelection(BaseModel):
     selected_at: str = Field(default_factory=lambda: datetime.now().strftime("%Y%m%d_%H%M%S"))
 
 
+def summarize_sources(context: list, yes_or_no: str) -> Optional[str]:
+    """LLMが間に合わない場合に、検索結果の出典だけを並べた短い回答を作る"""
+    lines = []
+    for doc in context:
+        metadata = getattr(doc, "metadata", None) or {}
+        if metadata.get("source"):
+            lines.append(f"- [{metadata.get('title') or metadata['source']}]({metadata['source']})")
+    if not lines:
+        return None
+    return f"{yes_or_no}の事例として、以下の情報源が見つかりました。\n\n" + "\n".join(lines)
+
+
 class ReporterAgent:
-    def __init__(self, llm: BaseChatModel) -> None:
+    def __init__(
+        self,
+        llm: BaseChatModel,
+        scheduler: Optional[Scheduler] = None,
+        fallback_llm: Optional[BaseChatModel] = None,
+        hedger: Optional[HedgedExecutor] = None,
+        reports: Optional[ReportTree] = None,
+        store: Optional["SQLiteStore"] = None,
+        retrieval_policy: Optional[RetrievalPolicy] = None,
+    ) -> None:
         self.llm = llm
-        self.news_retriever = create_news_retriever()
-        self.general_retriever = create_general_retriever()
-        self.reports: dict[str, ReportContent] = {}  # レポートを保持するための辞書
+        self.fallback_llm = fallback_llm
+        self.scheduler = scheduler or create_default_scheduler()
+        self.hedger = hedger or HedgedExecutor()
+        # 検索の深さ・件数はノードごとに選び、混雑時は軽い設定に切り替える
+        self.retrieval_policy = retrieval_policy or RetrievalPolicy(
+            self.scheduler, **retrieval_policy_from_env()
+        )
+        # 検索結果の本文は重複を除いて保存し、Document には doc_id と抜粋だけを持たせる
+        self.documents = DocumentStore(store=store)
+        self.news_retriever = self._retriever("generate_report", create_news_retriever)
+        self.detail_retriever = self._retriever("generate_detailed_report", create_news_retriever)
+        self.general_retriever = self._retriever("check_cases", create_general_retriever)
+        # レポートの階層構造をノードIDで引けるフラットなストア
+        self.reports = reports if reports is not None else ReportTree()
+        # 差分再生成のために、前回の生成結果と使った検索結果の doc_id を覚えておく
+        self.generations = GenerationLog(store=store)
+        # 論点ごとの Yes/No 事例の検索結果を先読みしておくキャッシュ
+        self.case_prefetcher = RetrievalPrefetcher(
+            self.general_retriever, self.scheduler, store=store, documents=self.documents
+        )
+
+    def _retriever(self, node: str, factory: Callable[..., BaseRetriever]) -> BaseRetriever:
+        adaptive = AdaptiveRetriever(node=node, policy=self.retrieval_policy, factory=factory)
+        return DedupRetriever(retriever=adaptive, documents=self.documents)
 
     def select_point(self, report_id: str, point_id: str) -> PointSelection:
         """レポートから特定のポイントを選択する"""
         if report_id not in self.reports:
             raise ValueError(f"Report with ID {report_id} not found")
 
-        report = self.reports[report_id]
         # 指定されたpoint_idが存在するか確認
-        if not any(point.id == point_id for point in report.points):
+        if self.reports.get_point(report_id, point_id) is None:
             raise ValueError(f"Point with ID {point_id} not found in report {report_id}")
 
         return PointSelection(report_id=report_id, point_id=point_id)
 
-    def generate_report(self, query: str) -> str:
-        """非ストリーミングバージョンのレポート生成メソッド"""
-        # Create the prompt
-        prompt = PromptTemplate(
-            template=GENERATE_REPORT_TEMPLATE,
-            input_variables=["context", "question"],
+    def selection_text(self, selection: PointSelection) -> tuple[Optional[str], Optional[str]]:
+        """選択の (title, content)。本文を持たない選択はレポートの木から引く"""
+        if selection.title and selection.content:
+            return selection.title, selection.content
+        point = self.reports.get_point(selection.report_id, selection.point_id)
+        if point is None:
+            return selection.title, selection.content
+        return selection.title or point.title, selection.content or point.content
+
+    def compact_selection(self, selection: Optional[PointSelection]) -> Optional[PointSelection]:
+        """木にある要点と同じ本文なら、コピーを持たず ID だけで参照する選択にする
+
+        論点（CriticPoint）の選択のように木にない本文を持つものはそのまま返す。
+        """
+        if selection is None or (selection.title is None and selection.content is None):
+            return selection
+        point = self.reports.get_point(selection.report_id, selection.point_id)
+        if point is None or (selection.title, selection.content) != (point.title, point.content):
+            return selection
+        return PointSelection(
+            report_id=sys.intern(selection.report_id),
+            point_id=sys.intern(selection.point_id),
+            selected_at=selection.selected_at,
         )
-        model = self.llm
 
-        # Get the context using news retriever
+    def _invoke_chain(
+        self,
+        node: str,
+        key: object,
+        prompt: PromptTemplate,
+        inputs: dict,
+        shorter: Optional[Callable[[], Optional[str]]] = None,
+    ) -> str:
+        """主モデルで実行し、遅い場合はフォールバックモデルでヘッジする"""
+
+        def run(model: BaseChatModel) -> str:
+            chain = prompt | model | StrOutputParser()
+            return self.scheduler.run("llm", chain.invoke, inputs)
+
+        fallback = (lambda: run(self.fallback_llm)) if self.fallback_llm else None
+        return self.hedger.call(node, key, lambda: run(self.llm), fallback, shorter)
+
+    def _search(self, retriever: BaseRetriever, query: str) -> list:
         try:
-            context = self.news_retriever.invoke(query)
+            context = self.scheduler.run("tavily", retriever.invoke, query)
             if not context:
                 context = [{"page_content": "No relevant information found.", "metadata": {}}]
         except Exception as e:
             context = [{"page_content": "Error retrieving information.", "metadata": {}}]
+        return context
+
+    def generate_report(self, query: str) -> str:
+        """非ストリーミングバージョンのレポート生成メソッド"""
+        # 授業前に warmup.py で生成済みなら検索もしない
+        warm = self.hedger.warm_result("generate_report", query)
+        if warm is not None:
+            return warm
+
+        # Get the context using news retriever
+        context = self._search(self.news_retriever, query)
+        text = self._report_from_context(query, context)
+        self.generations.record("generate_report", query, text, context)
+        return text
+
+    def _report_from_context(self, query: str, context: list) -> str:
+        # Create the prompt
+        prompt = PromptTemplate(
+            template=GENERATE_REPORT_TEMPLATE,
+            input_variables=["context", "question"],
+        )
 
         # Create and execute the chain
-        chain = prompt | model | StrOutputParser()
-        return chain.invoke({"context": context, "question": query})
+        return self._invoke_chain(
+            "generate_report",
+            query,
+            prompt,
+            {"context": format_context(context, self.documents), "question": query},
+        )
 
-    def generate_detailed_report(self, report_id: str, point_id: str) -> str:
-        """非ストリーミングバージョンの詳細レポート生成メソッド"""
+    def _get_point(self, report_id: str, point_id: str) -> "ReporterPoint":
         # レポートとポイントの取得
         if report_id not in self.reports:
             raise ValueError(f"Report with ID {report_id} not found")
 
-        report = self.reports[report_id]
-        point = next((p for p in report.points if p.id == point_id), None)
+        point = self.reports.get_point(report_id, point_id)
         if not point:
             raise ValueError(f"Point with ID {point_id} not found in report {report_id}")
+        return point
 
+    def generate_detailed_report(self, report_id: str, point_id: str) -> str:
+        """非ストリーミングバージョンの詳細レポート生成メソッド"""
+        point = self._get_point(report_id, point_id)
+        key = [point.title, point.content]
+        warm = self.hedger.warm_result("generate_detailed_report", key)
+        if warm is not None:
+            return warm
+
+        # コンテキストの取得
+        search_query = point.title  # タイトルのみを検索クエリとして使用
+        context = self._search(self.detail_retriever, search_query)
+        text = self._detailed_report_from_context(point, context)
+        self.generations.record("generate_detailed_report", key, text, context)
+        return text
+
+    def _detailed_report_from_context(self, point: "ReporterPoint", context: list) -> str:
         # プロンプトの作成
         prompt = PromptTemplate(
             template=GENERATE_DETAILED_REPORT_TEMPLATE,
             input_variables=["context", "title", "content"],
         )
-        model = self.llm
-
-        # コンテキストの取得
-        search_query = point.title  # タイトルのみを検索クエリとして使用
-        try:
-            context = self.news_retriever.invoke(search_query)
-            if not context:
-                context = [{"page_content": "No relevant information found.", "metadata": {}}]
-        except Exception as e:
-            context = [{"page_content": "Error retrieving information.", "metadata": {}}]
 
         # Create and execute the chain
-        chain = prompt | model | StrOutputParser()
-        return chain.invoke(
+        # 間に合わない場合は要点そのものを短い回答として返す
+        return self._invoke_chain(
+            "generate_detailed_report",
+            [point.title, point.content],
+            prompt,
             {
-                "context": context,
+                "context": format_context(context, self.documents),
                 "title": point.title,
                 "content": point.content,
-            }
+            },
+            shorter=lambda: f"**{point.title}**\n\n{point.content}",
+        )
+
+    def refresh_report(self, query: str) -> str:
+        """generate_report の差分再生成版。出典が変わった要点だけを生成し直す"""
+        context = self._search(self.news_retriever, query)
+        return self._regenerate(
+            "generate_report",
+            query,
+            query,
+            context,
+            lambda: self._report_from_context(query, context),
+        )
+
+    def refresh_detailed_report(self, report_id: str, point_id: str) -> str:
+        """generate_detailed_report の差分再生成版"""
+        point = self._get_point(report_id, point_id)
+        context = self._search(self.detail_retriever, point.title)
+        return self._regenerate(
+            "generate_detailed_report",
+            [point.title, point.content],
+            f"{point.title}: {point.content}",
+            context,
+            lambda: self._detailed_report_from_context(point, context),
+        )
+
+    def register_detailed_report(
+        self, report_id: str, point_id: str, text: Optional[str] = None
+    ) -> Optional[str]:
+        """詳細レポートを要点の子として木に登録し、その ID を返す（差分を返すときだけ登録する）
+
+        text を省略すると前回生成した詳細レポートを登録する（なければ None）。
+        """
+        point = self._get_point(report_id, point_id)
+        if text is None:
+            previous = self.generations.previous(
+                "generate_detailed_report", [point.title, point.content]
+            )
+            if previous is None:
+                return None
+            text = previous["text"]
+        return self.parse_report_output(text, point.title, report_id, point_id).id
+
+    def _regenerate(
+        self, node: str, key: object, topic: str, context: list, full: Callable[[], str]
+    ) -> str:
+        previous = self.generations.previous(node, key)
+        points: list[ReporterPoint] = []
+        if previous is not None:
+            try:
+                points = self.parse_points(previous["text"])
+            except (ValueError, IndexError):
+                points = []
+        current = context_sources(context)
+        stale = stale_points(points, previous["sources"], current) if points else []
+
+        # ウォームキャッシュの古い回答は使わず、生成し直した回答で更新する
+        with warming(refresh=True):
+            # 検索に失敗した場合も前回のレポートを残す
+            if points and (not stale or not current):
+                text = previous["text"]
+                self.generations.count(refreshes=1, unchanged=1, points_reused=len(points))
+            elif points:
+                text = self._regenerate_points(node, key, topic, context, points, stale)
+            else:
+                text = None
+            if text is None:
+                text = full()
+                self.generations.count(refreshes=1, full_regenerations=1)
+            else:
+                # 次の generate_report などが古い回答を返さないよう、ノード自身のキーも更新する
+                self.hedger.remember(node, key, text)
+        self.generations.record(node, key, text, context)
+        return text
+
+    def _regenerate_points(
+        self,
+        node: str,
+        key: object,
+        topic: str,
+        context: list,
+        points: list["ReporterPoint"],
+        stale: list[int],
+    ) -> Optional[str]:
+        """stale の位置の要点だけを、残す要点が使っていない検索結果から生成し直す"""
+        kept = [p for i, p in enumerate(points) if i not in stale]
+        used = {p.source.url for p in kept}
+        fresh = [
+            doc
+            for doc in context
+            if (getattr(doc, "metadata", None) or {}).get("source") not in used
+        ] or context
+        prompt = PromptTemplate(
+            template=REGENERATE_POINTS_TEMPLATE,
+            input_variables=["context", "topic", "existing", "count"],
+        )
+        text = self._invoke_chain(
+            "regenerate_points",
+            [node, key, sorted(context_sources(fresh).values()), len(stale)],
+            prompt,
+            {
+                "context": format_context(fresh, self.documents),
+                "topic": topic,
+                "existing": "\n".join(f"- {p.title}" for p in kept) or "（なし）",
+                "count": len(stale),
+            },
         )
+        try:
+            regenerated = self.parse_points(text)
+        except (ValueError, IndexError):
+            regenerated = []
+        if len(regenerated) < len(stale):
+            return None
+        merged = list(points)
+        for i, point in zip(stale, regenerated):
+            merged[i] = point
+        self.generations.count(refreshes=1, points_reused=len(kept), points_regenerated=len(stale))
+        return render_points(merged)
+
+    def prefetch_cases(self, critic_points: list["CriticPoint"]) -> None:
+        """論点ごとの Yes/No の事例の検索をバックグラウンドで始めておく"""
+        self.case_prefetcher.prefetch(expand_case_queries(p.title for p in critic_points))
 
     def check_cases(self, title: str, content: str, yes_or_no: str) -> str:
         """事例を調査するメソッド"""
@@ -146,8 +385,8 @@ class ReporterAgent:
             input_variables=["context", "title", "content", "yes_or_no"],
         )
         try:
-            search_query = f"{title} {yes_or_no}の事例"
-            context = self.general_retriever.invoke(search_query)
+            # critic ノードで先読みしていれば検索を待たずに済む
+            context = self.case_prefetcher.get(case_query(title, yes_or_no))
             if not context:
                 context = [
                     {"page_content": "No relevant information found for this case.", "metadata": {}}
@@ -155,14 +394,50 @@ class ReporterAgent:
         except Exception as e:
             context = [{"page_content": f"Error retrieving information: {str(e)}", "metadata": {}}]
 
-        model = self.llm
-        chain = prompt | model | StrOutputParser()
-        return chain.invoke(
-            {"context": context, "title": title, "content": content, "yes_or_no": yes_or_no}
+        return self._invoke_chain(
+            "check_cases",
+            # 同じタイトルでも内容が違う論点に、別の論点の回答を返さない
+            [title, content, yes_or_no],
+            prompt,
+            {
+                "context": format_context(context, self.documents),
+                "title": title,
+                "content": content,
+                "yes_or_no": yes_or_no,
+            },
+            shorter=lambda: summarize_sources(context, yes_or_no),
         )
 
-    def parse_report_output(self, text: str, query: str) -> ReportContent:
-        """Parse the reporter's markdown output into a structured format."""
+    def parse_report_output(
+        self,
+        text: str,
+        query: str,
+        parent_report_id: Optional[str] = None,
+        parent_point_id: Optional[str] = None,
+    ) -> ReportContent:
+        """Parse the reporter's markdown output into a structured format.
+
+        parent_report_id / parent_point_id を指定すると、そのポイントの詳細レポートとして
+        木に登録する。
+        """
+        points = self.parse_points(text)
+
+        # Generate a unique ID for the report using timestamp
+        from datetime import datetime
+
+        report_id = self.reports.unique_report_id(datetime.now().strftime("%Y%m%d_%H%M%S"))
+        for point in points:
+            point.report_id = report_id
+        report_content = ReportContent(id=report_id, topic=query, points=points)
+
+        # レポートを保存
+        self.reports.add_report(report_content, parent_report_id, parent_point_id)
+
+        return report_content
+
+    @staticmethod
+    def parse_points(text: str) -> list[ReporterPoint]:
+        """マークダウンの箇条書きを要点のリストにする（木には登録しない）"""
         lines = text.strip().split("\n")
         points = []
         current_point = None
@@ -218,16 +493,7 @@ class ReporterAgent:
                 )
             )
 
-        # Generate a unique ID for the report using timestamp
-        from datetime import datetime
-
-        report_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-        report_content = ReportContent(id=report_id, topic=query, points=points)
-
-        # レポートを保存
-        self.reports[report_id] = report_content
-
-        return report_content
+        return points
 
 
 class CriticPoint(BaseModel):
@@ -240,8 +506,17 @@ class CriticContent(BaseModel):
 
 
 class CriticAgent:
-    def __init__(self, llm: BaseChatModel) -> None:
+    def __init__(
+        self,
+        llm: BaseChatModel,
+        scheduler: Optional[Scheduler] = None,
+        fallback_llm: Optional[BaseChatModel] = None,
+        hedger: Optional[HedgedExecutor] = None,
+    ) -> None:
         self.llm = llm
+        self.fallback_llm = fallback_llm
+        self.scheduler = scheduler or create_default_scheduler()
+        self.hedger = hedger or HedgedExecutor()
 
     def generate_critique(self, title: str, content: str) -> dict:
         parser = PydanticOutputParser(pydantic_object=CriticContent)
@@ -250,11 +525,16 @@ class CriticAgent:
             partial_variables={"format_instructions": parser.get_format_instructions()},
         )
 
-        # Create chain
-        chain = prompt | self.llm | parser
+        inputs = {"title": title, "content": content}
+
+        def run(model: BaseChatModel) -> CriticContent:
+            # Create chain
+            chain = prompt | model | parser
+            # Execute chain and return result
+            return self.scheduler.run("llm", chain.invoke, inputs)
 
-        # Execute chain and return result
-        return chain.invoke({"title": title, "content": content})
+        fallback = (lambda: run(self.fallback_llm)) if self.fallback_llm else None
+        return self.hedger.call("generate_critique", inputs, lambda: run(self.llm), fallback)
 
 
 async def test_hierarchical_structure():
@@ -283,7 +563,9 @@ async def test_hierarchical_structure():
     if initial_report.points:
         point = initial_report.points[0]
         detailed_report_text = reporter.generate_detailed_report(initial_report.id, point.id)
-        detailed_report = reporter.parse_report_output(detailed_report_text, point.title)
+        detailed_report = reporter.parse_report_output(
+            detailed_report_text, point.title, initial_report.id, point.id
+        )
         point.detailed_report = detailed_report
         print(f"\nCreated detailed report for point {point.id}:")
         print(f"Detailed Report ID: {detailed_report.id}")
@@ -296,7 +578,9 @@ async def test_hierarchical_structure():
             nested_report_text = reporter.generate_detailed_report(
                 detailed_report.id, nested_point.id
             )
-            nested_report = reporter.parse_report_output(nested_report_text, nested_point.title)
+            nested_report = reporter.parse_report_output(
+                nested_report_text, nested_point.title, detailed_report.id, nested_point.id
+            )
             nested_point.detailed_report = nested_report
             print(f"\nCreated nested report for point {nested_point.id}:")
             print(f"Nested Report ID: {nested_report.id}")
@@ -0,0 +1,634 @@
+"""SQLite に保存する LangGraph のチェックポインタ
+
+MemorySaver と同じ形式でチェックポイントと書き込みを保存するが、保存先を
+SQLiteStore のファイルにすることで、複数のワーカープロセスやサーバー再起動後でも
+同じスレッドのチェックポイントを参照できる。
+
+チェックポイントは親との差分（バージョンが変わったチャンネルだけ）を zlib で圧縮して保存し、
+snapshot_every 個ごとに全体を保存する。RetentionPolicy に従って古いチェックポイントと
+放置されたスレッドを削除するコンパクションをバックグラウンドで実行できる。
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections.abc import AsyncIterator, Iterator, Sequence
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    SerializerProtocol,
+    get_checkpoint_id,
+)
+from langgraph.checkpoint.serde.types import TASKS
+
+from storage import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+# 差分圧縮したチェックポイントの type 列に付ける接頭辞（付いていなければ従来の形式）
+DELTA_PREFIX = "zdelta:"
+
+
+@dataclass
+class RetentionPolicy:
+    keep_last: int = 20  # スレッドごとに残すチェックポイント数
+    idle_ttl: Optional[float] = 30 * 24 * 3600  # 最後の更新からこの秒数が経ったスレッドを削除する
+    compaction_interval: float = 600.0
+
+
+def retention_policy_from_env() -> RetentionPolicy:
+    """CHECKPOINT_KEEP_LAST / CHECKPOINT_IDLE_DAYS / CHECKPOINT_COMPACTION_INTERVAL を読み込む"""
+    default = RetentionPolicy()
+    idle_days = os.getenv("CHECKPOINT_IDLE_DAYS")
+    return RetentionPolicy(
+        keep_last=max(1, int(os.getenv("CHECKPOINT_KEEP_LAST", default.keep_last))),
+        # 0 を指定すると放置されたスレッドを削除しない
+        idle_ttl=(float(idle_days) * 24 * 3600 or None) if idle_days else default.idle_ttl,
+        compaction_interval=float(
+            os.getenv("CHECKPOINT_COMPACTION_INTERVAL", default.compaction_interval)
+        ),
+    )
+
+
+class SqliteCheckpointSaver(BaseCheckpointSaver[str]):
+    _COLUMNS = (
+        "thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, "
+        "type, checkpoint, metadata_type, metadata"
+    )
+
+    def __init__(
+        self,
+        store: SQLiteStore,
+        *,
+        serde: Optional[SerializerProtocol] = None,
+        retention: Optional[RetentionPolicy] = None,
+        snapshot_every: int = 10,
+        compress_level: int = 6,
+    ) -> None:
+        super().__init__(serde=serde)
+        self.store = store
+        self.retention = retention or RetentionPolicy()
+        self.snapshot_every = max(1, snapshot_every)
+        self.compress_level = compress_level
+        self._stop = threading.Event()
+        self._compactor: Optional[threading.Thread] = None
+        with store.transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL DEFAULT '',
+                    checkpoint_id TEXT NOT NULL,
+                    parent_checkpoint_id TEXT,
+                    type TEXT,
+                    checkpoint BLOB,
+                    metadata_type TEXT,
+                    metadata BLOB,
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS writes (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL DEFAULT '',
+                    checkpoint_id TEXT NOT NULL,
+                    task_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    channel TEXT NOT NULL,
+                    type TEXT,
+                    value BLOB,
+                    task_path TEXT NOT NULL DEFAULT '',
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+                )
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(checkpoints)")}
+            if "created_at" not in columns:
+                # 以前のバージョンで作ったファイルは移行時点を最終更新とみなす
+                conn.execute("ALTER TABLE checkpoints ADD COLUMN created_at REAL")
+                conn.execute("UPDATE checkpoints SET created_at = ?", (time.time(),))
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS checkpoints_created_at "
+                "ON checkpoints (thread_id, created_at)"
+            )
+
+    @contextmanager
+    def _snapshot(self) -> Iterator[sqlite3.Connection]:
+        """親をたどって読む間にコンパクションで行が消えないよう、読み取りトランザクションを張る"""
+        conn = self.store.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT")
+
+    def _dump_delta(self, payload: dict[str, Any]) -> tuple[str, bytes]:
+        type_, blob = self.serde.dumps_typed(payload)
+        return DELTA_PREFIX + type_, zlib.compress(blob, self.compress_level)
+
+    def _load_delta(self, type_: str, blob: bytes) -> dict[str, Any]:
+        return self.serde.loads_typed((type_[len(DELTA_PREFIX) :], zlib.decompress(blob)))
+
+    def _load_payload(
+        self, conn: sqlite3.Connection, thread_id: str, checkpoint_ns: str, checkpoint_id: str
+    ) -> Optional[tuple[Optional[str], dict[str, Any]]]:
+        """(親の ID, 差分) を返す。従来の形式の行は全体を保存した差分として扱う"""
+        row = conn.execute(
+            "SELECT parent_checkpoint_id, type, checkpoint FROM checkpoints "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchone()
+        if row is None:
+            return None
+        parent_id, type_, blob = row
+        if type_.startswith(DELTA_PREFIX):
+            return parent_id, self._load_delta(type_, blob)
+        checkpoint = self.serde.loads_typed((type_, blob))
+        values = checkpoint.pop("channel_values")
+        return parent_id, {
+            "checkpoint": checkpoint,
+            "values": values,
+            "keys": list(values),
+            "depth": 0,
+            "base": True,
+        }
+
+    def _materialize(
+        self, conn: sqlite3.Connection, thread_id: str, checkpoint_ns: str, checkpoint_id: str
+    ) -> Optional[Checkpoint]:
+        """全体を保存したチェックポイントまで親をたどり、差分を重ねて復元する"""
+        loaded = self._load_payload(conn, thread_id, checkpoint_ns, checkpoint_id)
+        if loaded is None:
+            return None
+        parent_id, head = loaded
+        chain = [head]
+        while not chain[-1]["base"]:
+            loaded = self._load_payload(conn, thread_id, checkpoint_ns, parent_id)
+            if loaded is None:
+                raise LookupError(f"Parent checkpoint {parent_id} of {checkpoint_id} is missing")
+            parent_id, payload = loaded
+            chain.append(payload)
+        values: dict[str, Any] = {}
+        for payload in reversed(chain):
+            values.update(payload["values"])
+        return {
+            **head["checkpoint"],
+            "channel_values": {k: values[k] for k in head["keys"] if k in values},
+        }
+
+    def _config(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> RunnableConfig:
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id,
+            }
+        }
+
+    def _writes(
+        self, thread_id: str, checkpoint_ns: str, checkpoint_id: str
+    ) -> list[tuple[str, int, str, str, bytes, str]]:
+        return (
+            self.store.connection()
+            .execute(
+                "SELECT task_id, idx, channel, type, value, task_path FROM writes "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? "
+                "ORDER BY task_id, idx",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            )
+            .fetchall()
+        )
+
+    def _to_tuple(
+        self, row: tuple, metadata: Optional[CheckpointMetadata] = None
+    ) -> Optional[CheckpointTuple]:
+        thread_id, checkpoint_ns, checkpoint_id, parent_id, type_, blob, meta_type, meta = row
+        if type_.startswith(DELTA_PREFIX):
+            with self._snapshot() as conn:
+                checkpoint = self._materialize(conn, thread_id, checkpoint_ns, checkpoint_id)
+            if checkpoint is None:
+                return None
+        else:
+            checkpoint = self.serde.loads_typed((type_, blob))
+        sends = []
+        if parent_id:
+            # 親チェックポイントの TASKS への書き込みが pending_sends になる
+            parent_writes = self._writes(thread_id, checkpoint_ns, parent_id)
+            sends = sorted(
+                (w for w in parent_writes if w[2] == TASKS),
+                key=lambda w: (w[5], w[0], w[1]),
+            )
+        return CheckpointTuple(
+            config=self._config(thread_id, checkpoint_ns, checkpoint_id),
+            checkpoint={
+                **checkpoint,
+                "pending_sends": [self.serde.loads_typed((w[3], w[4])) for w in sends],
+            },
+            metadata=metadata or self.serde.loads_typed((meta_type, meta)),
+            parent_config=self._config(thread_id, checkpoint_ns, parent_id) if parent_id else None,
+            pending_writes=[
+                (w[0], w[2], self.serde.loads_typed((w[3], w[4])))
+                for w in self._writes(thread_id, checkpoint_ns, checkpoint_id)
+            ],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        conn = self.store.connection()
+        if checkpoint_id := get_checkpoint_id(config):
+            row = conn.execute(
+                f"SELECT {self._COLUMNS} FROM checkpoints "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            ).fetchone()
+        else:
+            row = conn.execute(
+                f"SELECT {self._COLUMNS} FROM checkpoints "
+                "WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC LIMIT 1",
+                (thread_id, checkpoint_ns),
+            ).fetchone()
+        return self._to_tuple(row) if row else None
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        where, params = [], []
+        if config:
+            where.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                where.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                where.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            where.append("checkpoint_id < ?")
+            params.append(before_id)
+        query = f"SELECT {self._COLUMNS} FROM checkpoints"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY thread_id, checkpoint_ns, checkpoint_id DESC"
+
+        rows = self.store.connection().execute(query, params).fetchall()
+        for row in rows:
+            if limit is not None and limit <= 0:
+                break
+            metadata = self.serde.loads_typed((row[6], row[7]))
+            if filter and not all(metadata.get(k) == v for k, v in filter.items()):
+                continue
+            # 読み取りの間にコンパクションで削除されたものは飛ばす
+            if (item := self._to_tuple(row, metadata)) is None:
+                continue
+            if limit is not None:
+                limit -= 1
+            yield item
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        c = checkpoint.copy()
+        c.pop("pending_sends", None)
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        parent_id = config["configurable"].get("checkpoint_id")
+        meta_type, meta = self.serde.dumps_typed(metadata)
+        with self.store.transaction() as conn:
+            parent = None
+            if parent_id:
+                loaded = self._load_payload(conn, thread_id, checkpoint_ns, parent_id)
+                parent = loaded[1] if loaded else None
+            type_, blob = self._dump_delta(self._delta(c, parent))
+            conn.execute(
+                f"INSERT OR REPLACE INTO checkpoints ({self._COLUMNS}, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id,
+                    checkpoint_ns,
+                    checkpoint["id"],
+                    parent_id,
+                    type_,
+                    blob,
+                    meta_type,
+                    meta,
+                    time.time(),
+                ),
+            )
+        return self._config(thread_id, checkpoint_ns, checkpoint["id"])
+
+    def _delta(self, checkpoint: Checkpoint, parent: Optional[dict[str, Any]]) -> dict[str, Any]:
+        """親からバージョンが変わったチャンネルの値だけを残す"""
+        header = {k: v for k, v in checkpoint.items() if k != "channel_values"}
+        values = checkpoint["channel_values"]
+        if parent is None or parent["depth"] + 1 >= self.snapshot_every:
+            return {
+                "checkpoint": header,
+                "values": values,
+                "keys": list(values),
+                "depth": 0,
+                "base": True,
+            }
+        parent_versions = parent["checkpoint"]["channel_versions"]
+        parent_keys = set(parent["keys"])
+        versions = checkpoint["channel_versions"]
+        changed = {
+            k: v
+            for k, v in values.items()
+            if k not in parent_keys or versions.get(k) != parent_versions.get(k)
+        }
+        return {
+            "checkpoint": header,
+            "values": changed,
+            "keys": list(values),
+            "depth": parent["depth"] + 1,
+            "base": False,
+        }
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        special, regular = [], []
+        for idx, (channel, value) in enumerate(writes):
+            type_, blob = self.serde.dumps_typed(value)
+            row = (
+                thread_id,
+                checkpoint_ns,
+                checkpoint_id,
+                task_id,
+                WRITES_IDX_MAP.get(channel, idx),
+                channel,
+                type_,
+                blob,
+                task_path,
+            )
+            (special if channel in WRITES_IDX_MAP else regular).append(row)
+        columns = (
+            "INTO writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, "
+            "channel, type, value, task_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        )
+        with self.store.transaction() as conn:
+            # 通常の書き込みは最初のものを残し、エラー・割り込みなどの特殊な書き込みは上書きする
+            conn.executemany(f"INSERT OR IGNORE {columns}", regular)
+            conn.executemany(f"INSERT OR REPLACE {columns}", special)
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+            conn.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+
+    def expire_idle_threads(self, idle_ttl: float) -> int:
+        """最後のチェックポイントから idle_ttl 秒以上経ったスレッドを削除し、その数を返す"""
+        cutoff = time.time() - idle_ttl
+        with self.store.transaction() as conn:
+            threads = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT thread_id FROM checkpoints GROUP BY thread_id "
+                    "HAVING MAX(created_at) < ?",
+                    (cutoff,),
+                )
+            ]
+            for thread_id in threads:
+                conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+                conn.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+        return len(threads)
+
+    def prune(self, keep_last: int) -> int:
+        """スレッドごとに新しい keep_last 個だけを残し、削除したチェックポイント数を返す
+
+        削除する親を参照している差分は、先に全体を保存した形に書き直す。
+        """
+        conn = self.store.connection()
+        targets = conn.execute(
+            "SELECT thread_id, checkpoint_ns FROM checkpoints "
+            "GROUP BY thread_id, checkpoint_ns HAVING COUNT(*) > ?",
+            (keep_last,),
+        ).fetchall()
+        removed = 0
+        for thread_id, checkpoint_ns in targets:
+            # スレッド単位の短いトランザクションにして、リクエストの書き込みを長く止めない
+            with self.store.transaction() as conn:
+                rows = conn.execute(
+                    "SELECT checkpoint_id, parent_checkpoint_id, type FROM checkpoints "
+                    "WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC",
+                    (thread_id, checkpoint_ns),
+                ).fetchall()
+                drop = {row[0] for row in rows[keep_last:]}
+                for checkpoint_id, parent_id, type_ in rows[:keep_last]:
+                    if parent_id in drop and type_.startswith(DELTA_PREFIX):
+                        self._rebase(conn, thread_id, checkpoint_ns, checkpoint_id)
+                for checkpoint_id in drop:
+                    params = (thread_id, checkpoint_ns, checkpoint_id)
+                    where = "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?"
+                    conn.execute(f"DELETE FROM checkpoints {where}", params)
+                    conn.execute(f"DELETE FROM writes {where}", params)
+                removed += len(drop)
+        return removed
+
+    def _rebase(
+        self, conn: sqlite3.Connection, thread_id: str, checkpoint_ns: str, checkpoint_id: str
+    ) -> None:
+        checkpoint = self._materialize(conn, thread_id, checkpoint_ns, checkpoint_id)
+        type_, blob = self._dump_delta(self._delta(checkpoint, None))
+        conn.execute(
+            "UPDATE checkpoints SET type = ?, checkpoint = ? "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            (type_, blob, thread_id, checkpoint_ns, checkpoint_id),
+        )
+
+    def compact(self) -> dict[str, int]:
+        """保持ポリシーを適用し、期限切れのキャッシュと WAL を片付ける"""
+        expired = 0
+        if self.retention.idle_ttl:
+            expired = self.expire_idle_threads(self.retention.idle_ttl)
+        pruned = self.prune(self.retention.keep_last)
+        purged = self.store.purge_expired()
+        self.store.connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return {"expired_threads": expired, "pruned_checkpoints": pruned, "purged_entries": purged}
+
+    def _claim_compaction(self) -> bool:
+        # 複数のワーカーが同じファイルを続けてコンパクションしないようにする
+        with self.store.transaction():
+            last = self.store.get_json("checkpoint_compaction", "last_run")
+            if last is not None and time.time() - last < self.retention.compaction_interval / 2:
+                return False
+            self.store.put_json("checkpoint_compaction", "last_run", time.time())
+        return True
+
+    def _compaction_loop(self) -> None:
+        while not self._stop.wait(self.retention.compaction_interval):
+            try:
+                if self._claim_compaction():
+                    logger.info("Checkpoint compaction: %s", self.compact())
+            except Exception:
+                logger.exception("Checkpoint compaction failed")
+
+    def start_compaction(self) -> None:
+        """compaction_interval ごとに compact() を実行するデーモンスレッドを起動する"""
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._stop.clear()
+        self._compactor = threading.Thread(
+            target=self._compaction_loop, name="checkpoint-compaction", daemon=True
+        )
+        self._compactor.start()
+
+    def stop_compaction(self) -> None:
+        self._stop.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for item in items:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+
+if __name__ == "__main__":
+    # 1つのセッションに近いチェックポイント列を保存し、毎回全体を保存する形式とサイズを比べる
+    import random
+    import tempfile
+
+    from langgraph.checkpoint.base import create_checkpoint, empty_checkpoint
+
+    from tavily_standin import _text
+
+    # 同じ文の繰り返しだと zlib だけで縮んでしまうので、スタンドインサーバーと同じ生成器で作る
+    rng = random.Random(0)
+    report = _text(rng, 4500)
+    article = _text(rng, 1500)
+    steps = 30
+
+    def run(saver: SqliteCheckpointSaver, mode: str) -> str:
+        config = {"configurable": {"thread_id": "1", "checkpoint_ns": ""}}
+        checkpoint = empty_checkpoint()
+        for n in range(steps):
+            # 長い reporter_content は最初だけ書き込まれ、その後は小さいフィールドだけが変わる
+            values = {
+                "query": "ウクライナ戦争",
+                "reporter_content": report,
+                "explored_content": article if n >= 3 else None,
+                "current_role": ["reporter", "explore_report", "critic"][n % 3],
+                "step": n,
+            }
+            versions = dict(checkpoint["channel_versions"])
+            for key in ("current_role", "step") if n else values:
+                versions[key] = saver.get_next_version(versions.get(key), None)
+            if n == 3:
+                versions["explored_content"] = saver.get_next_version(
+                    versions.get("explored_content"), None
+                )
+            checkpoint = create_checkpoint(checkpoint, None, n)
+            checkpoint["channel_values"] = values
+            checkpoint["channel_versions"] = versions
+            if mode != "delta":
+                # 差分を使わず毎回全体を保存する形式（snapshot+zlib はそれを圧縮したもの）
+                c = dict(checkpoint)
+                type_, blob = saver.serde.dumps_typed(c)
+                if mode == "snapshot+zlib":
+                    blob = zlib.compress(blob, saver.compress_level)
+                with saver.store.transaction() as conn:
+                    conn.execute(
+                        f"INSERT INTO checkpoints ({saver._COLUMNS}, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        ("1", "", c["id"], None, type_, blob, "msgpack", b"\x80", time.time()),
+                    )
+            else:
+                config = saver.put(config, checkpoint, {"step": n}, versions)
+        return checkpoint["id"]
+
+    def stored_bytes(saver: SqliteCheckpointSaver) -> int:
+        conn = saver.store.connection()
+        return conn.execute("SELECT SUM(LENGTH(checkpoint)) FROM checkpoints").fetchone()[0]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{steps} checkpoints:")
+        for mode in ("snapshot", "snapshot+zlib"):
+            snapshots = SqliteCheckpointSaver(SQLiteStore(os.path.join(tmp, f"{mode}.db")))
+            run(snapshots, mode)
+            print(f"  {mode:<14} {stored_bytes(snapshots):>8} bytes")
+        saver = SqliteCheckpointSaver(
+            SQLiteStore(os.path.join(tmp, "delta.db")), retention=RetentionPolicy(keep_last=5)
+        )
+        last_id = run(saver, "delta")
+        print(f"  {'delta+zlib':<14} {stored_bytes(saver):>8} bytes")
+
+        start = time.perf_counter()
+        latest = saver.get_tuple({"configurable": {"thread_id": "1"}})
+        print(f"restore latest: {(time.perf_counter() - start) * 1e3:.2f}ms")
+        assert latest.checkpoint["id"] == last_id
+        assert latest.checkpoint["channel_values"]["reporter_content"] == report
+        assert latest.checkpoint["channel_values"]["step"] == steps - 1
+
+        result = saver.compact()
+        remaining = list(saver.list({"configurable": {"thread_id": "1"}}))
+        print(f"compact: {result}, remaining {len(remaining)}, {stored_bytes(saver)} bytes")
+        assert len(remaining) == 5
+        assert saver.get_tuple({"configurable": {"thread_id": "1"}}).checkpoint == latest.checkpoint
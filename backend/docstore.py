@@ -0,0 +1,267 @@
+"""検索結果の本文を重複なく保存するコンテンツアドレス型のドキュメントストア
+
+Tavily の include_raw_content=True の結果は、同じニュース記事の本文がクエリやセッションを
+またいで何度も返ってくる。本文は URL と正規化した本文のハッシュを ID として zlib で圧縮して
+1度だけ保存し、検索結果の Document は ID と短い抜粋だけを持つ。プロンプトの資料は
+format_context で ID から組み立てる（同じ ID の整形結果は使い回す）。検索結果の Document は
+圧縮した本文への参照も持つので、リクエストの途中でストアから本文が追い出されても資料を組み立てられる。
+"""
+
+import hashlib
+import logging
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import PrivateAttr
+
+if TYPE_CHECKING:
+    from storage import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+# 検索結果の Document に残す抜粋の長さ
+EXCERPT_CHARS = 200
+
+
+def normalize_body(text: str) -> str:
+    """全角・半角や空白の違いだけの本文が同じ ID になるように正規化する"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def document_id(url: str, body: str) -> str:
+    digest = hashlib.sha256(f"{url}\0{normalize_body(body)}".encode())
+    return digest.hexdigest()[:32]
+
+
+class DocumentStore:
+    """ID → 圧縮した本文。store を渡すとプロセスや再起動をまたいで重複を除ける"""
+
+    namespace = "documents"
+
+    def __init__(
+        self,
+        store: Optional["SQLiteStore"] = None,
+        max_entries: int = 2048,
+        compress_level: int = 6,
+    ) -> None:
+        self.store = store
+        self.max_entries = max_entries
+        self.compress_level = compress_level
+        self._bodies: OrderedDict[str, bytes] = OrderedDict()
+        self._formatted: OrderedDict[tuple[str, Optional[int]], str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "stored": 0,
+            "deduplicated": 0,
+            "raw_bytes": 0,
+            "stored_bytes": 0,
+            # 本文が見つからず、検索結果の抜粋だけで資料を組み立てた回数
+            "excerpt_fallbacks": 0,
+        }
+
+    def _remember(self, doc_id: str, blob: bytes) -> None:
+        with self._lock:
+            self._bodies[doc_id] = blob
+            self._bodies.move_to_end(doc_id)
+            while len(self._bodies) > self.max_entries:
+                self._bodies.popitem(last=False)
+
+    def _blob(self, doc_id: str) -> Optional[bytes]:
+        with self._lock:
+            blob = self._bodies.get(doc_id)
+            if blob is not None:
+                self._bodies.move_to_end(doc_id)
+                return blob
+        if self.store is not None:
+            blob = self.store.get(self.namespace, doc_id)
+            if blob is not None:
+                self._remember(doc_id, blob)
+        return blob
+
+    def put(self, url: str, body: str) -> str:
+        """本文を保存して ID を返す。保存済みなら圧縮も書き込みもしない"""
+        return self.put_blob(url, body)[0]
+
+    def put_blob(self, url: str, body: str) -> tuple[str, bytes]:
+        """put と同じ。(ID, 圧縮した本文) を返す"""
+        doc_id = document_id(url, body)
+        blob = self._blob(doc_id)
+        if blob is not None:
+            with self._lock:
+                self._counters["deduplicated"] += 1
+            return doc_id, blob
+
+        blob = zlib.compress(body.encode(), self.compress_level)
+        if self.store is not None:
+            self.store.add(self.namespace, doc_id, blob)
+        self._remember(doc_id, blob)
+        with self._lock:
+            self._counters["stored"] += 1
+            self._counters["raw_bytes"] += len(body.encode())
+            self._counters["stored_bytes"] += len(blob)
+        return doc_id, blob
+
+    def get(self, doc_id: str) -> Optional[str]:
+        blob = self._blob(doc_id)
+        return zlib.decompress(blob).decode() if blob is not None else None
+
+    def __contains__(self, doc_id: object) -> bool:
+        return isinstance(doc_id, str) and self._blob(doc_id) is not None
+
+    def restore(self, page_content: str, metadata: dict[str, Any]) -> Document:
+        """保存した検索結果から Document を作り直す。本文が残っていれば StoredDocument にする"""
+        doc_id = metadata.get("doc_id")
+        blob = self._blob(doc_id) if isinstance(doc_id, str) else None
+        if blob is None:
+            return Document(page_content=page_content, metadata=metadata)
+        doc = StoredDocument(page_content=page_content, metadata=metadata)
+        doc._blob = blob
+        return doc
+
+    def format(
+        self,
+        doc_id: str,
+        title: str,
+        url: str,
+        max_chars: Optional[int] = None,
+        blob: Optional[bytes] = None,
+    ) -> str:
+        """プロンプトに埋め込む1件分の資料。同じ記事は何度参照されても1度だけ整形する
+
+        blob（検索結果が持つ圧縮した本文）があればストアから読まない。
+        """
+        key = (doc_id, max_chars)
+        with self._lock:
+            if key in self._formatted:
+                self._formatted.move_to_end(key)
+                return self._formatted[key]
+        body = zlib.decompress(blob).decode() if blob is not None else self.get(doc_id) or ""
+        if max_chars is not None and len(body) > max_chars:
+            body = body[:max_chars] + "…"
+        text = f"[{title or url}]({url})\n{body}"
+        with self._lock:
+            self._formatted[key] = text
+            while len(self._formatted) > self.max_entries:
+                self._formatted.popitem(last=False)
+        return text
+
+    def count_fallback(self) -> None:
+        with self._lock:
+            self._counters["excerpt_fallbacks"] += 1
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            return {**self._counters, "entries": len(self._bodies)}
+
+
+class StoredDocument(Document):
+    """DedupRetriever が返す検索結果。圧縮した本文への参照を持ち、結果を使う間は本文が消えない"""
+
+    # metadata に入れるとシリアライズされるので、プライベート属性で持つ
+    _blob: Optional[bytes] = PrivateAttr(default=None)
+
+
+class DedupRetriever(BaseRetriever):
+    """検索結果の本文を DocumentStore に保存し、doc_id と抜粋だけの Document を返す"""
+
+    retriever: BaseRetriever
+    documents: DocumentStore
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        results = []
+        for doc in docs:
+            url = doc.metadata.get("source", "")
+            doc_id, blob = self.documents.put_blob(url, doc.page_content)
+            result = StoredDocument(
+                page_content=doc.page_content[:EXCERPT_CHARS],
+                metadata={**doc.metadata, "doc_id": doc_id},
+            )
+            result._blob = blob
+            results.append(result)
+        return results
+
+
+def format_context(context: list, documents: DocumentStore, max_chars: Optional[int] = None) -> str:
+    """検索結果をプロンプトの資料に整形する。doc_id があれば本文はストアから読む"""
+    parts = []
+    for doc in context:
+        if isinstance(doc, dict):
+            # 検索に失敗した場合などのプレースホルダ
+            parts.append(doc.get("page_content", ""))
+            continue
+        metadata = doc.metadata or {}
+        url = metadata.get("source", "")
+        doc_id = metadata.get("doc_id")
+        blob = getattr(doc, "_blob", None)
+        if doc_id is not None and (blob is not None or doc_id in documents):
+            parts.append(
+                documents.format(doc_id, metadata.get("title", ""), url, max_chars, blob=blob)
+            )
+            continue
+        if doc_id is not None:
+            # 本文が追い出されていて store もない（プロンプトの資料が抜粋だけになる）
+            documents.count_fallback()
+            logger.warning("Body of %s (%s) is gone; using the excerpt", doc_id, url)
+        parts.append(f"[{metadata.get('title') or url}]({url})\n{doc.page_content}")
+    return "\n\n".join(parts)
+
+
+if __name__ == "__main__":
+    import pickle
+    import time
+
+    # 重なりのある3つのトピックで同じ記事が繰り返し返ってくる場合
+    articles = {
+        f"https://example.com/news/{i}": "ウクライナ情勢と国際秩序に関する解説記事の本文。" * 400
+        for i in range(5)
+    }
+    queries = [[0, 1, 2], [1, 2, 3], [2, 3, 4], [0, 2, 4]] * 5
+
+    def raw_results(indexes: list[int]) -> list[Document]:
+        urls = list(articles)
+        return [
+            Document(
+                page_content=articles[urls[i]], metadata={"title": f"記事{i}", "source": urls[i]}
+            )
+            for i in indexes
+        ]
+
+    store = DocumentStore()
+    raw_bytes = deduped_bytes = 0
+    raw_time = deduped_time = 0.0
+    for indexes in queries:
+        docs = raw_results(indexes)
+        raw_bytes += len(pickle.dumps(docs))
+        start = time.perf_counter()
+        str(docs)
+        raw_time += time.perf_counter() - start
+
+        refs = []
+        for doc in docs:
+            doc_id = store.put(doc.metadata["source"], doc.page_content)
+            refs.append(
+                Document(
+                    page_content=doc.page_content[:EXCERPT_CHARS],
+                    metadata={**doc.metadata, "doc_id": doc_id},
+                )
+            )
+        deduped_bytes += len(pickle.dumps(refs))
+        start = time.perf_counter()
+        format_context(refs, store)
+        deduped_time += time.perf_counter() - start
+
+    metrics = store.metrics()
+    print(f"{len(queries)} retrievals, {sum(len(q) for q in queries)} documents")
+    print(f"  raw results held:   {raw_bytes} bytes")
+    print(f"  references held:    {deduped_bytes} bytes + store {metrics['stored_bytes']} bytes")
+    print(f"  stored {metrics['stored']} bodies, deduplicated {metrics['deduplicated']}")
+    print(f"  prompt building:    raw {raw_time * 1e3:.2f}ms, store {deduped_time * 1e3:.2f}ms")
@@ -1,5 +1,8 @@
 import asyncio
+import logging
 import os
+import uuid
+from collections.abc import Iterator
 from datetime import datetime
 from enum import Enum
 from pprint import pprint
@@ -9,6 +12,7 @@ from dotenv import load_dotenv
 from IPython.display import Image, display
 from langchain_core.language_models import BaseChatModel
 from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import RunnableConfig
 from langchain_google_vertexai import VertexAI
 from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.memory import MemorySaver
@@ -17,6 +21,15 @@ from pydantic import BaseModel, Field
 
 from agent import CriticAgent, CriticContent, ReporterAgent, PointSelection
 from retrievers import create_tavily_search_api_retriever
+from checkpoint import SqliteCheckpointSaver, retention_policy_from_env
+from hedging import WARM_NAMESPACE, WARM_TTL, HedgedExecutor, ResponseCache
+from regeneration import json_patch
+from report_tree import ReportTree
+from scheduler import Scheduler, create_default_scheduler
+from storage import SQLiteReportBackend, SQLiteStore
+from thread_locks import ThreadLocks
+
+logger = logging.getLogger(__name__)
 
 
 class State(BaseModel):
@@ -24,13 +37,13 @@ class State(BaseModel):
     current_role: str = Field(default="", description="現在のロール")
     reporter_content: str = Field(default="", description="reporterの初回回答内容")
     report_id: str = Field(default="", description="レポートID")
-    point_selection_for_critic: PointSelection = Field(
+    point_selection_for_critic: Optional[PointSelection] = Field(
         default=None, description="ユーザーの要点選択"
     )
     explored_content: Optional[str] = Field(
         default=None, description="選択された要点の詳細レポート"
     )
-    user_selection_of_critic: PointSelection = Field(
+    user_selection_of_critic: Optional[PointSelection] = Field(
         default=None, description="ユーザーのcritic論点選択"
     )
     critic_content: CriticContent = Field(
@@ -40,13 +53,58 @@ class State(BaseModel):
     is_yes_case: bool = Field(default=False, description="Yesの事例を調査するかどうか")
 
 
+class ThreadNotFoundError(LookupError):
+    """チェックポイントがなく、再開できないスレッド"""
+
+
+# 選択後に実行するノード → その手前でユーザーの選択を待つノード
+SELECTION_NODES = {
+    "explore_report": "select_point",
+    "critic": "select_topic",
+    "investigate_cases": "select_case",
+}
+
+# stream_start / stream_resume が返す LangGraph のストリームの種類（LLM のトークンとノードの出力）
+STREAM_MODES = ["messages", "updates"]
+
+
 class AgentClassroom:
-    def __init__(self, llm: BaseChatModel, retriever: BaseRetriever) -> None:
+    def __init__(
+        self,
+        llm: BaseChatModel,
+        retriever: BaseRetriever,
+        scheduler: Optional[Scheduler] = None,
+        fallback_llm: Optional[BaseChatModel] = None,
+        store: Optional[SQLiteStore] = None,
+    ) -> None:
         self.llm = llm
         self.retriever = retriever
-        self.reporter = ReporterAgent(llm)
-        self.critic = CriticAgent(llm)
-        self.memory = MemorySaver()
+        # reporter と critic で同じスケジューラを共有し、プロバイダー単位で制限する
+        self.scheduler = scheduler or create_default_scheduler()
+        # store があればレポート・チェックポイント・キャッシュをワーカープロセス間で共有する
+        self.store = store
+        reports = ReportTree(backend=SQLiteReportBackend(store)) if store else None
+        # レイテンシの統計と縮退用のキャッシュ、warmup.py で事前計算した回答も共有する
+        self.hedger = HedgedExecutor(
+            cache=ResponseCache(store=store, models=[CriticContent]),
+            warm=ResponseCache(
+                store=store, namespace=WARM_NAMESPACE, ttl=WARM_TTL, models=[CriticContent]
+            )
+            if store
+            else None,
+        )
+        self.reporter = ReporterAgent(
+            llm, self.scheduler, fallback_llm, self.hedger, reports, store=store
+        )
+        self.critic = CriticAgent(llm, self.scheduler, fallback_llm, self.hedger)
+        # チェックポイントは差分圧縮して保存し、CHECKPOINT_* の保持ポリシーで古いものを削除する
+        self.memory = (
+            SqliteCheckpointSaver(store, retention=retention_policy_from_env())
+            if store
+            else MemorySaver()
+        )
+        # 同じスレッドへのコマンドを（store があればワーカープロセスをまたいで）1つずつ実行する
+        self.locks = ThreadLocks(store)
         self.graph = self._create_graph()
 
     def _create_graph(self) -> CompiledGraph:
@@ -58,32 +116,186 @@ class AgentClassroom:
         workflow.add_node("explore_report", self.explore_report_node)
         workflow.add_node("select_topic", self.topic_selection_node)
         workflow.add_node("critic", self.critic_node)
+        workflow.add_node("select_case", self.case_selection_node)
+        workflow.add_node("investigate_cases", self.investigate_cases_node)
 
         # エッジの追加
         workflow.add_edge("reporter", "select_point")
         workflow.add_edge("select_point", "explore_report")
         workflow.add_edge("explore_report", "select_topic")
         workflow.add_edge("select_topic", "critic")
+        workflow.add_edge("critic", "select_case")
+        workflow.add_edge("select_case", "investigate_cases")
+        # Yes / No の両方を調べられるよう、調査後は再び事例の選択を待つ
+        workflow.add_edge("investigate_cases", "select_case")
 
         workflow.set_entry_point("reporter")
 
-        return workflow.compile()
+        # ユーザーの選択を待つノードの手前で止め、選択内容はそのノードの出力として書き込む
+        return workflow.compile(
+            checkpointer=self.memory, interrupt_before=list(SELECTION_NODES.values())
+        )
+
+    @staticmethod
+    def new_thread_id() -> str:
+        """新しいセッションのスレッドID（推測できないよう乱数にする）"""
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def thread_config(thread_id: str) -> dict[str, Any]:
+        return {"configurable": {"thread_id": thread_id}}
+
+    def get_state(self, thread_id: str) -> Optional[State]:
+        """スレッドの最新のチェックポイントから State を取り出す"""
+        snapshot = self.graph.get_state(self.thread_config(thread_id))
+        return State(**snapshot.values) if snapshot.values else None
+
+    def start(self, thread_id: str, query: str) -> State:
+        """reporter を実行し、要点の選択待ちで止まった State を返す"""
+        with self.locks.hold(thread_id):
+            config = self.thread_config(thread_id)
+            self.graph.invoke(State(query=query, thread_id=thread_id), config)
+            return self.get_state(thread_id)
+
+    def resume(
+        self,
+        thread_id: str,
+        node_name: str,
+        selection: dict[str, Any],
+        seed: Optional[State] = None,
+    ) -> State:
+        """ユーザーの選択を書き込み、チェックポイントから node_name 以降を実行する
+
+        チェックポイントがないスレッド（サーバーの移行前に始まったセッションなど）は、
+        クライアントから送られた seed の State を起点にする。
+        """
+        with self.locks.hold(thread_id):
+            config = self._write_selection(thread_id, node_name, selection, seed)
+            self.graph.invoke(None, config)
+            return self.get_state(thread_id)
+
+    def refresh(self, thread_id: str, query: str) -> tuple[State, Optional[str]]:
+        """start の差分再生成版。出典が変わった要点だけを生成し直す
+
+        (State, 同じトピックの前回のレポートID) を返す。
+        """
+        with self.locks.hold(thread_id):
+            previous = self.get_state(thread_id)
+            base = previous.report_id if previous and previous.query == query else None
+            config = self.thread_config(thread_id)
+            config["configurable"]["regenerate"] = True
+            self.graph.invoke(State(query=query, thread_id=thread_id), config)
+            return self.get_state(thread_id), base
+
+    def refresh_detailed_report(
+        self, thread_id: str, selection: dict[str, Any], seed: Optional[State] = None
+    ) -> tuple[State, Optional[str], Optional[str]]:
+        """explore_report の差分再生成版。(State, 前回の詳細レポートID, 今回の詳細レポートID)"""
+        point = selection["point_selection_for_critic"]
+        with self.locks.hold(thread_id):
+            base = self.reporter.reports.detailed_report_id(point.report_id, point.point_id)
+            if base is None:
+                # 通常の explore では木に登録しないので、差分の起点として前回の生成結果を登録する
+                base = self._register_detailed_report(point.report_id, point.point_id)
+            config = self._write_selection(thread_id, "explore_report", selection, seed)
+            config["configurable"]["regenerate"] = True
+            self.graph.invoke(None, config)
+            detailed = self.reporter.reports.detailed_report_id(point.report_id, point.point_id)
+            return self.get_state(thread_id), base, detailed
+
+    def _register_detailed_report(
+        self, report_id: str, point_id: str, content: Optional[str] = None
+    ) -> Optional[str]:
+        try:
+            return self.reporter.register_detailed_report(report_id, point_id, content)
+        except (ValueError, IndexError) as e:
+            logger.warning(
+                "Could not register the detailed report of %s/%s: %s", report_id, point_id, e
+            )
+            return None
+
+    def report_patch(self, base_id: Optional[str], report_id: str) -> Optional[list[dict]]:
+        """base_id のレポートを report_id のレポートにする JSON Patch（base がなければ None）"""
+        if base_id is None or base_id not in self.reporter.reports:
+            return None
+        base = self.reporter.reports.get_report(base_id).model_dump(mode="json")
+        report = self.reporter.reports.get_report(report_id).model_dump(mode="json")
+        return json_patch(base, report)
+
+    def stream_start(self, thread_id: str, query: str) -> Iterator[tuple[str, Any]]:
+        """start と同じ処理を、(stream_mode, chunk) を順に返しながら実行する
+
+        ロックは最後まで読み切るか close() するまで持ち続ける。
+        """
+        with self.locks.hold(thread_id):
+            config = self.thread_config(thread_id)
+            yield from self.graph.stream(
+                State(query=query, thread_id=thread_id), config, stream_mode=STREAM_MODES
+            )
+
+    def stream_resume(
+        self,
+        thread_id: str,
+        node_name: str,
+        selection: dict[str, Any],
+        seed: Optional[State] = None,
+    ) -> Iterator[tuple[str, Any]]:
+        """resume と同じ処理を、(stream_mode, chunk) を順に返しながら実行する"""
+        with self.locks.hold(thread_id):
+            config = self._write_selection(thread_id, node_name, selection, seed)
+            yield from self.graph.stream(None, config, stream_mode=STREAM_MODES)
+
+    def _write_selection(
+        self,
+        thread_id: str,
+        node_name: str,
+        selection: dict[str, Any],
+        seed: Optional[State],
+    ) -> dict[str, Any]:
+        config = self.thread_config(thread_id)
+        if not self.graph.get_state(config).values:
+            if seed is None:
+                raise ThreadNotFoundError(f"Thread {thread_id} has no checkpoint")
+            self.graph.update_state(
+                config, self._compact_selections(seed.model_dump()), as_node="reporter"
+            )
+        self.graph.update_state(
+            config, self._compact_selections(selection), as_node=SELECTION_NODES[node_name]
+        )
+        return config
+
+    def _compact_selections(self, values: dict[str, Any]) -> dict[str, Any]:
+        # 要点の本文はレポートの木にあるので、チェックポイントには ID だけを残す
+        values = dict(values)
+        for name in ("point_selection_for_critic", "user_selection_of_critic"):
+            selection = values.get(name)
+            if isinstance(selection, dict):
+                selection = PointSelection(**selection)
+            if selection is not None:
+                values[name] = self.reporter.compact_selection(selection)
+        return values
 
     def invoke_node(self, node_name: str, state: State) -> State:
-        """特定のノードのみを実行する"""
+        """特定のノードのみを実行する（チェックポイントは使わない）"""
         workflow = StateGraph(State)
         workflow.add_node(node_name, getattr(self, f"{node_name}_node"))
         workflow.set_entry_point(node_name)
         graph = workflow.compile()
 
-        config = {"configurable": {"thread_id": "1"}}
-        result = graph.invoke(state, config)
+        result = graph.invoke(state)
         return State(**result)
 
-    def reporter_node(self, state: State) -> dict[str, Any]:
+    @staticmethod
+    def _regenerating(config: Optional[RunnableConfig]) -> bool:
+        return bool((config or {}).get("configurable", {}).get("regenerate"))
+
+    def reporter_node(self, state: State, config: RunnableConfig) -> dict[str, Any]:
         """初回の要点を3つ生成するノード"""
         query = state.query
-        content = self.reporter.generate_report(query)
+        if self._regenerating(config):
+            content = self.reporter.refresh_report(query)
+        else:
+            content = self.reporter.generate_report(query)
         # レポートを解析して保存
         report_content = self.reporter.parse_report_output(content, query)
         print(f"\nDebug - Reporter node:")
@@ -96,6 +308,11 @@ class AgentClassroom:
             "reporter_content": content,
             "report_id": report_content.id,
             "thread_id": state.thread_id,
+            # 同じスレッドで新しいトピックを始めた場合に前回の選択結果を残さない
+            "point_selection_for_critic": None,
+            "explored_content": None,
+            "user_selection_of_critic": None,
+            "critic_content": CriticContent(),
         }
 
     def point_selection_node(self, state: State) -> dict[str, Any]:
@@ -108,17 +325,18 @@ class AgentClassroom:
             "report_id": state.report_id,
         }
 
-    def explore_report_node(self, state: State) -> dict[str, Any]:
+    def explore_report_node(self, state: State, config: RunnableConfig) -> dict[str, Any]:
         """選択された要点について詳細レポートを生成するノード"""
-        print(f"\nDebug - Generating detailed report for:")
-        print(f"Report ID: {state.point_selection_for_critic.report_id}")
-        print(f"Point ID: {state.point_selection_for_critic.point_id}")
-        print(f"Available reports: {list(self.reporter.reports.keys())}")
-
-        content = self.reporter.generate_detailed_report(
-            state.point_selection_for_critic.report_id, state.point_selection_for_critic.point_id
-        )
-        print(f"\nDebug - Generated content length: {len(content)}")
+        selection = state.point_selection_for_critic
+        report_id, point_id = selection.report_id, selection.point_id
+        logger.debug("Generating the detailed report of %s/%s", report_id, point_id)
+        if self._regenerating(config):
+            content = self.reporter.refresh_detailed_report(report_id, point_id)
+            # 差分を返すのは再生成のときだけなので、そのときだけ木に登録する
+            self._register_detailed_report(report_id, point_id, content)
+        else:
+            content = self.reporter.generate_detailed_report(report_id, point_id)
+        logger.debug("Generated %d characters for %s/%s", len(content), report_id, point_id)
 
         return {
             "query": state.query,
@@ -142,19 +360,30 @@ class AgentClassroom:
             "report_id": state.report_id,
         }
 
+    def case_selection_node(self, state: State) -> dict[str, Any]:
+        """ユーザーによるYes/Noの事例選択を待機するノード"""
+        return {
+            "query": state.query,
+            "current_role": "select_case",
+            "reporter_content": state.reporter_content,
+            "point_selection_for_critic": state.point_selection_for_critic,
+            "explored_content": state.explored_content,
+            "critic_content": state.critic_content,
+            "is_yes_case": state.is_yes_case,
+            "report_id": state.report_id,
+        }
+
     def critic_node(self, state: State) -> dict[str, Any]:
         """選択されたトピックに対して論点を生成するノード"""
-        if (
-            not state.point_selection_for_critic
-            or not state.point_selection_for_critic.title
-            or not state.point_selection_for_critic.content
-        ):
+        if not state.point_selection_for_critic:
+            raise ValueError("Point selection with title and content is required for critic node")
+        title, content = self.reporter.selection_text(state.point_selection_for_critic)
+        if not title or not content:
             raise ValueError("Point selection with title and content is required for critic node")
 
-        critic_content = self.critic.generate_critique(
-            title=state.point_selection_for_critic.title,
-            content=state.point_selection_for_critic.content,
-        )
+        critic_content = self.critic.generate_critique(title=title, content=content)
+        # ユーザーが Yes/No を選ぶ前に、各論点の事例の検索を始めておく
+        self.reporter.prefetch_cases(critic_content.critic_points)
 
         return {
             "query": state.query,
@@ -170,7 +399,7 @@ class AgentClassroom:
     def investigate_cases_node(self, state: State) -> dict[str, Any]:
         """選択された論点に対してYes/Noの事例を調査するノード"""
         print("\nDebug - Investigate Cases Node:")
-        print(f"Current state: {state.dict()}")
+        print(f"Current role: {state.current_role}, Report ID: {state.report_id}")
         print(f"Point selection: {state.point_selection_for_critic}")
         print(f"User selection: {state.user_selection_of_critic}")
         print(f"Is Yes Case: {state.is_yes_case}")
@@ -182,8 +411,7 @@ class AgentClassroom:
 
         # titleとcontentがpoint_selection_for_criticにない場合は、
         # user_selection_of_criticから取得を試みる
-        title = state.point_selection_for_critic.title
-        content = state.point_selection_for_critic.content
+        title, content = self.reporter.selection_text(state.point_selection_for_critic)
 
         print(f"Debug - Initial title from point_selection: {title}")
         print(f"Debug - Initial content from point_selection: {content}")
@@ -192,8 +420,7 @@ class AgentClassroom:
             print("Debug - Title or content missing from point_selection_for_critic")
             if state.user_selection_of_critic:
                 print("Debug - Attempting to get from user_selection_of_critic")
-                title = state.user_selection_of_critic.title
-                content = state.user_selection_of_critic.content
+                title, content = self.reporter.selection_text(state.user_selection_of_critic)
                 print(f"Debug - Title from user_selection: {title}")
                 print(f"Debug - Content from user_selection: {content}")
             else:
@@ -221,7 +448,7 @@ class AgentClassroom:
             "thread_id": state.thread_id,
             "critic_content": state.critic_content,
         }
-        print("Debug - Returning result:", result)
+        print(f"Debug - Returning {len(cases_content)} chars of {yes_or_no} case content")
         return result
 
     def show_image(self):
@@ -237,17 +464,17 @@ def main():
     llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
     retriever = create_tavily_search_api_retriever()
     agent = AgentClassroom(llm, retriever)
-    init_state = State(query="日米首脳会談")
+    thread_id = "main"
 
-    # 初期状態から開始（reporterノード）
+    # 初期状態から開始（reporterノードを実行し、要点の選択待ちで止まる）
     print("\nExecuting reporter node:")
     print("-" * 50)
-    state = agent.invoke_node("reporter", init_state)
+    state = agent.start(thread_id, "日米首脳会談")
     print(f"Reporter content:\n{state.reporter_content}")
     print(f"Report ID: {state.report_id}")
+    print(f"Next: {agent.graph.get_state(agent.thread_config(thread_id)).next}")
 
-    # レポートの解析と保存
-    report_content = agent.reporter.parse_report_output(state.reporter_content, state.query)
+    report_content = agent.reporter.reports.get_report(state.report_id)
     print("\nParsed report points:")
     for point in report_content.points:
         print(f"\nPoint {point.id}:")
@@ -257,35 +484,46 @@ def main():
             print(f"Source: {point.source.name} ({point.source.url})")
     print("-" * 50)
 
-    # ユーザー入力のシミュレート（要点選択）
-    state.point_selection_for_critic = PointSelection(report_id=state.report_id, point_id="1")
-    print(
-        f"Selected point - Report ID: {state.point_selection_for_critic.report_id}, Point ID: {state.point_selection_for_critic.point_id}"
+    # ユーザー入力のシミュレート（要点選択）→ 詳細レポートの生成
+    point = report_content.points[0]
+    selection = PointSelection(
+        report_id=state.report_id, point_id=point.id, title=point.title, content=point.content
     )
-
-    # 詳細レポートの生成
     print("\nGenerating detailed report...")
-    state = agent.invoke_node("explore_report", state)
+    state = agent.resume(thread_id, "explore_report", {"point_selection_for_critic": selection})
     print(f"Current role: {state.current_role}")
-    print(f"Report ID: {state.report_id}")
     if state.explored_content:
         print(f"Explored content:\n{state.explored_content}")
     else:
         print("Warning: No explored content generated")
     print("-" * 50)
 
-    # ユーザー入力のシミュレート（トピック選択）
-    state.user_selection_of_critic = PointSelection(report_id=state.report_id, point_id="1")
-
-    # 最終的な論点生成
-    state = agent.invoke_node("critic", state)
+    # ユーザー入力のシミュレート（トピック選択）→ 論点生成
+    state = agent.resume(
+        thread_id,
+        "critic",
+        {"point_selection_for_critic": selection, "user_selection_of_critic": selection},
+    )
     print("\nCritic points:")
-    for i, point in enumerate(state.critic_content.points):
+    for i, critic_point in enumerate(state.critic_content.critic_points):
         print(f"\nPoint {i + 1}:")
-        print(f"Title: {point.title}")
-        print("Cases:")
-        for j, case in enumerate(point.cases):
-            print(f"  {j + 1}. {case}")
+        print(f"Title: {critic_point.title}")
+        print(f"Content: {critic_point.content}")
+
+    # ユーザー入力のシミュレート（Yes の事例を選択）→ 事例調査
+    critic_point = state.critic_content.critic_points[0]
+    case_selection = PointSelection(
+        report_id=state.report_id,
+        point_id="1",
+        title=critic_point.title,
+        content=critic_point.content,
+    )
+    state = agent.resume(
+        thread_id,
+        "investigate_cases",
+        {"point_selection_for_critic": case_selection, "is_yes_case": True},
+    )
+    print(f"\nYes cases:\n{state.explored_content}")
 
     print("\nExecution completed.")
 
@@ -0,0 +1,375 @@
+"""遅い LLM 呼び出しに対するデッドライン・ヘッジ・縮退のポリシー
+
+ノードごとにデッドラインを設定し、観測した p95 レイテンシを超えても主モデルが
+応答しない場合はフォールバックモデルへ2本目のリクエストを投げ（ヘッジ）、先に
+返ってきた方を採用する。デッドラインまでにどちらも返らなければ、キャッシュ済みの
+回答か短い代替回答に縮退する。
+"""
+
+import contextvars
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Optional, TypeVar
+
+from pydantic import BaseModel
+
+from profiling import profiled_thread
+from scheduler import abandon_with
+
+if TYPE_CHECKING:
+    from storage import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class DeadlineExceededError(TimeoutError):
+    """デッドラインまでに回答が得られず、縮退できる回答もなかった"""
+
+    def __init__(self, node: str, deadline: float) -> None:
+        super().__init__(f"{node}: no answer within {deadline:.0f}s")
+        self.node = node
+        self.deadline = deadline
+
+
+@dataclass
+class NodePolicy:
+    deadline: float = 60.0
+    # None の場合は観測したレイテンシの hedge_percentile を使う
+    hedge_after: Optional[float] = None
+    hedge_percentile: float = 0.95
+    # 観測数が min_samples に満たない間は initial_hedge_after を使う
+    min_samples: int = 20
+    initial_hedge_after: float = 20.0
+    hedge: bool = True
+
+
+DEFAULT_POLICIES = {
+    "generate_report": NodePolicy(deadline=60.0),
+    "generate_detailed_report": NodePolicy(deadline=45.0),
+    "check_cases": NodePolicy(deadline=45.0),
+    "generate_critique": NodePolicy(deadline=45.0),
+    "regenerate_points": NodePolicy(deadline=45.0),
+}
+
+
+class LatencyTracker:
+    """直近のレイテンシを保持してパーセンタイルを求める"""
+
+    def __init__(self, window: int = 200) -> None:
+        self._samples: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(q * len(samples)))
+        return samples[index]
+
+
+# warmup.py が事前計算した回答を保存する store の名前空間と既定の保持期間
+WARM_NAMESPACE = "warm"
+WARM_TTL = 24 * 3600
+
+_warming: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "hedging_warming", default=None
+)
+
+
+@contextmanager
+def warming(refresh: bool = False) -> Iterator[None]:
+    """ブロック内の call の結果をウォームキャッシュに保存する（授業前の事前計算用）
+
+    refresh=True なら、ウォームキャッシュにある回答も生成し直す。
+    """
+    token = _warming.set("refresh" if refresh else "warm")
+    try:
+        yield
+    finally:
+        _warming.reset(token)
+
+
+class ResponseCache:
+    """ノードと入力ごとに最後に成功した回答を保持する LRU キャッシュ
+
+    store を渡すと、他のワーカープロセスが保存した回答も参照できる。store には型の名前を付けた
+    JSON で保存するので、共有できるのは文字列と models に渡した pydantic モデルだけ。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        store: Optional["SQLiteStore"] = None,
+        namespace: str = "responses",
+        ttl: Optional[float] = None,
+        models: Iterable[type[BaseModel]] = (),
+    ) -> None:
+        self.max_entries = max_entries
+        self.store = store
+        self.namespace = namespace
+        self.ttl = ttl
+        self.models = {model.__name__: model for model in models}
+        self._entries: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(node: str, key: Any) -> str:
+        raw = json.dumps([node, key], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, node: str, key: Any) -> Optional[Any]:
+        cache_key = self.make_key(node, key)
+        with self._lock:
+            if cache_key in self._entries:
+                self._entries.move_to_end(cache_key)
+                return self._entries[cache_key]
+        if self.store is not None:
+            try:
+                return self._load(self.store.get_json(self.namespace, cache_key))
+            except (KeyError, TypeError, ValueError):
+                # 壊れた行や以前の形式（pickle）の行はキャッシュにないものとして扱う
+                logger.warning("Ignoring unreadable cached response for %s", node)
+        return None
+
+    def _load(self, data: Optional[dict[str, Any]]) -> Optional[Any]:
+        if data is None:
+            return None
+        if data["type"] == "str":
+            return data["value"]
+        model = self.models.get(data["type"])
+        if model is None:
+            raise ValueError(f"Unknown cached type: {data['type']}")
+        return model.model_validate(data["value"])
+
+    def _dump(self, value: Any) -> Optional[dict[str, Any]]:
+        if isinstance(value, str):
+            return {"type": "str", "value": value}
+        if type(value) in self.models.values():
+            return {"type": type(value).__name__, "value": value.model_dump()}
+        return None
+
+    def put(self, node: str, key: Any, value: Any) -> None:
+        cache_key = self.make_key(node, key)
+        with self._lock:
+            self._entries[cache_key] = value
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self.store is not None:
+            data = self._dump(value)
+            if data is None:
+                logger.debug("Not sharing cached %s of type %s", node, type(value).__name__)
+                return
+            self.store.put_json(self.namespace, cache_key, data, self.ttl)
+
+
+class HedgedExecutor:
+    """ノードごとのデッドライン・ヘッジ・縮退を行う
+
+    デッドラインを過ぎた、または相手が先に返ったために結果を使わなくなった呼び出しは、
+    スケジューラーのキューで待っていればスロットを確保せずに打ち切る。すでに実行中の呼び出しは
+    止められないので件数を数え、max_abandoned 件以上残っている間はヘッジで呼び出しを増やさず、
+    キャッシュ済みの回答があればそれを返す。
+    """
+
+    def __init__(
+        self,
+        policies: Optional[dict[str, NodePolicy]] = None,
+        cache: Optional[ResponseCache] = None,
+        max_workers: int = 32,
+        warm: Optional[ResponseCache] = None,
+        max_abandoned: int = 8,
+    ) -> None:
+        self.policies = {**DEFAULT_POLICIES, **(policies or {})}
+        self.cache = cache or ResponseCache()
+        # warmup.py が授業前に保存した回答（あれば LLM を呼ばずに返す）
+        self.warm = warm
+        self.max_abandoned = max_abandoned
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self._latency: dict[str, LatencyTracker] = {}
+        self._counters: dict[str, dict[str, int]] = {}
+        # 結果を待たなくなったがまだ実行中の呼び出し
+        self._abandoned: dict[str, set[Future]] = {}
+        self._lock = threading.Lock()
+
+    def _tracker(self, node: str) -> LatencyTracker:
+        with self._lock:
+            return self._latency.setdefault(node, LatencyTracker())
+
+    def _count(self, node: str, name: str) -> None:
+        with self._lock:
+            counters = self._counters.setdefault(node, {})
+            counters[name] = counters.get(name, 0) + 1
+
+    def hedge_delay(self, node: str) -> float:
+        policy = self.policies.get(node, NodePolicy())
+        if policy.hedge_after is not None:
+            return policy.hedge_after
+        tracker = self._tracker(node)
+        if len(tracker) < policy.min_samples:
+            return policy.initial_hedge_after
+        return tracker.percentile(policy.hedge_percentile) or policy.initial_hedge_after
+
+    def _submit(
+        self,
+        fn: Callable[[], T],
+        abandoned: threading.Event,
+        tracker: Optional[LatencyTracker] = None,
+    ) -> Future:
+        # 優先度やコールバックなどの contextvars をワーカースレッドへ引き継ぐ
+        ctx = contextvars.copy_context()
+        ctx.run(abandon_with, abandoned)
+        started = time.monotonic()
+
+        def run() -> T:
+            # プロファイル中のリクエストなら、このワーカースレッドもサンプリングする
+            with profiled_thread():
+                return fn()
+
+        future = self._executor.submit(ctx.run, run)
+        if tracker is not None:
+
+            def _record(f: Future) -> None:
+                if not f.cancelled() and f.exception() is None:
+                    tracker.record(time.monotonic() - started)
+
+            future.add_done_callback(_record)
+        return future
+
+    def _abandon(self, node: str, pending: set[Future], abandoned: threading.Event) -> None:
+        """結果を使わない呼び出しを打ち切り、止められないものは完了するまで数える"""
+        abandoned.set()
+        for future in pending:
+            if future.cancel():
+                continue
+            self._count(node, "abandoned")
+            with self._lock:
+                self._abandoned.setdefault(node, set()).add(future)
+
+            def _discard(f: Future) -> None:
+                with self._lock:
+                    self._abandoned[node].discard(f)
+
+            future.add_done_callback(_discard)
+
+    def abandoned_in_flight(self) -> int:
+        with self._lock:
+            return sum(len(futures) for futures in self._abandoned.values())
+
+    def warm_result(self, node: str, key: Any) -> Optional[Any]:
+        """ウォームキャッシュにある回答（refresh 中は None）"""
+        if self.warm is None or _warming.get() == "refresh":
+            return None
+        value = self.warm.get(node, key)
+        if value is not None:
+            self._count(node, "warm_hits")
+        return value
+
+    def remember(self, node: str, key: Any, value: Any) -> None:
+        """call を通さずに組み立てた回答（差分再生成のレポートなど）をキャッシュに保存する"""
+        self.cache.put(node, key, value)
+        if self.warm is not None and _warming.get() is not None:
+            self.warm.put(node, key, value)
+
+    def call(
+        self,
+        node: str,
+        key: Any,
+        primary: Callable[[], T],
+        fallback: Optional[Callable[[], T]] = None,
+        shorter: Optional[Callable[[], Optional[T]]] = None,
+    ) -> T:
+        """primary を実行し、必要に応じて fallback でヘッジ、間に合わなければ縮退する"""
+        warm = self.warm_result(node, key)
+        if warm is not None:
+            return warm
+        policy = self.policies.get(node, NodePolicy())
+        saturated = self.abandoned_in_flight() >= self.max_abandoned
+        if saturated:
+            # 打ち切れなかった呼び出しが LLM のスロットを占めているので、キャッシュがあれば待たない
+            cached = self.cache.get(node, key)
+            if cached is not None:
+                self._count(node, "degraded_saturated")
+                return cached
+        hedge = policy.hedge and not saturated
+        started = time.monotonic()
+        deadline = started + policy.deadline
+        abandoned = threading.Event()
+        pending = {self._submit(primary, abandoned, self._tracker(node))}
+        fallback_future: Optional[Future] = None
+        error: Optional[BaseException] = None
+
+        while pending:
+            if fallback_future is None and fallback is not None and hedge:
+                timeout = min(deadline, started + self.hedge_delay(node)) - time.monotonic()
+            else:
+                timeout = deadline - time.monotonic()
+            done, pending = wait(pending, timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is fallback_future:
+                        self._count(node, "fallback_won")
+                    result = future.result()
+                    # 負けた方の呼び出しはもう使わない
+                    self._abandon(node, pending, abandoned)
+                    self.remember(node, key, result)
+                    return result
+                error = future.exception()
+                logger.warning("%s: call failed: %s", node, error)
+            if time.monotonic() >= deadline:
+                break
+            if fallback_future is None and fallback is not None and (hedge or not pending):
+                # p95 を過ぎた、または主モデルが失敗したのでフォールバックモデルへ投げる
+                self._count(node, "hedged")
+                fallback_future = self._submit(fallback, abandoned)
+                pending.add(fallback_future)
+
+        if pending:
+            self._count(node, "deadline_exceeded")
+            self._abandon(node, pending, abandoned)
+        cached = self.cache.get(node, key)
+        if cached is not None:
+            self._count(node, "degraded_cache")
+            return cached
+        answer = shorter() if shorter is not None else None
+        if answer is not None:
+            self._count(node, "degraded_shorter")
+            return answer
+        if error is not None and not pending:
+            raise error
+        raise DeadlineExceededError(node, policy.deadline)
+
+    def metrics(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            nodes = set(self._latency) | set(self._counters)
+            counters = {node: dict(self._counters.get(node, {})) for node in nodes}
+            in_flight = {node: len(self._abandoned.get(node, ())) for node in nodes}
+        return {
+            node: {
+                "samples": len(self._tracker(node)),
+                "p50_seconds": self._tracker(node).percentile(0.5),
+                "p95_seconds": self._tracker(node).percentile(0.95),
+                "hedge_after_seconds": self.hedge_delay(node),
+                "abandoned_in_flight": in_flight[node],
+                **counters[node],
+            }
+            for node in sorted(nodes)
+        }
@@ -0,0 +1,287 @@
+"""アップロードされた授業資料（PDF）の非同期の取り込み
+
+アップロードされた PDF はバックグラウンドのワーカーが1ページずつ
+抽出 → チャンク分割 → まとめて埋め込み → Chroma への追加 の順に処理する。
+batch_size 件のチャンクがたまるたびにインデックスへ追加するので、大きな PDF も
+処理が終わったページから検索できる。進捗は GET /documents/{job_id} で確認できる。
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Optional
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import CharacterTextSplitter
+
+from scheduler import Priority, Scheduler, create_default_scheduler, priority
+from utils import count_pdf_pages, iter_pdf_pages
+
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+
+    from storage import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+PDF_MAGIC = b"%PDF-"
+
+
+class InvalidDocumentError(ValueError):
+    """PDF ではない（415）、または大きすぎる（413）ファイル"""
+
+    def __init__(self, status: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+@dataclass
+class IngestionJob:
+    id: str
+    filename: str
+    status: str = "queued"  # queued / running / done / failed
+    pages_total: Optional[int] = None
+    pages_done: int = 0
+    chunks_indexed: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    def to_dict(self) -> dict[str, Any]:
+        data = asdict(self)
+        data["progress"] = self.pages_done / self.pages_total if self.pages_total else 0.0
+        return data
+
+
+def _default_embeddings() -> Embeddings:
+    from langchain_openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(model="text-embedding-3-small")
+
+
+class IngestionPipeline:
+    """PDF の取り込みジョブを max_workers 個のスレッドで処理する
+
+    埋め込みの API 呼び出しは scheduler の "embeddings" プロバイダーとして BATCH 優先度で実行する。
+    store を渡すと、ジョブの進捗を別のワーカープロセスからも参照できる。persist_directory の
+    インデックスに別のワーカーが追加したチャンクは、開いているクライアントからは見えないので、
+    store のインデックスの版が変わっていたら検索の前にクライアントを開き直す。
+    """
+
+    namespace = "ingestion"
+    index_version_key = "_index_version"
+
+    def __init__(
+        self,
+        embeddings_factory: Callable[[], Embeddings] = _default_embeddings,
+        scheduler: Optional[Scheduler] = None,
+        store: Optional["SQLiteStore"] = None,
+        max_workers: int = 2,
+        batch_size: int = 64,
+        chunk_size: int = 1000,
+        collection_name: str = "course_materials",
+        persist_directory: Optional[str] = None,
+        upload_dir: Optional[str] = None,
+        max_upload_bytes: int = 50 * 1024 * 1024,
+        job_ttl: float = 7 * 24 * 3600,
+    ) -> None:
+        self.embeddings_factory = embeddings_factory
+        self.scheduler = scheduler or create_default_scheduler()
+        self.store = store
+        self.batch_size = batch_size
+        self.collection_name = collection_name
+        self.persist_directory = persist_directory
+        self.upload_dir = upload_dir or tempfile.mkdtemp(prefix="agent_classroom_uploads_")
+        self.max_upload_bytes = max_upload_bytes
+        self.job_ttl = job_ttl
+        self._splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs: dict[str, IngestionJob] = {}
+        self._lock = threading.Lock()
+        self._vectorstore: Optional["Chroma"] = None
+        self._vectorstore_cond = threading.Condition()
+        # クライアントを使っている呼び出しの数と、開いたときのインデックスの版
+        self._vectorstore_users = 0
+        self._seen_version = 0
+
+    def _index_version(self) -> int:
+        if self.store is None or self.persist_directory is None:
+            return self._seen_version
+        return self.store.get_json(self.namespace, self.index_version_key) or 0
+
+    def _bump_index_version(self) -> None:
+        if self.store is None or self.persist_directory is None:
+            return
+        with self.store.transaction():
+            version = self.store.get_json(self.namespace, self.index_version_key) or 0
+            self.store.put_json(self.namespace, self.index_version_key, version + 1)
+        with self._vectorstore_cond:
+            # 間に別のワーカーが追加していれば、次に使うときに開き直す
+            if version == self._seen_version:
+                self._seen_version = version + 1
+
+    @contextmanager
+    def _using_vectorstore(self) -> Iterator["Chroma"]:
+        # OpenAI のキーがなくてもサーバーを起動できるよう、最初のジョブまで作らない
+        with self._vectorstore_cond:
+            version = self._index_version()
+            if self._vectorstore is not None and version != self._seen_version:
+                from chromadb.api.client import SharedSystemClient
+
+                # 同じディレクトリのクライアントはプロセス内で共有されるので、使用中の呼び出しを待つ
+                self._vectorstore_cond.wait_for(lambda: self._vectorstore_users == 0)
+                SharedSystemClient.clear_system_cache()
+                self._vectorstore = None
+            if self._vectorstore is None:
+                from langchain_chroma import Chroma
+
+                self._vectorstore = Chroma(
+                    collection_name=self.collection_name,
+                    embedding_function=self.embeddings_factory(),
+                    persist_directory=self.persist_directory,
+                )
+                self._seen_version = version
+            self._vectorstore_users += 1
+            vectorstore = self._vectorstore
+        try:
+            yield vectorstore
+        finally:
+            with self._vectorstore_cond:
+                self._vectorstore_users -= 1
+                self._vectorstore_cond.notify_all()
+
+    def save_upload(self, file: BinaryIO, filename: str) -> str:
+        """アップロードを一時ファイルに書き出す（PDF でない、または大きすぎる場合は例外）"""
+        os.makedirs(self.upload_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=".pdf", dir=self.upload_dir)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                head = file.read(len(PDF_MAGIC))
+                if head != PDF_MAGIC:
+                    raise InvalidDocumentError(415, f"{filename} is not a PDF")
+                out.write(head)
+                written = len(head)
+                while chunk := file.read(1024 * 1024):
+                    written += len(chunk)
+                    if written > self.max_upload_bytes:
+                        raise InvalidDocumentError(
+                            413, f"{filename} exceeds {self.max_upload_bytes // (1024 * 1024)} MB"
+                        )
+                    out.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
+
+    def submit(self, path: str, filename: str, delete_after: bool = True) -> IngestionJob:
+        """path の PDF の取り込みをバックグラウンドで始める"""
+        job = IngestionJob(id=uuid.uuid4().hex, filename=filename)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._save(job)
+        self._executor.submit(self._run, job, path, delete_after)
+        return job
+
+    def get(self, job_id: str) -> Optional[dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.to_dict()
+        if self.store is not None:
+            return self.store.get_json(self.namespace, job_id)
+        return None
+
+    def _save(self, job: IngestionJob) -> None:
+        if self.store is not None:
+            self.store.put_json(self.namespace, job.id, job.to_dict(), self.job_ttl)
+
+    def _update(self, job: IngestionJob, **changes: Any) -> None:
+        with self._lock:
+            for name, value in changes.items():
+                setattr(job, name, value)
+        self._save(job)
+
+    def _index(self, job: IngestionJob, batch: list[Document]) -> None:
+        # 埋め込みの API をバッチごとに1回だけ呼び、そのままインデックスに追加する
+        ids = [f"{job.id}-{job.chunks_indexed + i}" for i in range(len(batch))]
+        with self._using_vectorstore() as vectorstore:
+            self.scheduler.run("embeddings", vectorstore.add_documents, batch, ids=ids)
+        self._bump_index_version()
+        self._update(job, chunks_indexed=job.chunks_indexed + len(batch))
+
+    def _run(self, job: IngestionJob, path: str, delete_after: bool) -> None:
+        try:
+            self._update(job, status="running", started_at=time.time())
+            self._update(job, pages_total=count_pdf_pages(path))
+            batch: list[Document] = []
+            # 授業中のリクエストの埋め込みや LLM 呼び出しを先に通す
+            with priority(Priority.BATCH):
+                for number, text in iter_pdf_pages(path):
+                    metadata = {"source": job.filename, "page": number, "job_id": job.id}
+                    for chunk in self._splitter.split_text(text):
+                        batch.append(Document(page_content=chunk, metadata=metadata))
+                    if len(batch) >= self.batch_size:
+                        self._index(job, batch)
+                        batch = []
+                    self._update(job, pages_done=number)
+                if batch:
+                    self._index(job, batch)
+            self._update(job, status="done", finished_at=time.time())
+            logger.info(
+                "Ingested %s: %d pages, %d chunks", job.filename, job.pages_done, job.chunks_indexed
+            )
+        except Exception as e:
+            logger.exception("Ingestion of %s failed", job.filename)
+            self._update(job, status="failed", error=str(e), finished_at=time.time())
+        finally:
+            if delete_after and os.path.exists(path):
+                os.remove(path)
+
+    def search(self, query: str, k: int = 4) -> list[Document]:
+        """取り込み済みのチャンク（取り込み中の PDF も処理済みのページまで）を検索する"""
+        if self._vectorstore is None and self.persist_directory is None:
+            return []
+        with self._using_vectorstore() as vectorstore:
+            return self.scheduler.run("embeddings", vectorstore.similarity_search, query, k=k)
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        statuses: dict[str, int] = {}
+        for job in jobs:
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "jobs": statuses,
+            "pages_done": sum(job.pages_done for job in jobs),
+            "chunks_indexed": sum(job.chunks_indexed for job in jobs),
+        }
+
+
+def default_chroma_dir(store: Optional["SQLiteStore"]) -> Optional[str]:
+    """共有ストアの SQLite ファイルの隣の chroma/（ストアがなければプロセス内のみ）"""
+    if store is None:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(store.path)), "chroma")
+
+
+def ingestion_settings_from_env(store: Optional["SQLiteStore"] = None) -> dict[str, Any]:
+    """INGESTION_WORKERS / INGESTION_BATCH_SIZE / INGESTION_MAX_UPLOAD_MB / CHROMA_DIR
+
+    CHROMA_DIR が未設定なら、すべてのワーカーが store と同じディレクトリのインデックスを使う。
+    """
+    return {
+        "max_workers": int(os.getenv("INGESTION_WORKERS", "2")),
+        "batch_size": int(os.getenv("INGESTION_BATCH_SIZE", "64")),
+        "max_upload_bytes": int(os.getenv("INGESTION_MAX_UPLOAD_MB", "50")) * 1024 * 1024,
+        "persist_directory": os.getenv("CHROMA_DIR", default_chroma_dir(store) or "") or None,
+    }
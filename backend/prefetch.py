@@ -0,0 +1,191 @@
+"""論点ごとの Yes/No 事例の検索結果を先読みするキャッシュ
+
+critic ノードで論点が生成された時点で、各論点の「Yes の事例」「No の事例」の検索クエリを
+バッチ優先度で並行に実行しておき、ユーザーが Yes/No を選んだときには検索を待たずに
+LLM の呼び出しを始められるようにする。
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import TYPE_CHECKING, Any, Optional
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from scheduler import Priority, Scheduler, priority
+
+if TYPE_CHECKING:
+    from docstore import DocumentStore
+    from storage import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+CASE_SIDES = ("Yes", "No")
+
+
+def case_query(title: str, yes_or_no: str) -> str:
+    """check_cases で使う検索クエリ"""
+    return f"{title} {yes_or_no}の事例"
+
+
+def expand_case_queries(titles: Iterable[str]) -> list[str]:
+    """論点のタイトルを Yes/No 両方の検索クエリに展開する"""
+    return [case_query(title, side) for title in titles if title for side in CASE_SIDES]
+
+
+class RetrievalPrefetcher:
+    """検索クエリごとの結果を TTL 付きで保持し、先読み中のクエリは完了を待って共有する
+
+    store を渡すと、別のワーカープロセスが先読みした結果も参照できる。store には page_content と
+    metadata の JSON だけを保存し、読み出すときに documents から本文への参照を付け直す。
+    """
+
+    namespace = "retrieval"
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        scheduler: Scheduler,
+        provider: str = "tavily",
+        ttl: float = 600.0,
+        max_entries: int = 512,
+        max_workers: int = 4,
+        inflight_timeout: float = 10.0,
+        store: Optional["SQLiteStore"] = None,
+        documents: Optional["DocumentStore"] = None,
+    ) -> None:
+        self.retriever = retriever
+        self.scheduler = scheduler
+        self.provider = provider
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # 先読みが終わらない場合は待つのをやめて対話的な優先度で検索し直す
+        self.inflight_timeout = inflight_timeout
+        self.store = store
+        self.documents = documents
+        self._entries: OrderedDict[str, tuple[float, list]] = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._counters = {
+            "prefetched": 0,
+            "prefetch_errors": 0,
+            "hits": 0,
+            "inflight_hits": 0,
+            # 先読みを待っていたが失敗して、その場で検索し直した回数
+            "inflight_errors": 0,
+            "misses": 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def _cached(self, query: str) -> Optional[list]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(query)
+                    return entry[1]
+                del self._entries[query]
+        if self.store is not None:
+            try:
+                value = self.store.get_json(self.namespace, query)
+                if value is not None:
+                    return [self._restore(doc) for doc in value]
+            except (KeyError, TypeError, ValueError):
+                # 壊れた行や以前の形式（pickle）の行は、検索し直して上書きする
+                logger.warning("Ignoring unreadable prefetched results for %r", query)
+        return None
+
+    def _restore(self, doc: dict[str, Any]) -> Document:
+        if self.documents is not None:
+            return self.documents.restore(doc["page_content"], doc["metadata"])
+        return Document(page_content=doc["page_content"], metadata=doc["metadata"])
+
+    def _put(self, query: str, docs: list, ttl: Optional[float] = None) -> None:
+        ttl = ttl or self.ttl
+        with self._lock:
+            self._entries[query] = (time.time() + ttl, docs)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self.store is not None:
+            value = [{"page_content": d.page_content, "metadata": d.metadata} for d in docs]
+            self.store.put_json(self.namespace, query, value, ttl=ttl)
+
+    def _retrieve(self, query: str, ttl: Optional[float] = None) -> list:
+        docs = self.scheduler.run(self.provider, self.retriever.invoke, query)
+        self._put(query, docs, ttl)
+        return docs
+
+    def _prefetch_one(self, query: str, ttl: Optional[float]) -> list:
+        try:
+            # 対話的なリクエストの検索を先に通す
+            with priority(Priority.BATCH):
+                docs = self._retrieve(query, ttl)
+            self._count("prefetched")
+            return docs
+        except Exception as e:
+            self._count("prefetch_errors")
+            logger.warning("Prefetch failed for %r: %s", query, e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(query, None)
+
+    def prefetch(self, queries: Iterable[str], ttl: Optional[float] = None) -> list[Future]:
+        """キャッシュにも実行中にもないクエリをバックグラウンドで検索する（結果は待たない）
+
+        ttl を指定すると、その秒数だけ結果を保持する（授業前の warmup.py 用）。
+        """
+        futures = []
+        for query in dict.fromkeys(queries):
+            if self._cached(query) is not None:
+                continue
+            with self._lock:
+                if query in self._inflight:
+                    continue
+                future = self._executor.submit(self._prefetch_one, query, ttl)
+                self._inflight[query] = future
+            futures.append(future)
+        return futures
+
+    def get(self, query: str) -> list:
+        """キャッシュ済みの結果、先読み中なら完了を待った結果、なければその場で検索した結果を返す"""
+        docs = self._cached(query)
+        if docs is not None:
+            self._count("hits")
+            return docs
+        with self._lock:
+            future = self._inflight.get(query)
+        if future is not None:
+            try:
+                docs = future.result(timeout=self.inflight_timeout)
+                self._count("inflight_hits")
+                return docs
+            except FutureTimeoutError:
+                logger.info("Prefetch for %r is still running, retrieving directly", query)
+            except Exception as e:
+                self._count("inflight_errors")
+                logger.warning("Prefetch for %r failed, retrieving directly: %s", query, e)
+        self._count("misses")
+        return self._retrieve(query)
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            counters["inflight"] = len(self._inflight)
+            counters["entries"] = len(self._entries)
+        lookups = counters["hits"] + counters["inflight_hits"] + counters["misses"]
+        counters["hit_rate"] = (
+            (counters["hits"] + counters["inflight_hits"]) / lookups if lookups else 0.0
+        )
+        return counters
@@ -0,0 +1,390 @@
+"""リクエスト単位のプロファイリング
+
+X-Profile ヘッダー（または ?profile=）に PROFILE_TOKEN を付けたリクエストの実行中、
+そのリクエストを処理しているスレッドのスタックを一定間隔でサンプリングし、ID を付けて保存する。
+エンドポイントの処理はスレッドプールやヘッジ用のワーカースレッドで実行されるため、
+呼び出し元のスレッドしか見えない cProfile / pyinstrument ではなく、
+sys._current_frames() によるサンプリングを使う。
+どのワーカースレッドがどのリクエストを処理しているかは、contextvar で引き継いだプロファイル ID から
+profiled_thread() が登録する。イベントループのスレッドは他の接続と共有しているので、
+そのリクエストのタスクがループで実行中のサンプルだけを記録する（他のリクエストのスタックは混ざらない）。
+PROFILE_SAMPLE_RATE を設定すると、その割合のリクエストを粗い間隔で常時プロファイルする。
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from types import FrameType
+from typing import TYPE_CHECKING, Any, Optional, TypeVar
+from urllib.parse import parse_qs
+
+from fastapi.concurrency import run_in_threadpool as _run_in_threadpool
+
+if TYPE_CHECKING:
+    from storage import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 待機中のスタックの末尾に現れる標準ライブラリのモジュール
+_WAIT_MODULES = ("threading.py", "queue.py", "selectors.py")
+# これらの関数（モジュール名, qualname）で待機しているスレッドはアイドルとみなして集計しない
+_IDLE_LOOPS = {
+    ("concurrent.futures.thread", "_worker"),
+    ("anyio._backends._asyncio", "WorkerThread.run"),
+    ("asyncio.base_events", "BaseEventLoop._run_once"),
+    ("socketserver", "BaseServer.serve_forever"),
+    ("checkpoint", "SqliteCheckpointSaver._compaction_loop"),
+}
+
+T = TypeVar("T")
+
+# 実行中のコンテキストを処理しているリクエストのプロファイル ID
+_profile_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "profile_id", default=None
+)
+# スレッドの ident → そのスレッドが処理しているプロファイル ID（と入れ子の数）
+_profiled_threads: dict[int, Counter] = {}
+# イベントループのタスク → (プロファイル ID, ループのスレッドの ident, ループ)
+_profiled_tasks: dict[asyncio.Task, tuple[str, int, asyncio.AbstractEventLoop]] = {}
+_profiled_threads_lock = threading.Lock()
+
+
+@contextmanager
+def profiled_thread() -> Iterator[None]:
+    """プロファイル中のリクエストの処理なら、ブロックの間このスレッドをサンプリングの対象にする"""
+    profile_id = _profile_id.get()
+    if profile_id is None:
+        yield
+        return
+    ident = threading.get_ident()
+    with _profiled_threads_lock:
+        _profiled_threads.setdefault(ident, Counter())[profile_id] += 1
+    try:
+        yield
+    finally:
+        with _profiled_threads_lock:
+            counts = _profiled_threads[ident]
+            counts[profile_id] -= 1
+            if counts[profile_id] <= 0:
+                del counts[profile_id]
+            if not counts:
+                del _profiled_threads[ident]
+
+
+def profiled_threads(profile_id: str) -> set[int]:
+    with _profiled_threads_lock:
+        threads = {ident for ident, counts in _profiled_threads.items() if profile_id in counts}
+        tasks = [(task, v) for task, v in _profiled_tasks.items() if v[0] == profile_id]
+    # ループのスレッドは、いまそのループで動いているのがこのリクエストのタスクのときだけ含める
+    for task, (_, ident, loop) in tasks:
+        if asyncio.current_task(loop) is task:
+            threads.add(ident)
+    return threads
+
+
+def tag_task(profile_id: str) -> None:
+    """実行中の asyncio タスクをプロファイル中のリクエストのタスクとして記録する"""
+    task = asyncio.current_task()
+    if task is None:
+        return
+    with _profiled_threads_lock:
+        _profiled_tasks.setdefault(task, (profile_id, threading.get_ident(), task.get_loop()))
+
+
+@contextmanager
+def profiled_task(profile_id: str) -> Iterator[None]:
+    """ブロックの間、このタスク（と tag_task() したタスク）が動いているループのスレッドを記録する"""
+    tag_task(profile_id)
+    try:
+        yield
+    finally:
+        with _profiled_threads_lock:
+            for task in [t for t, v in _profiled_tasks.items() if v[0] == profile_id]:
+                del _profiled_tasks[task]
+
+
+async def run_in_threadpool(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """fastapi の run_in_threadpool と同じ。プロファイル中ならワーカースレッドも記録する"""
+
+    def run() -> T:
+        with profiled_thread():
+            return func(*args, **kwargs)
+
+    return await _run_in_threadpool(run)
+
+
+def _label(frame: FrameType) -> str:
+    code = frame.f_code
+    path = code.co_filename
+    if path.startswith(APP_DIR):
+        location = os.path.relpath(path, APP_DIR)
+    else:
+        location = "/".join(path.split(os.sep)[-2:])
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({location}:{code.co_firstlineno})"
+
+
+def _is_app_label(label: str) -> bool:
+    # アプリのモジュールは backend からの相対パス（agent.py など）、それ以外は "パッケージ/ファイル"
+    location = label.rsplit(" (", 1)[-1].split(":")[0]
+    return "/" not in location and not location.startswith("<")
+
+
+def _stack(frame: Optional[FrameType]) -> list[FrameType]:
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _is_idle(frames: list[FrameType]) -> bool:
+    """プールのワーカーやイベントループが次の仕事を待っているだけのスタックか"""
+    for frame in reversed(frames):
+        if os.path.basename(frame.f_code.co_filename) in _WAIT_MODULES:
+            continue
+        code = frame.f_code
+        name = getattr(code, "co_qualname", code.co_name)
+        return (frame.f_globals.get("__name__"), name) in _IDLE_LOOPS
+    return True
+
+
+def _thread_group(name: str) -> str:
+    # hedge_0, hedge_1 … のようなプールのスレッドは1つにまとめる
+    base = name.rsplit("_", 1)
+    return base[0] if len(base) == 2 and base[1].isdigit() else name
+
+
+@dataclass
+class Profile:
+    id: str
+    method: str
+    path: str
+    mode: str  # "request"（ヘッダー指定）または "sampled"
+    interval: float
+    started_at: float
+    duration: float = 0.0
+    samples: int = 0
+    stacks: Counter = field(default_factory=Counter)
+
+    def collapsed(self) -> str:
+        """flamegraph.pl / speedscope で読める collapsed stack 形式"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self, top: int = 30) -> dict[str, Any]:
+        """関数ごとの推定時間（サンプル数 × 間隔）。inclusive はアプリのコードに絞る"""
+        self_counts: Counter = Counter()
+        inclusive: Counter = Counter()
+        threads: Counter = Counter()
+        for stack, count in self.stacks.items():
+            threads[stack[0]] += count
+            self_counts[stack[-1]] += count
+            for label in set(stack[1:]):
+                if _is_app_label(label):
+                    inclusive[label] += count
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "mode": self.mode,
+            "started_at": self.started_at,
+            "duration_seconds": self.duration,
+            "interval_seconds": self.interval,
+            "samples": self.samples,
+            "threads": dict(threads.most_common()),
+            "app_inclusive_seconds": {
+                k: round(v * self.interval, 4) for k, v in inclusive.most_common(top)
+            },
+            "self_seconds": {
+                k: round(v * self.interval, 4) for k, v in self_counts.most_common(top)
+            },
+        }
+
+    def to_json(self) -> dict[str, Any]:
+        return {**self.summary(), "collapsed": self.collapsed()}
+
+
+class StackSampler:
+    """interval ごとに、プロファイル中のリクエストを処理しているスレッドのスタックを記録する"""
+
+    def __init__(self, profile: Profile) -> None:
+        self.profile = profile
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _sample(self) -> None:
+        names = {t.ident: _thread_group(t.name) for t in threading.enumerate()}
+        targets = profiled_threads(self.profile.id)
+        for ident, frame in sys._current_frames().items():
+            if ident not in targets:
+                continue
+            frames = _stack(frame)
+            if _is_idle(frames):
+                continue
+            stack = (names.get(ident, str(ident)),) + tuple(_label(f) for f in frames)
+            self.profile.stacks[stack] += 1
+        self.profile.samples += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.profile.interval):
+            self._sample()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> Profile:
+        self._stop.set()
+        self._thread.join()
+        self.profile.duration = time.time() - self.profile.started_at
+        return self.profile
+
+
+class ProfileStore:
+    """直近のプロファイルを保持する。store を渡すと別のワーカーからもダウンロードできる"""
+
+    namespace = "profiles"
+
+    def __init__(
+        self,
+        max_entries: int = 50,
+        ttl: float = 24 * 3600,
+        store: Optional["SQLiteStore"] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self._profiles: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, profile: Profile) -> None:
+        data = profile.to_json()
+        with self._lock:
+            self._profiles[profile.id] = data
+            while len(self._profiles) > self.max_entries:
+                self._profiles.popitem(last=False)
+        if self.store is not None:
+            self.store.put(
+                self.namespace, profile.id, json.dumps(data, ensure_ascii=False).encode(), self.ttl
+            )
+
+    def get(self, profile_id: str) -> Optional[dict[str, Any]]:
+        with self._lock:
+            if profile_id in self._profiles:
+                return self._profiles[profile_id]
+        if self.store is not None:
+            value = self.store.get(self.namespace, profile_id)
+            if value is not None:
+                return json.loads(value)
+        return None
+
+    def recent(self) -> list[dict[str, Any]]:
+        with self._lock:
+            profiles = list(self._profiles.values())
+        keys = ("id", "method", "path", "mode", "started_at", "duration_seconds", "samples")
+        return [{k: p[k] for k in keys} for p in reversed(profiles)]
+
+
+class ProfilingMiddleware:
+    """X-Profile ヘッダーか ?profile= が token と一致するリクエストと、sample_rate の割合を記録する
+
+    プロファイルにはファイルパスや関数名が含まれるので、token が未設定なら
+    ヘッダー・クエリは無視する（sample_rate による常時プロファイルだけになる）。
+    レスポンスには X-Profile-Id を付ける（GET /profiles/{id} でダウンロードできる）。
+    """
+
+    def __init__(
+        self,
+        app: Any,
+        profiles: ProfileStore,
+        interval: float = 0.005,
+        sample_rate: float = 0.0,
+        sampled_interval: float = 0.02,
+        token: Optional[str] = None,
+    ) -> None:
+        self.app = app
+        self.profiles = profiles
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.sampled_interval = sampled_interval
+        self.token = token
+
+    def requested(self, scope: dict[str, Any]) -> bool:
+        value = None
+        for name, header in scope.get("headers", []):
+            if name == b"x-profile":
+                value = header.decode()
+        if value is None:
+            query = parse_qs(scope.get("query_string", b"").decode())
+            value = query.get("profile", [None])[0]
+        return self.token is not None and value == self.token
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or scope["path"].startswith("/profiles"):
+            await self.app(scope, receive, send)
+            return
+        if self.requested(scope):
+            mode, interval = "request", self.interval
+        elif self.sample_rate and random.random() < self.sample_rate:
+            mode, interval = "sampled", self.sampled_interval
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(
+            id=uuid.uuid4().hex,
+            method=scope["method"],
+            path=scope["path"],
+            mode=mode,
+            interval=interval,
+            started_at=time.time(),
+        )
+
+        async def send_with_id(message: dict[str, Any]) -> None:
+            # ストリーミングのレスポンスは別のタスクから送られるので、そのタスクも記録する
+            tag_task(profile.id)
+            if message["type"] == "http.response.start":
+                headers = [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]
+                message = {**message, "headers": headers}
+            await send(message)
+
+        sampler = StackSampler(profile)
+        token = _profile_id.set(profile.id)
+        sampler.start()
+        try:
+            # ワーカースレッドは contextvar を引き継いだ profiled_thread() が記録する
+            with profiled_task(profile.id):
+                await self.app(scope, receive, send_with_id)
+        finally:
+            _profile_id.reset(token)
+            self.profiles.put(sampler.stop())
+            logger.info(
+                "Profiled %s %s in %.2fs (%s, id=%s)",
+                profile.method,
+                profile.path,
+                profile.duration,
+                profile.mode,
+                profile.id,
+            )
+
+
+def profiling_settings_from_env() -> dict[str, Any]:
+    """PROFILE_INTERVAL / PROFILE_SAMPLE_RATE / PROFILE_SAMPLED_INTERVAL / PROFILE_TOKEN"""
+    return {
+        "interval": float(os.getenv("PROFILE_INTERVAL", "0.005")),
+        "sample_rate": float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+        "sampled_interval": float(os.getenv("PROFILE_SAMPLED_INTERVAL", "0.02")),
+        "token": os.getenv("PROFILE_TOKEN") or None,
+    }
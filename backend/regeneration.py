@@ -0,0 +1,155 @@
+"""レポートの差分再生成
+
+同じトピック・要点のレポートを生成し直すとき、前回の生成に使った検索結果（doc_id）を覚えておき、
+出典の記事が変わっていない要点はそのまま残して、出典が変わった要点だけを LLM に生成し直させる。
+クライアントには前回の ReportContent に対する JSON Patch（RFC 6902）を返す。
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Optional
+
+from hedging import ResponseCache
+
+if TYPE_CHECKING:
+    from agent import ReporterPoint
+    from storage import SQLiteStore
+
+
+def context_sources(context: list) -> dict[str, str]:
+    """検索結果の URL → doc_id（DedupRetriever が付けたもの）"""
+    sources = {}
+    for doc in context:
+        metadata = getattr(doc, "metadata", None) or {}
+        if metadata.get("source") and metadata.get("doc_id"):
+            sources[metadata["source"]] = metadata["doc_id"]
+    return sources
+
+
+def stale_points(
+    points: list["ReporterPoint"], previous: dict[str, str], current: dict[str, str]
+) -> list[int]:
+    """出典の記事が今回の検索結果にない、または本文が変わった要点の位置"""
+    stale = []
+    for i, point in enumerate(points):
+        url = point.source.url if point.source else None
+        if url is None or url not in previous or current.get(url) != previous[url]:
+            stale.append(i)
+    return stale
+
+
+def render_points(points: list["ReporterPoint"]) -> str:
+    """要点を GENERATE_REPORT_TEMPLATE と同じマークダウン形式に戻す"""
+    lines = []
+    for i, point in enumerate(points, 1):
+        lines.append(f"{i}. **{point.title}**")
+        lines.append(point.content)
+        if point.source is not None:
+            lines.append(f"[出典: {point.source.name}]({point.source.url})")
+    return "\n".join(lines)
+
+
+def _pointer(path: str, key: Any) -> str:
+    return f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
+
+
+def json_patch(old: Any, new: Any, path: str = "") -> list[dict[str, Any]]:
+    """old を new にする JSON Patch の操作（リストは位置ごとに比較する）"""
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": _pointer(path, key)})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "add", "path": _pointer(path, key), "value": value})
+            else:
+                ops.extend(json_patch(old[key], value, _pointer(path, key)))
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        ops = []
+        for i in range(min(len(old), len(new))):
+            ops.extend(json_patch(old[i], new[i], _pointer(path, i)))
+        for i in range(len(old), len(new)):
+            ops.append({"op": "add", "path": _pointer(path, i), "value": new[i]})
+        # 後ろから消すと、残りの要素の位置が変わらない
+        for i in reversed(range(len(new), len(old))):
+            ops.append({"op": "remove", "path": _pointer(path, i)})
+        return ops
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def apply_patch(doc: Any, ops: list[dict[str, Any]]) -> Any:
+    """json_patch が返す add / remove / replace を適用する（クライアントの実装の参考用）"""
+    doc = json.loads(json.dumps(doc))
+    for op in ops:
+        keys = [k.replace("~1", "/").replace("~0", "~") for k in op["path"].split("/")[1:]]
+        if not keys:
+            doc = op.get("value")
+            continue
+        parent = doc
+        for key in keys[:-1]:
+            parent = parent[int(key)] if isinstance(parent, list) else parent[key]
+        last: Any = int(keys[-1]) if isinstance(parent, list) else keys[-1]
+        if op["op"] == "remove":
+            del parent[last]
+        elif op["op"] == "add" and isinstance(parent, list):
+            parent.insert(last, op["value"])
+        else:
+            parent[last] = op["value"]
+    return doc
+
+
+class GenerationLog:
+    """ノードと入力ごとに、最後に生成したテキストとその検索結果の doc_id を保持する
+
+    store を渡すと、別のワーカーが生成したレポートも差分再生成の起点にできる。
+    """
+
+    namespace = "generations"
+
+    def __init__(self, store: Optional["SQLiteStore"] = None, max_entries: int = 512) -> None:
+        self.store = store
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "refreshes": 0,
+            "unchanged": 0,
+            "points_reused": 0,
+            "points_regenerated": 0,
+            "full_regenerations": 0,
+        }
+
+    def record(self, node: str, key: Any, text: str, context: list) -> None:
+        cache_key = ResponseCache.make_key(node, key)
+        entry = {"text": text, "sources": context_sources(context)}
+        with self._lock:
+            self._entries[cache_key] = entry
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self.store is not None:
+            self.store.put_json(self.namespace, cache_key, entry)
+
+    def previous(self, node: str, key: Any) -> Optional[dict[str, Any]]:
+        cache_key = ResponseCache.make_key(node, key)
+        # 別のワーカーがより新しい版を生成しているかもしれないので、store があれば先に読む
+        if self.store is not None:
+            entry = self.store.get_json(self.namespace, cache_key)
+            if entry is not None:
+                return entry
+        with self._lock:
+            return self._entries.get(cache_key)
+
+    def count(self, **counts: int) -> None:
+        with self._lock:
+            for name, n in counts.items():
+                self._counters[name] += n
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            return {**self._counters, "entries": len(self._entries)}
@@ -0,0 +1,87 @@
+"""検索結果をフィクスチャに記録・再生するリトリーバー
+
+record モードでは実際のリトリーバーの結果をクエリごとに JSON ファイルへ保存し、
+replay モードではネットワークに出ずにそのファイルから同じ結果を返す。
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Literal, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+
+class FixtureNotFoundError(LookupError):
+    """replay モードで、記録されていないクエリが来た"""
+
+    def __init__(self, path: str, query: str) -> None:
+        super().__init__(f"No recorded results for {query!r} in {path}")
+        self.path = path
+        self.query = query
+
+
+_file_locks: dict[str, threading.Lock] = {}
+_file_locks_guard = threading.Lock()
+
+
+def _file_lock(path: str) -> threading.Lock:
+    # 同じファイルを使う複数のリトリーバー（news と prefetch など）で書き込みを直列化する
+    with _file_locks_guard:
+        return _file_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def load_fixtures(path: str) -> dict[str, list[dict[str, Any]]]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class RecordReplayRetriever(BaseRetriever):
+    """mode="record" は retriever の結果を path に追記し、"replay" は path から返す
+
+    "auto" は記録済みのクエリを再生し、未記録のものだけ retriever で検索して記録する。
+    latency を指定すると再生時にその秒数だけ待つ（本番に近い待ち時間での負荷試験用）。
+    """
+
+    path: str
+    retriever: Optional[BaseRetriever] = None
+    mode: Literal["record", "replay", "auto"] = "replay"
+    latency: float = 0.0
+    fixtures: dict[str, list[dict[str, Any]]] = {}
+
+    def model_post_init(self, __context: Any) -> None:
+        if self.mode != "replay" and self.retriever is None:
+            raise ValueError(f"mode={self.mode!r} requires a retriever to record from")
+        self.fixtures = load_fixtures(self.path)
+
+    def _record(self, query: str, docs: list[Document]) -> None:
+        entry = [{"page_content": d.page_content, "metadata": d.metadata} for d in docs]
+        with _file_lock(self.path):
+            # 他のリトリーバーが同じファイルに追記した分を取り込んでから書き出す
+            fixtures = load_fixtures(self.path)
+            fixtures[query] = entry
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(fixtures, f, ensure_ascii=False, indent=1, default=str)
+            os.replace(tmp, self.path)
+            self.fixtures = fixtures
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        recorded = self.fixtures.get(query)
+        if recorded is not None and self.mode != "record":
+            if self.latency:
+                time.sleep(self.latency)
+            return [Document(**d) for d in recorded]
+        if self.mode == "replay":
+            raise FixtureNotFoundError(self.path, query)
+        docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        self._record(query, docs)
+        return docs
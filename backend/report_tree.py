@@ -0,0 +1,601 @@
+"""レポートの階層構造をフラットに保持するストア
+
+ReportContent → ReporterPoint.detailed_report → ReportContent … という入れ子構造を
+ノードID → ノードの辞書と親子リンクで保持する。ノードIDはレポートなら report_id、
+ポイントなら "{report_id}/{point_id}" とする。
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional, Protocol
+
+if TYPE_CHECKING:
+    from agent import ReportContent, ReporterPoint
+
+
+class TreeLimitError(ValueError):
+    """深さ・ノード数の上限を超えた"""
+
+
+def point_node_id(report_id: str, point_id: str) -> str:
+    return sys.intern(f"{report_id}/{point_id}")
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value is not None else None
+
+
+# ID や出典などセッションをまたいで繰り返し現れる短い文字列は intern して1つのオブジェクトを共有する
+# （本文はセッションごとに異なるので intern しない）
+
+
+@dataclass(slots=True)
+class ReportNode:
+    id: str
+    topic: str
+    thread_id: Optional[str]
+    depth: int
+    parent_id: Optional[str] = None  # 親ポイントのノードID
+    point_ids: list[str] = field(default_factory=list)  # 子ポイントのノードID
+    root_id: Optional[str] = None  # ルートのレポートID（None ならこのレポートがルート）
+
+    def __post_init__(self) -> None:
+        self.id = sys.intern(self.id)
+        self.thread_id = _intern(self.thread_id)
+        self.parent_id = _intern(self.parent_id)
+        self.root_id = _intern(self.root_id)
+        self.point_ids = [sys.intern(pid) for pid in self.point_ids]
+
+
+@dataclass(slots=True)
+class PointNode:
+    id: str
+    point_id: str
+    report_id: str
+    title: str
+    content: str
+    source_name: Optional[str]
+    source_url: Optional[str]
+    detailed_report_id: Optional[str] = None
+
+    def __post_init__(self) -> None:
+        self.id = sys.intern(self.id)
+        self.point_id = sys.intern(self.point_id)
+        self.report_id = sys.intern(self.report_id)
+        self.source_name = _intern(self.source_name)
+        self.source_url = _intern(self.source_url)
+        self.detailed_report_id = _intern(self.detailed_report_id)
+
+
+# 遅延読み込みの単位: レポートノードと直下のポイントノード。詳細レポートは ID で参照する
+LoadedReport = tuple[ReportNode, list[PointNode]]
+
+
+class ReportTreeBackend(Protocol):
+    """メモリ上にないノードの読み込みと、追加・更新したノードの保存先"""
+
+    def load(self, report_id: str) -> Optional[LoadedReport]: ...
+
+    def save(self, node: ReportNode, points: list[PointNode]) -> None: ...
+
+    def claim(self, report_id: str) -> bool: ...
+
+    def link(self, report_id: str, point_node_id: str, detailed_report_id: str) -> None:
+        """保存済みのポイントに詳細レポートを結び付ける（他のワーカーの更新を上書きしない）"""
+        ...
+
+    def reserve(self, root_id: str, count: int, limit: int) -> bool:
+        """ルートの木に count 個のノードを追加してよいか確認し、よければ数を加える"""
+        ...
+
+
+class ReportTree:
+    """レポートの木（ルートのレポートから詳細レポートをたどる）をまとめて保持する
+
+    - max_depth / max_tree_nodes: 1つのルートの木の深さとノード数の上限
+    - max_nodes: メモリ上に保持するノード数。超えたら最近使っていないレポートから外す
+      （backend があれば必要になったときに読み込み直す。なければルートの木ごと破棄する）
+    """
+
+    def __init__(
+        self,
+        max_depth: int = 8,
+        max_nodes: int = 100_000,
+        backend: Optional[ReportTreeBackend] = None,
+        max_tree_nodes: int = 10_000,
+    ) -> None:
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_tree_nodes = max_tree_nodes
+        # メモリ上にないレポートノード（とその直下のポイント）はここから遅延読み込みする
+        self.backend = backend
+        # 最近使った順（末尾が最新）
+        self._reports: OrderedDict[str, ReportNode] = OrderedDict()
+        self._points: dict[str, PointNode] = {}
+        # メモリ上のルートごとのレポートID（最近使った順）と、backend がない場合のノード数
+        self._trees: OrderedDict[str, set[str]] = OrderedDict()
+        self._tree_sizes: dict[str, int] = {}
+        self._lock = threading.RLock()
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._reports)
+
+    def __contains__(self, report_id: object) -> bool:
+        if not isinstance(report_id, str):
+            return False
+        with self._lock:
+            found = self._get_report_node(report_id) is not None
+            self._evict()
+            return found
+
+    def __getitem__(self, report_id: str) -> "ReportContent":
+        return self.get_report(report_id)
+
+    def keys(self) -> Iterator[str]:
+        return iter(list(self._reports))
+
+    @property
+    def node_count(self) -> int:
+        return len(self._reports) + len(self._points)
+
+    def _cache(self, node: ReportNode, points: list[PointNode]) -> None:
+        self._reports[node.id] = node
+        self._trees.setdefault(node.root_id or node.id, set()).add(node.id)
+        for pnode in points:
+            self._points[pnode.id] = pnode
+
+    def _touch(self, node: ReportNode) -> None:
+        self._reports.move_to_end(node.id)
+        root_id = node.root_id or node.id
+        if root_id in self._trees:
+            self._trees.move_to_end(root_id)
+
+    def _get_report_node(self, report_id: str, fresh: bool = False) -> Optional[ReportNode]:
+        """fresh=True なら、他のワーカーが結び付けた詳細レポートを backend から読み直す"""
+        with self._lock:
+            node = self._reports.get(report_id)
+            if self.backend is not None and (node is None or fresh):
+                loaded = self.backend.load(report_id)
+                if loaded is not None:
+                    node, points = loaded
+                    old = self._reports.get(report_id)
+                    if old is not None:
+                        # 参照中の呼び出し元とずれないよう、手元のノードのリンクだけ更新する
+                        for pnode in points:
+                            cached = self._points.get(pnode.id)
+                            if cached is not None and pnode.detailed_report_id is not None:
+                                cached.detailed_report_id = pnode.detailed_report_id
+                        node = old
+                    else:
+                        self._cache(node, points)
+            if node is not None:
+                self._touch(node)
+            return node
+
+    def unique_report_id(self, report_id: str) -> str:
+        """同じ秒に生成されたレポートIDが衝突しないように連番を付ける
+
+        バックエンドがある場合は他のプロセスと重複しないように ID を確保する。
+        """
+        candidate, n = report_id, 1
+        while candidate in self or (self.backend is not None and not self.backend.claim(candidate)):
+            n += 1
+            candidate = f"{report_id}_{n}"
+        return candidate
+
+    def _count_nodes(self, report: "ReportContent") -> int:
+        return 1 + sum(
+            1 + (self._count_nodes(p.detailed_report) if p.detailed_report else 0)
+            for p in report.points
+        )
+
+    def _subtree_depth(self, report: "ReportContent") -> int:
+        return max(
+            (
+                1 + self._subtree_depth(p.detailed_report)
+                for p in report.points
+                if p.detailed_report
+            ),
+            default=0,
+        )
+
+    def _reserve(self, root_id: str, count: int) -> bool:
+        if self.backend is not None:
+            return self.backend.reserve(root_id, count, self.max_tree_nodes)
+        size = self._tree_sizes.get(root_id, 0)
+        if size + count > self.max_tree_nodes:
+            return False
+        self._tree_sizes[root_id] = size + count
+        return True
+
+    def add_report(
+        self,
+        report: "ReportContent",
+        parent_report_id: Optional[str] = None,
+        parent_point_id: Optional[str] = None,
+    ) -> ReportNode:
+        """レポートとその入れ子のレポートをすべてフラットに登録する
+
+        上限を超える場合は何も登録せずに TreeLimitError を送出する。
+        """
+        with self._lock:
+            parent: Optional[PointNode] = None
+            depth = 0
+            root_id = report.id
+            if parent_report_id is not None and parent_point_id is not None:
+                parent_report = self._get_report_node(parent_report_id)
+                parent = self._points.get(point_node_id(parent_report_id, parent_point_id))
+                if parent_report is None or parent is None:
+                    raise ValueError(
+                        f"Point with ID {parent_point_id} not found in report {parent_report_id}"
+                    )
+                depth = parent_report.depth + 1
+                root_id = parent_report.root_id or parent_report.id
+
+            # 状態を変える前に木全体で上限を確認する（途中で失敗して半端な木を残さない）
+            if depth + self._subtree_depth(report) > self.max_depth:
+                raise TreeLimitError(f"Report tree is limited to depth {self.max_depth}")
+            if not self._reserve(root_id, self._count_nodes(report)):
+                raise TreeLimitError(
+                    f"Report tree {root_id} is limited to {self.max_tree_nodes} nodes"
+                )
+
+            node = self._add(report, depth, parent, root_id)
+            added = [r.id for r in self._walk(report)]
+            if self.backend is not None:
+                for report_id in added:
+                    saved = self._reports[report_id]
+                    self.backend.save(saved, [self._points[pid] for pid in saved.point_ids])
+                if parent is not None:
+                    # 手元の親レポートは古いかもしれないので、保存済みの親を読み直して結び付ける
+                    self.backend.link(parent.report_id, parent.id, node.id)
+            self._evict(keep=frozenset(added + ([parent.report_id] if parent else [])))
+            return node
+
+    def _walk(self, report: "ReportContent") -> Iterator["ReportContent"]:
+        yield report
+        for point in report.points:
+            if point.detailed_report is not None:
+                yield from self._walk(point.detailed_report)
+
+    def _add(
+        self, report: "ReportContent", depth: int, parent: Optional[PointNode], root_id: str
+    ) -> ReportNode:
+        old = self._reports.get(report.id)
+        if old is not None:
+            # 同じIDで登録し直す場合は古いポイントを外す
+            for pid in old.point_ids:
+                self._points.pop(pid, None)
+
+        node = ReportNode(
+            id=report.id,
+            topic=report.topic,
+            thread_id=report.thread_id,
+            depth=depth,
+            parent_id=parent.id if parent else None,
+            root_id=root_id,
+        )
+        self._cache(node, [])
+        self._touch(node)
+        if parent is not None:
+            parent.detailed_report_id = node.id
+
+        for point in report.points:
+            pnode = PointNode(
+                id=point_node_id(report.id, point.id),
+                point_id=point.id,
+                report_id=report.id,
+                title=point.title,
+                content=point.content,
+                source_name=point.source.name if point.source else None,
+                source_url=point.source.url if point.source else None,
+            )
+            self._points[pnode.id] = pnode
+            node.point_ids.append(pnode.id)
+            if point.detailed_report is not None:
+                self._add(point.detailed_report, depth + 1, pnode, root_id)
+        return node
+
+    def _drop(self, report_id: str) -> None:
+        node = self._reports.pop(report_id)
+        for pid in node.point_ids:
+            self._points.pop(pid, None)
+        root_id = node.root_id or node.id
+        tree = self._trees.get(root_id)
+        if tree is not None:
+            tree.discard(report_id)
+            if not tree:
+                del self._trees[root_id]
+        self.evicted += 1
+
+    def _root(self, report_id: str) -> str:
+        return self._reports[report_id].root_id or report_id
+
+    def _evict(self, keep: frozenset[str] = frozenset()) -> None:
+        """ノード数が max_nodes を超えていれば、最近使っていないレポートから外す
+
+        参照中のノードを外さないよう、公開メソッドの最後に呼ぶ。
+        """
+        if self.node_count <= self.max_nodes:
+            return
+        if self.backend is not None:
+            # backend から読み込み直せるのでレポート単位で外す
+            for report_id in list(self._reports):
+                if self.node_count <= self.max_nodes:
+                    return
+                if report_id not in keep:
+                    self._drop(report_id)
+            return
+        # 読み込み直せないので、最近使っていないルートの木ごと（セッションのレポートごと）破棄する
+        keep_roots = {self._root(rid) for rid in keep if rid in self._reports}
+        for root_id in list(self._trees):
+            if self.node_count <= self.max_nodes:
+                return
+            if root_id not in keep_roots:
+                for report_id in list(self._trees[root_id]):
+                    self._drop(report_id)
+                self._tree_sizes.pop(root_id, None)
+
+    def get_point(self, report_id: str, point_id: str) -> Optional["ReporterPoint"]:
+        """ポイントを O(1) で取得する（詳細レポートは展開しない）"""
+        with self._lock:
+            if self._get_report_node(report_id) is None:
+                return None
+            pnode = self._points.get(point_node_id(report_id, point_id))
+            point = self._to_point(pnode, 0) if pnode else None
+            self._evict()
+            return point
+
+    def detailed_report_id(self, report_id: str, point_id: str) -> Optional[str]:
+        """ポイントの詳細レポートの ID（まだなければ None）。他のワーカーが作ったものも含む"""
+        with self._lock:
+            if self._get_report_node(report_id, fresh=True) is None:
+                return None
+            pnode = self._points.get(point_node_id(report_id, point_id))
+            detailed_report_id = pnode.detailed_report_id if pnode else None
+            self._evict()
+            return detailed_report_id
+
+    def get_report(self, report_id: str, depth: Optional[int] = 0) -> "ReportContent":
+        """depth 段までの詳細レポートを展開した ReportContent を返す（None なら全て）"""
+        with self._lock:
+            node = self._get_report_node(report_id, fresh=depth != 0)
+            if node is None:
+                raise KeyError(report_id)
+            report = self._to_report(node, depth)
+            self._evict()
+            return report
+
+    def path_view(self, report_id: str) -> "ReportContent":
+        """ルートから report_id までの経路上の詳細レポートだけを展開した木を返す
+
+        API で返すのは表示中の経路だけで十分なので、兄弟ポイントの詳細レポートは含めない。
+        """
+        with self._lock:
+            node = self._get_report_node(report_id)
+            if node is None:
+                raise KeyError(report_id)
+            path = [node]
+            while path[-1].parent_id is not None:
+                # 親レポートがまだ読み込まれていなければここで読み込む
+                parent_report_id = path[-1].parent_id.rsplit("/", 1)[0]
+                parent = self._get_report_node(parent_report_id)
+                if parent is None:
+                    raise KeyError(parent_report_id)
+                path.append(parent)
+
+            view = self._to_report(path[-1], 0)
+            current = view
+            for child in reversed(path[:-1]):
+                point_id = self._points[child.parent_id].point_id
+                point = next(p for p in current.points if p.id == point_id)
+                point.detailed_report = self._to_report(child, 0)
+                current = point.detailed_report
+            self._evict()
+            return view
+
+    def _to_point(self, pnode: PointNode, depth: Optional[int]) -> "ReporterPoint":
+        from agent import ReporterPoint, Source
+
+        detailed = None
+        if pnode.detailed_report_id is not None and (depth is None or depth > 0):
+            child = self._get_report_node(pnode.detailed_report_id, fresh=True)
+            if child is not None:
+                detailed = self._to_report(child, None if depth is None else depth - 1)
+        source = None
+        if pnode.source_name is not None and pnode.source_url is not None:
+            source = Source(name=pnode.source_name, url=pnode.source_url)
+        return ReporterPoint.model_construct(
+            id=pnode.point_id,
+            title=pnode.title,
+            content=pnode.content,
+            source=source,
+            report_id=pnode.report_id,
+            detailed_report=detailed,
+        )
+
+    def _to_report(self, node: ReportNode, depth: Optional[int]) -> "ReportContent":
+        from agent import ReportContent
+
+        return ReportContent.model_construct(
+            id=node.id,
+            topic=node.topic,
+            thread_id=node.thread_id,
+            points=[self._to_point(self._points[pid], depth) for pid in node.point_ids],
+        )
+
+
+if __name__ == "__main__":
+    import time
+    from typing import Any
+
+    from agent import ReportContent, ReporterPoint, Source
+
+    def make_report(report_id: str, n_points: int, depth: int, width: int = 1) -> ReportContent:
+        points = []
+        for i in range(n_points):
+            detailed = None
+            if depth > 0 and i < width:
+                detailed = make_report(f"{report_id}.{i + 1}", n_points, depth - 1, width)
+            points.append(
+                ReporterPoint(
+                    id=str(i + 1),
+                    title=f"要点 {report_id}-{i + 1}",
+                    content="本文" * 200,
+                    source=Source(name="example", url=f"https://example.com/{report_id}/{i}"),
+                    report_id=report_id,
+                    detailed_report=detailed,
+                )
+            )
+        return ReportContent(id=report_id, topic=f"topic {report_id}", points=points)
+
+    def find_nested(report: ReportContent, report_id: str) -> ReportContent | None:
+        # 従来の入れ子構造での線形探索
+        if report.id == report_id:
+            return report
+        for point in report.points:
+            if point.detailed_report:
+                found = find_nested(point.detailed_report, report_id)
+                if found:
+                    return found
+        return None
+
+    def bench(name: str, root: ReportContent, leaf_id: str, repeat: int = 1000) -> None:
+        tree = ReportTree(max_depth=100, max_nodes=1_000_000)
+        start = time.perf_counter()
+        tree.add_report(root)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            next(p for p in find_nested(root, leaf_id).points if p.id == "3")
+        nested = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            tree.get_point(leaf_id, "3")
+        flat = (time.perf_counter() - start) / repeat
+
+        full_bytes = len(root.model_dump_json().encode())
+        path_bytes = len(tree.path_view(leaf_id).model_dump_json().encode())
+        print(f"{name}: {tree.node_count} nodes, build {build * 1e3:.1f}ms")
+        print(f"  point lookup: nested {nested * 1e6:.1f}us, flat {flat * 1e6:.1f}us")
+        print(f"  serialized: full tree {full_bytes} bytes, visible path {path_bytes} bytes")
+
+    # 深い木: 各段で1つ目のポイントだけを掘り下げる
+    bench("deep (depth 50)", make_report("r", 3, 50), "r" + ".1" * 50)
+    # 広い木: 各段で3つのポイントすべてを掘り下げる
+    bench("wide (3^6)", make_report("r", 3, 6, width=3), "r" + ".3" * 6)
+
+    # 1セッション（レポート + 詳細レポート + 要点の選択2つ）あたりのメモリ
+    import gc
+    import json
+    import tracemalloc
+
+    from langchain_core.language_models import FakeListChatModel
+
+    from agent import PointSelection, ReporterAgent
+    from graph import State
+
+    n_sessions = 200
+    # 同じ記事が多くのセッションで出典になる
+    sources = [
+        Source(name=f"news{i}", url=f"https://news.example.com/article/{i}") for i in range(20)
+    ]
+
+    def session_report(n: int) -> ReportContent:
+        points = []
+        for i in range(3):
+            detailed = ReportContent(
+                id=f"{n:08d}_d{i}",
+                topic=f"要点 {n}-{i}",
+                points=[
+                    ReporterPoint(
+                        id=str(j + 1),
+                        title=f"詳細 {n}-{i}-{j}",
+                        content=f"セッション{n}の詳細な説明{i}-{j}。" * 20,
+                        source=sources[(n + j) % len(sources)],
+                        report_id=f"{n:08d}_d{i}",
+                    )
+                    for j in range(3)
+                ],
+            )
+            points.append(
+                ReporterPoint(
+                    id=str(i + 1),
+                    title=f"要点 {n}-{i}",
+                    content=f"セッション{n}の要点{i}の説明。" * 20,
+                    source=sources[(n + i) % len(sources)],
+                    report_id=f"{n:08d}",
+                    detailed_report=detailed if i == 0 else None,
+                )
+            )
+        return ReportContent(id=f"{n:08d}", topic=f"トピック {n}", points=points)
+
+    def from_request(selection: PointSelection) -> PointSelection:
+        # リクエストの JSON から作られた選択は、木とは別の文字列オブジェクトを持つ
+        return PointSelection(**json.loads(selection.model_dump_json()))
+
+    def session_state(report: ReportContent, selection: PointSelection) -> State:
+        return State(
+            query=report.topic,
+            current_role="critic",
+            reporter_content="\n".join(p.content for p in report.points),
+            report_id=report.id,
+            point_selection_for_critic=selection,
+            user_selection_of_critic=selection,
+        )
+
+    def measure(build: Any) -> float:
+        gc.collect()
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+        del kept
+        return used / n_sessions
+
+    def before() -> list:
+        # 入れ子の ReportContent と、本文のコピーを持つ選択
+        sessions = []
+        for n in range(n_sessions):
+            report = session_report(n)
+            point = report.points[0]
+            selection = from_request(
+                PointSelection(
+                    report_id=report.id, point_id=point.id, title=point.title, content=point.content
+                )
+            )
+            sessions.append((report, session_state(report, selection)))
+        return sessions
+
+    def after() -> tuple:
+        # フラットな木（slots + intern）と、ID だけで要点を参照する選択
+        agent = ReporterAgent(FakeListChatModel(responses=[""]))
+        states = []
+        for n in range(n_sessions):
+            report = session_report(n)
+            agent.reports.add_report(report)
+            point = report.points[0]
+            selection = agent.compact_selection(
+                from_request(
+                    PointSelection(
+                        report_id=report.id,
+                        point_id=point.id,
+                        title=point.title,
+                        content=point.content,
+                    )
+                )
+            )
+            states.append(session_state(report, selection))
+        return agent.reports, states
+
+    print(f"memory per session ({n_sessions} sessions):")
+    print(f"  nested models + copied selections: {measure(before):10.0f} bytes")
+    print(f"  flat tree + id-only selections:    {measure(after):10.0f} bytes")
@@ -0,0 +1,257 @@
+"""ノードごとの Tavily の検索設定（search_depth / k / include_raw_content）の選択
+
+初回のレポート（generate_report）は幅広い話題を扱うので advanced で検索し、要点の詳細や
+Yes/No の事例のように対象が絞られた検索は basic で十分なことが多い。ノードごとに優先する設定と
+軽い設定を持ち、優先する設定の実測レイテンシがノードの予算を超えている場合や、Tavily の
+スケジューラーのキューが詰まっている場合は軽い設定で検索する。
+"""
+
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Literal, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RetrievalConfig:
+    search_depth: Literal["basic", "advanced"]
+    k: int
+    include_raw_content: bool
+
+    @property
+    def name(self) -> str:
+        return f"{self.search_depth}-k{self.k}" + ("-raw" if self.include_raw_content else "")
+
+    def kwargs(self) -> dict[str, Any]:
+        return {
+            "search_depth": self.search_depth,
+            "k": self.k,
+            "include_raw_content": self.include_raw_content,
+        }
+
+
+@dataclass(frozen=True)
+class NodePolicy:
+    preferred: RetrievalConfig
+    fallback: RetrievalConfig
+    latency_budget: float  # 秒
+
+
+DEFAULT_NODE_POLICIES = {
+    "generate_report": NodePolicy(
+        preferred=RetrievalConfig("advanced", 3, True),
+        fallback=RetrievalConfig("basic", 3, True),
+        latency_budget=6.0,
+    ),
+    "generate_detailed_report": NodePolicy(
+        preferred=RetrievalConfig("advanced", 3, True),
+        fallback=RetrievalConfig("basic", 3, True),
+        latency_budget=4.0,
+    ),
+    "check_cases": NodePolicy(
+        preferred=RetrievalConfig("basic", 3, True),
+        fallback=RetrievalConfig("basic", 2, False),
+        latency_budget=3.0,
+    ),
+}
+
+
+class ConfigStats:
+    """1つの (ノード, 設定) の実測レイテンシ（指数移動平均）と結果の質"""
+
+    def __init__(self, alpha: float) -> None:
+        self.alpha = alpha
+        self.calls = 0
+        self.errors = 0
+        self.latency_ewma: Optional[float] = None
+        self.latency_max = 0.0
+        self.results_total = 0
+        self.chars_total = 0
+        self.score_total = 0.0
+        self.scored = 0
+
+    def record(self, latency: float, docs: Optional[list[Document]]) -> None:
+        self.calls += 1
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += self.alpha * (latency - self.latency_ewma)
+        self.latency_max = max(self.latency_max, latency)
+        if docs is None:
+            self.errors += 1
+            return
+        self.results_total += len(docs)
+        for doc in docs:
+            self.chars_total += len(doc.page_content)
+            # Tavily はクエリとの関連度を score として返す
+            score = (doc.metadata or {}).get("score")
+            if isinstance(score, (int, float)):
+                self.score_total += score
+                self.scored += 1
+
+    def to_dict(self) -> dict[str, Any]:
+        succeeded = self.calls - self.errors
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "latency_seconds_ewma": self.latency_ewma,
+            "latency_seconds_max": self.latency_max,
+            "results_avg": self.results_total / succeeded if succeeded else 0.0,
+            "chars_avg": self.chars_total / self.results_total if self.results_total else 0.0,
+            "score_avg": self.score_total / self.scored if self.scored else None,
+        }
+
+
+class RetrievalPolicy:
+    """ノードごとに優先する設定と軽い設定のどちらで検索するかを決める
+
+    - adaptive=False なら常に優先する設定を使う
+    - provider のキューに queue_threshold 件以上待ちがあれば軽い設定を使う
+      （None ならそのプロバイダーの同時実行数）
+    - 優先する設定のレイテンシが予算を超えていれば軽い設定を使う。ただし probe_every 回に
+      1回は優先する設定で検索し、レイテンシが戻ったかを測り直す
+    """
+
+    def __init__(
+        self,
+        scheduler: Scheduler,
+        policies: Optional[dict[str, NodePolicy]] = None,
+        provider: str = "tavily",
+        adaptive: bool = True,
+        queue_threshold: Optional[int] = None,
+        probe_every: int = 10,
+        alpha: float = 0.2,
+    ) -> None:
+        self.scheduler = scheduler
+        self.policies = dict(DEFAULT_NODE_POLICIES if policies is None else policies)
+        self.provider = provider
+        self.adaptive = adaptive
+        self.queue_threshold = queue_threshold
+        self.probe_every = probe_every
+        self.alpha = alpha
+        self._stats: dict[tuple[str, RetrievalConfig], ConfigStats] = {}
+        self._skipped: dict[str, int] = {}
+        self._reasons: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def _loaded(self) -> bool:
+        metrics = self.scheduler.provider(self.provider).metrics()
+        threshold = self.queue_threshold or metrics["max_concurrency"]
+        return metrics["queue_depth"] >= threshold
+
+    def _count_reason(self, node: str, reason: str) -> None:
+        reasons = self._reasons.setdefault(node, {})
+        reasons[reason] = reasons.get(reason, 0) + 1
+
+    def choose(self, node: str) -> RetrievalConfig:
+        policy = self.policies[node]
+        if not self.adaptive:
+            return policy.preferred
+        loaded = self._loaded()
+        with self._lock:
+            if loaded:
+                self._count_reason(node, "load")
+                return policy.fallback
+            stats = self._stats.get((node, policy.preferred))
+            if stats is None or stats.latency_ewma is None:
+                return policy.preferred
+            if stats.latency_ewma <= policy.latency_budget:
+                self._skipped[node] = 0
+                return policy.preferred
+            skipped = self._skipped.get(node, 0) + 1
+            if skipped >= self.probe_every:
+                self._skipped[node] = 0
+                self._count_reason(node, "probe")
+                return policy.preferred
+            self._skipped[node] = skipped
+            self._count_reason(node, "latency")
+            return policy.fallback
+
+    def record(
+        self,
+        node: str,
+        config: RetrievalConfig,
+        latency: float,
+        docs: Optional[list[Document]],
+    ) -> None:
+        """検索にかかった時間と結果（失敗した場合は None）を記録する"""
+        with self._lock:
+            stats = self._stats.get((node, config))
+            if stats is None:
+                stats = self._stats[(node, config)] = ConfigStats(self.alpha)
+            stats.record(latency, docs)
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            nodes: dict[str, Any] = {}
+            for (node, config), stats in self._stats.items():
+                nodes.setdefault(node, {"configs": {}})["configs"][config.name] = stats.to_dict()
+            for node, reasons in self._reasons.items():
+                nodes.setdefault(node, {"configs": {}})["decisions"] = dict(reasons)
+        return {"adaptive": self.adaptive, "nodes": nodes}
+
+
+class AdaptiveRetriever(BaseRetriever):
+    """policy が選んだ設定のリトリーバー（factory(**config.kwargs()) で作る）で検索する"""
+
+    node: str
+    policy: RetrievalPolicy
+    factory: Callable[..., BaseRetriever]
+    retrievers: dict[RetrievalConfig, BaseRetriever] = {}
+
+    def _retriever(self, config: RetrievalConfig) -> BaseRetriever:
+        retriever = self.retrievers.get(config)
+        if retriever is None:
+            retriever = self.retrievers.setdefault(config, self.factory(**config.kwargs()))
+        return retriever
+
+    def _search(
+        self, config: RetrievalConfig, query: str, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        started = time.monotonic()
+        try:
+            docs = self._retriever(config).invoke(
+                query, config={"callbacks": run_manager.get_child()}
+            )
+        except Exception:
+            self.policy.record(self.node, config, time.monotonic() - started, None)
+            raise
+        self.policy.record(self.node, config, time.monotonic() - started, docs)
+        return docs
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        config = self.policy.choose(self.node)
+        docs = self._search(config, query, run_manager)
+        preferred = self.policy.policies[self.node].preferred
+        if not docs and config != preferred:
+            # 軽い設定で何も見つからなければ、レポートの質を優先して検索し直す
+            logger.info(
+                "No results for %r with %s, retrying with %s", query, config.name, preferred.name
+            )
+            docs = self._search(preferred, query, run_manager)
+        return docs
+
+
+def retrieval_policy_from_env() -> dict[str, Any]:
+    """RETRIEVAL_ADAPTIVE / RETRIEVAL_QUEUE_THRESHOLD / RETRIEVAL_PROBE_EVERY
+
+    RETRIEVAL_ADAPTIVE=0 なら混雑していても常に優先する設定で検索する。
+    """
+    threshold = os.getenv("RETRIEVAL_QUEUE_THRESHOLD")
+    return {
+        "adaptive": os.getenv("RETRIEVAL_ADAPTIVE", "1") not in ("0", "false"),
+        "queue_threshold": int(threshold) if threshold else None,
+        "probe_every": int(os.getenv("RETRIEVAL_PROBE_EVERY", "10")),
+    }
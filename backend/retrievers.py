@@ -1,3 +1,5 @@
+import os
+
 from langchain_chroma import Chroma
 from langchain_community.retrievers import TavilySearchAPIRetriever
 from langchain_core.retrievers import BaseRetriever
@@ -5,33 +7,76 @@ from langchain_openai import OpenAIEmbeddings
 # from langchain_google_community import VertexAISearchRetriever
 # import os
 
+from replay import RecordReplayRetriever
+from tavily_standin import DEFAULT_STANDIN_URL, StandInTavilyRetriever
 from utils import extract_text_from_pdf, text_to_documents
 
 # # Define trusted news sources
 # NEWS_SEARCH_SOURCES = ["bbc.com", "cnn.com", "reuters.com", "theguardian.com", "aljazeera.com"]
 
 
-def create_news_retriever() -> TavilySearchAPIRetriever:
-    """Create a retriever specifically for news sources"""
-    return TavilySearchAPIRetriever(
-        k=3,
-        search_depth="advanced",
-        topic="news",
-        include_raw_content=True,
+def fixture_path(name: str, **kwargs) -> str:
+    """検索結果を記録するファイル。検索の深さ・件数・本文の有無ごとに分ける
+
+    RetrievalPolicy が設定を変えても、別の設定で記録した結果を再生しないようにする。
+    """
+    # 省略した場合は TavilySearchAPIRetriever の既定値
+    depth = getattr(kwargs.get("search_depth"), "value", kwargs.get("search_depth", "basic"))
+    raw = "_raw" if kwargs.get("include_raw_content") else ""
+    filename = f"{name}_{depth}_k{kwargs.get('k', 10)}{raw}.json"
+    return os.path.join(os.getenv("RETRIEVER_FIXTURES_DIR", "fixtures"), filename)
+
+
+def create_tavily_retriever(name: str, **kwargs) -> BaseRetriever:
+    """RETRIEVER_MODE に応じて Tavily のリトリーバーを作る
+
+    - live（既定）: Tavily API を呼び出す
+    - standin: TAVILY_STANDIN_URL のローカルのスタンドインサーバー（tavily_standin.py）を呼び出す
+    - record / replay / auto: RETRIEVER_FIXTURES_DIR のファイル（fixture_path）に記録・再生する
+    """
+    mode = os.getenv("RETRIEVER_MODE", "live")
+    if mode == "live":
+        return TavilySearchAPIRetriever(**kwargs)
+    if mode == "standin":
+        base_url = os.getenv("TAVILY_STANDIN_URL", DEFAULT_STANDIN_URL)
+        return StandInTavilyRetriever(base_url=base_url, **kwargs)
+    if mode in ("record", "replay", "auto"):
+        return RecordReplayRetriever(
+            path=fixture_path(name, **kwargs),
+            retriever=TavilySearchAPIRetriever(**kwargs) if mode != "replay" else None,
+            mode=mode,
+            latency=float(os.getenv("RETRIEVER_REPLAY_LATENCY", "0")),
+        )
+    raise ValueError(f"Unknown RETRIEVER_MODE: {mode}")
+
+
+def create_news_retriever(**overrides) -> BaseRetriever:
+    """Create a retriever specifically for news sources
+
+    overrides で search_depth / k / include_raw_content などの既定値を上書きできる。
+    """
+    return create_tavily_retriever(
+        "news",
+        **{
+            "k": 3,
+            "search_depth": "advanced",
+            "topic": "news",
+            "include_raw_content": True,
+            **overrides,
+        },
     )
 
 
-def create_general_retriever() -> TavilySearchAPIRetriever:
+def create_general_retriever(**overrides) -> BaseRetriever:
     """Create a general-purpose retriever without domain restrictions"""
-    return TavilySearchAPIRetriever(
-        k=3,
-        search_depth="advanced",
-        include_raw_content=True,
+    return create_tavily_retriever(
+        "general",
+        **{"k": 3, "search_depth": "advanced", "include_raw_content": True, **overrides},
     )
 
 
 # Deprecated: Use create_news_retriever() or create_general_retriever() instead
-def create_tavily_search_api_retriever() -> TavilySearchAPIRetriever:
+def create_tavily_search_api_retriever() -> BaseRetriever:
     return create_news_retriever()
 
 
@@ -0,0 +1,328 @@
+"""Vertex AI / Tavily への呼び出しを制御する共有スケジューラ
+
+プロバイダーごとに同時実行数とトークンバケットによるレート制限をかけ、
+待機中の呼び出しは優先度順（対話的な /explore などを事前生成より先）に処理する。
+429 / 5xx は指数バックオフで再試行し、キュー長と待ち時間をメトリクスとして公開する。
+"""
+
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class Priority(IntEnum):
+    """値が小さいほど先に処理される"""
+
+    INTERACTIVE = 0
+    BATCH = 10
+
+
+_current_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+    "scheduler_priority", default=Priority.INTERACTIVE
+)
+
+
+@contextmanager
+def priority(level: Priority) -> Iterator[None]:
+    """ブロック内で発行される呼び出しの優先度を設定する"""
+    token = _current_priority.set(level)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+# 呼び出し元がデッドラインで諦めた呼び出しに対して set されるイベント（hedging.py が設定する）
+_abandoned: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar(
+    "scheduler_abandoned", default=None
+)
+
+
+def abandon_with(event: threading.Event) -> None:
+    """現在のコンテキストの呼び出しを、event が set されたらキューから外すようにする"""
+    _abandoned.set(event)
+
+
+class CallAbandonedError(RuntimeError):
+    """呼び出し元が結果を待たなくなったので、スロットを確保せずに打ち切った"""
+
+    def __init__(self, provider: str) -> None:
+        super().__init__(f"{provider}: caller abandoned the call while it was queued")
+        self.provider = provider
+
+
+class QueueTimeoutError(TimeoutError):
+    """キューで待機できる時間を超えた"""
+
+    def __init__(self, provider: str, waited: float) -> None:
+        super().__init__(f"{provider}: waited {waited:.1f}s for an execution slot")
+        self.provider = provider
+        self.waited = waited
+
+
+class ProviderOverloadedError(RuntimeError):
+    """再試行してもプロバイダーが 429 / 5xx を返し続けた"""
+
+    def __init__(self, provider: str, status_code: int) -> None:
+        super().__init__(f"{provider}: gave up after repeated HTTP {status_code}")
+        self.provider = provider
+        self.status_code = status_code
+
+
+@dataclass
+class ProviderLimits:
+    max_concurrency: int = 4
+    rate_per_second: float = 2.0
+    burst: int = 4
+    max_retries: int = 4
+    backoff_base: float = 0.5
+    backoff_max: float = 20.0
+    queue_timeout: float = 60.0
+
+
+def get_status_code(exc: BaseException) -> Optional[int]:
+    """各種クライアントの例外から HTTP ステータスコードを取り出す"""
+    for attr in ("status_code", "code", "http_status"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int) and 100 <= value < 600:
+            return value
+    response = getattr(exc, "response", None)
+    value = getattr(response, "status_code", None)
+    if isinstance(value, int):
+        return value
+    # google.api_core の ResourceExhausted などは grpc のコードしか持たない場合がある
+    # tavily-python は 429 を UsageLimitExceededError として送出する
+    if type(exc).__name__ in (
+        "ResourceExhausted",
+        "TooManyRequests",
+        "RateLimitError",
+        "UsageLimitExceededError",
+    ):
+        return 429
+    if type(exc).__name__ in ("ServiceUnavailable", "InternalServerError"):
+        return 503
+    return None
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, burst: int) -> None:
+        self.rate = rate_per_second
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> float:
+        """トークンを1つ取得する。取得できなければ次に取得できるまでの秒数を返す"""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (1 - self.tokens) / self.rate
+
+
+class ProviderScheduler:
+    """1つのプロバイダーに対する同時実行数・レート・優先度付きキュー"""
+
+    def __init__(self, name: str, limits: ProviderLimits) -> None:
+        self.name = name
+        self.limits = limits
+        self._bucket = TokenBucket(limits.rate_per_second, limits.burst)
+        self._cond = threading.Condition()
+        self._waiting: list[tuple[int, int]] = []
+        self._seq = itertools.count()
+        self._running = 0
+        # メトリクス
+        self._admitted = 0
+        self._timeouts = 0
+        self._abandoned = 0
+        self._retries = 0
+        self._failures = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _acquire(self, level: Priority) -> float:
+        entry = (int(level), next(self._seq))
+        started = time.monotonic()
+        deadline = started + self.limits.queue_timeout
+        abandoned = _abandoned.get()
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    if abandoned is not None and abandoned.is_set():
+                        # 結果を使わない呼び出しにスロットを渡さない
+                        self._abandoned += 1
+                        raise CallAbandonedError(self.name)
+                    wait = None
+                    if self._waiting[0] == entry and self._running < self.limits.max_concurrency:
+                        wait = self._bucket.try_acquire()
+                        if wait == 0:
+                            break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise QueueTimeoutError(self.name, time.monotonic() - started)
+                    timeout = min(remaining, wait) if wait else remaining
+                    if abandoned is not None:
+                        # set されたことに気づけるよう、定期的に起きて確認する
+                        timeout = min(timeout, 0.5)
+                    self._cond.wait(timeout)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                # 先頭が入れ替わったので他の待機者を起こす
+                self._cond.notify_all()
+            self._running += 1
+            waited = time.monotonic() - started
+            self._admitted += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return waited
+
+    def _release(self) -> None:
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.limits.backoff_max, self.limits.backoff_base * (2**attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """スロットを確保して fn を実行する。429 / 5xx の場合は待機し直して再試行する"""
+        level = _current_priority.get()
+        attempt = 0
+        while True:
+            self._acquire(level)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                status = get_status_code(e)
+                if status not in RETRYABLE_STATUS_CODES:
+                    raise
+                with self._cond:
+                    self._failures += 1
+                if attempt >= self.limits.max_retries:
+                    raise ProviderOverloadedError(self.name, status) from e
+                delay = self._backoff(attempt)
+                logger.warning(
+                    "%s returned HTTP %s, retrying in %.1fs (attempt %d)",
+                    self.name,
+                    status,
+                    delay,
+                    attempt + 1,
+                )
+                with self._cond:
+                    self._retries += 1
+            finally:
+                self._release()
+            time.sleep(delay)
+            attempt += 1
+
+    def metrics(self) -> dict[str, Any]:
+        with self._cond:
+            return {
+                "queue_depth": len(self._waiting),
+                "running": self._running,
+                "max_concurrency": self.limits.max_concurrency,
+                "admitted": self._admitted,
+                "queue_timeouts": self._timeouts,
+                "abandoned": self._abandoned,
+                "retries": self._retries,
+                "retryable_failures": self._failures,
+                "wait_seconds_avg": self._wait_total / self._admitted if self._admitted else 0.0,
+                "wait_seconds_max": self._wait_max,
+            }
+
+
+class Scheduler:
+    """プロバイダー名ごとの ProviderScheduler をまとめたもの"""
+
+    def __init__(self, limits: Optional[dict[str, ProviderLimits]] = None) -> None:
+        self._providers: dict[str, ProviderScheduler] = {}
+        self._lock = threading.Lock()
+        for name, provider_limits in (limits or {}).items():
+            self._providers[name] = ProviderScheduler(name, provider_limits)
+
+    def provider(self, name: str) -> ProviderScheduler:
+        with self._lock:
+            if name not in self._providers:
+                self._providers[name] = ProviderScheduler(name, ProviderLimits())
+            return self._providers[name]
+
+    def run(self, provider: str, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        return self.provider(provider).run(fn, *args, **kwargs)
+
+    def metrics(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            providers = list(self._providers.values())
+        return {p.name: p.metrics() for p in providers}
+
+
+def _limits_from_env(prefix: str, default: ProviderLimits) -> ProviderLimits:
+    return ProviderLimits(
+        max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", default.max_concurrency)),
+        rate_per_second=float(os.getenv(f"{prefix}_RATE_PER_SECOND", default.rate_per_second)),
+        burst=int(os.getenv(f"{prefix}_BURST", default.burst)),
+        max_retries=int(os.getenv(f"{prefix}_MAX_RETRIES", default.max_retries)),
+        queue_timeout=float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", default.queue_timeout)),
+    )
+
+
+def _split_across_workers(limits: ProviderLimits, workers: int) -> ProviderLimits:
+    # 上限はサーバー全体の値として扱い、ワーカープロセスで等分する
+    return ProviderLimits(
+        max_concurrency=max(1, limits.max_concurrency // workers),
+        rate_per_second=limits.rate_per_second / workers,
+        burst=max(1, limits.burst // workers),
+        max_retries=limits.max_retries,
+        backoff_base=limits.backoff_base,
+        backoff_max=limits.backoff_max,
+        queue_timeout=limits.queue_timeout,
+    )
+
+
+def create_default_scheduler() -> Scheduler:
+    """環境変数（LLM_MAX_CONCURRENCY, TAVILY_RATE_PER_SECOND など）から設定を読み込む
+
+    WEB_CONCURRENCY（uvicorn / gunicorn のワーカー数）が設定されていれば、上限をワーカー数で割る。
+    """
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    limits = {
+        "llm": _limits_from_env(
+            "LLM", ProviderLimits(max_concurrency=8, rate_per_second=4.0, burst=8)
+        ),
+        "tavily": _limits_from_env(
+            "TAVILY", ProviderLimits(max_concurrency=4, rate_per_second=2.0, burst=4)
+        ),
+        # アップロードされた PDF の埋め込み（IngestionPipeline）
+        "embeddings": _limits_from_env(
+            "EMBEDDINGS", ProviderLimits(max_concurrency=2, rate_per_second=2.0, burst=2)
+        ),
+    }
+    return Scheduler(
+        {name: _split_across_workers(value, workers) for name, value in limits.items()}
+    )
@@ -0,0 +1,229 @@
+"""State / レポートのレスポンスを軽量にシリアライズする
+
+- JSON は orjson でエンコードする（FastAPI 既定の jsonable_encoder + json.dumps を経由しない）
+- Accept: application/msgpack のクライアントには msgpack で返す
+- 大きなレスポンスは Accept-Encoding に応じて brotli / gzip で圧縮する
+- リクエストの State のうちサーバーが生成したフィールドは再検証しない
+"""
+
+import gzip
+import json
+from typing import Any, Optional
+
+from fastapi import HTTPException, Request, Response
+from pydantic import BaseModel
+
+from agent import CriticContent, CriticPoint
+from graph import State
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson は langserve[all] 経由で入る
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# これより小さいレスポンスは圧縮しても効果が薄い
+COMPRESS_MIN_BYTES = 1024
+
+# サーバーが生成してクライアントがそのまま送り返すフィールド（検証を省略する）
+TRUSTED_STATE_FIELDS = ("reporter_content", "explored_content", "current_role", "report_id")
+
+
+def to_builtins(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(warnings=False)
+    return obj
+
+
+def dumps_json(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(to_builtins(obj))
+    return json.dumps(to_builtins(obj), ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def loads_json(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def wants_msgpack(accept: str) -> bool:
+    return msgpack is not None and MSGPACK_MEDIA_TYPE in accept
+
+
+def encode(obj: Any, accept: str = "") -> tuple[bytes, str]:
+    """Accept ヘッダーに応じてエンコードし、(本文, media_type) を返す"""
+    if wants_msgpack(accept):
+        return msgpack.packb(to_builtins(obj), use_bin_type=True), MSGPACK_MEDIA_TYPE
+    return dumps_json(obj), JSON_MEDIA_TYPE
+
+
+def compress(body: bytes, accept_encoding: str) -> tuple[bytes, Optional[str]]:
+    """Accept-Encoding に応じて圧縮し、(本文, Content-Encoding) を返す"""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    encodings = {e.split(";")[0].strip() for e in accept_encoding.split(",")}
+    if brotli is not None and "br" in encodings:
+        return brotli.compress(body, quality=4), "br"
+    if "gzip" in encodings:
+        return gzip.compress(body, compresslevel=5), "gzip"
+    return body, None
+
+
+def serialize(request: Request, obj: Any, status_code: int = 200) -> Response:
+    """レスポンスモデルの再検証をせずに、交渉した形式でレスポンスを作る"""
+    body, media_type = encode(obj, request.headers.get("accept", ""))
+    body, content_encoding = compress(body, request.headers.get("accept-encoding", ""))
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    return Response(body, status_code=status_code, media_type=media_type, headers=headers)
+
+
+async def read_body(request: Request) -> dict[str, Any]:
+    """Content-Type に応じて JSON / msgpack のリクエスト本文をデコードする"""
+    raw = await request.body()
+    content_type = request.headers.get("content-type", JSON_MEDIA_TYPE)
+    try:
+        if MSGPACK_MEDIA_TYPE in content_type:
+            if msgpack is None:
+                raise HTTPException(status_code=415, detail="msgpack is not supported")
+            data = msgpack.unpackb(raw, raw=False)
+        else:
+            data = loads_json(raw)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request body: {e}") from e
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Request body must be an object")
+    return data
+
+
+def build_state(data: dict[str, Any]) -> State:
+    """クライアントが選択するフィールドだけを検証して State を組み立てる
+
+    reporter_content などサーバーが生成した長い文字列と critic_content は、
+    型だけ確認してそのまま使う。data は変更される。
+    """
+    trusted = {}
+    for name in TRUSTED_STATE_FIELDS:
+        if name in data:
+            value = data.pop(name)
+            if value is not None and not isinstance(value, str):
+                raise HTTPException(status_code=422, detail=f"{name} must be a string")
+            trusted[name] = value
+    critic_content = data.pop("critic_content", None)
+    if critic_content is not None:
+        critic_content = build_critic_content(critic_content)
+
+    state = State.model_validate(data)
+    for name, value in trusted.items():
+        setattr(state, name, value)
+    if critic_content is not None:
+        state.critic_content = critic_content
+    return state
+
+
+def build_critic_content(value: Any) -> CriticContent:
+    """critic_content を、各論点の title / content の型だけ確認して組み立てる"""
+    if not isinstance(value, dict):
+        raise HTTPException(status_code=422, detail="critic_content must be an object")
+    points = value.get("critic_points", [])
+    if not isinstance(points, list):
+        raise HTTPException(status_code=422, detail="critic_content.critic_points must be a list")
+    critic_points = []
+    for i, point in enumerate(points):
+        if not isinstance(point, dict):
+            raise HTTPException(
+                status_code=422, detail=f"critic_content.critic_points[{i}] must be an object"
+            )
+        for name in ("title", "content"):
+            if not isinstance(point.get(name), str):
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"critic_content.critic_points[{i}].{name} must be a string",
+                )
+        critic_points.append(
+            CriticPoint.model_construct(title=point["title"], content=point["content"])
+        )
+    return CriticContent.model_construct(critic_points=critic_points)
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    from fastapi.encoders import jsonable_encoder
+
+    from agent import PointSelection
+    from tavily_standin import _text
+
+    # 実際のセッションに近いサイズの State。同じ文の繰り返しだと圧縮率が実際より良く見えるので、
+    # スタンドインサーバーと同じ生成器でフィールドごとに異なる本文を作る
+    rng = random.Random(0)
+    points = [_text(rng, 1500) for _ in range(3)]
+    state = State(
+        query="ウクライナ戦争が国際秩序に与える影響について",
+        current_role="critic",
+        reporter_content="\n".join(
+            f"{i}. **要点{i}**\n{point}\n[出典: 例](https://example.com/{i})"
+            for i, point in enumerate(points, 1)
+        ),
+        report_id="20250101_000000",
+        point_selection_for_critic=PointSelection(
+            report_id="20250101_000000", point_id="1", title="要点1", content=points[0]
+        ),
+        explored_content=_text(rng, 4500),
+        user_selection_of_critic=PointSelection(
+            report_id="20250101_000000", point_id="1", title="要点1", content=points[0]
+        ),
+        critic_content=CriticContent(
+            critic_points=[CriticPoint(title=f"論点{i}", content=_text(rng, 300)) for i in range(3)]
+        ),
+        thread_id="1",
+    )
+    repeat = 500
+
+    def bench(name: str, fn: Any) -> Any:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = fn()
+        print(f"{name:<40} {(time.perf_counter() - start) / repeat * 1e6:8.1f}us")
+        return result
+
+    print("encode:")
+    baseline = bench(
+        "fastapi default (jsonable_encoder+json)",
+        lambda: json.dumps(jsonable_encoder(state), ensure_ascii=False).encode(),
+    )
+    fast_json = bench("orjson", lambda: dumps_json(state))
+    packed = bench("msgpack", lambda: encode(state, MSGPACK_MEDIA_TYPE)[0])
+    gzipped = bench("orjson + gzip", lambda: compress(dumps_json(state), "gzip")[0])
+    if brotli is not None:
+        brotlied = bench("orjson + brotli", lambda: compress(dumps_json(state), "br")[0])
+
+    print("decode:")
+    payload = json.loads(baseline)
+    bench("State.model_validate_json", lambda: State.model_validate_json(baseline))
+    bench("orjson + build_state", lambda: build_state(loads_json(fast_json)))
+    bench("msgpack + build_state", lambda: build_state(msgpack.unpackb(packed)))
+
+    print("bytes on the wire:")
+    print(f"  json (fastapi default) {len(baseline)}")
+    print(f"  json (orjson)          {len(fast_json)}")
+    print(f"  msgpack                {len(packed)}")
+    print(f"  json + gzip            {len(gzipped)}")
+    if brotli is not None:
+        print(f"  json + brotli          {len(brotlied)}")
+    assert build_state(dict(payload)).model_dump() == state.model_dump()
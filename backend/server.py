@@ -1,14 +1,30 @@
 import logging
-from typing import Optional
+import os
+from typing import Any, Optional
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, UploadFile, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from langchain_google_vertexai import ChatVertexAI
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError, field_validator
 
-from graph import AgentClassroom, PointSelection, State
+from agent import ReportContent
+from checkpoint import SqliteCheckpointSaver
+from graph import AgentClassroom, PointSelection, State, ThreadNotFoundError
+from hedging import DeadlineExceededError
+from ingestion import IngestionPipeline, InvalidDocumentError, ingestion_settings_from_env
+from profiling import (
+    ProfileStore,
+    ProfilingMiddleware,
+    profiling_settings_from_env,
+    run_in_threadpool,
+)
 from retrievers import create_tavily_search_api_retriever
+from scheduler import ProviderOverloadedError, QueueTimeoutError, create_default_scheduler
+from session_channel import serve_session
+from serialization import build_state, dumps_json, read_body, serialize
+from storage import DEFAULT_DB_PATH, create_store_from_env
+from thread_locks import ThreadBusyError
 
 load_dotenv()
 
@@ -29,97 +45,356 @@ app.add_middleware(
 llm = ChatVertexAI(
     model_name="gemini-1.5-flash",
 )
+# 主モデルの応答が遅い場合にヘッジ先として使うモデル
+fallback_llm = ChatVertexAI(
+    model_name=os.getenv("FALLBACK_MODEL_NAME", "gemini-1.5-flash-8b"),
+)
 
 retriever = create_tavily_search_api_retriever()
-graph = AgentClassroom(llm, retriever)
+scheduler = create_default_scheduler()
+# セッションは既定で agent_classroom.db に保存し、再起動後や複数ワーカーでも再開できるようにする
+store = create_store_from_env(DEFAULT_DB_PATH)
+graph = AgentClassroom(llm, retriever, scheduler, fallback_llm, store)
+if isinstance(graph.memory, SqliteCheckpointSaver):
+    graph.memory.start_compaction()
+# アップロードされた PDF はバックグラウンドで取り込み、処理が終わったページから検索できるようにする
+ingestion = IngestionPipeline(
+    scheduler=scheduler, store=store, **ingestion_settings_from_env(store)
+)
+
+# X-Profile ヘッダー（または ?profile=）に PROFILE_TOKEN を付けたリクエストと、
+# PROFILE_SAMPLE_RATE の割合のリクエストをプロファイルする
+profiling_settings = profiling_settings_from_env()
+profiles = ProfileStore(store=store)
+app.add_middleware(ProfilingMiddleware, profiles=profiles, **profiling_settings)
+
+OVERLOAD_ERRORS = (QueueTimeoutError, ProviderOverloadedError, DeadlineExceededError)
+
+
+def overloaded(e: Exception) -> HTTPException:
+    """プロバイダーの混雑やタイムアウトを 500 ではなく 503 としてクライアントに伝える"""
+    logging.warning(f"Upstream unavailable: {e}")
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+
+def busy(e: ThreadBusyError) -> HTTPException:
+    """同じスレッドの別のリクエストが終わらない（別タブでの操作など）"""
+    return HTTPException(status_code=409, detail=str(e), headers={"Retry-After": "5"})
+
+
+def _thread_id_as_str(value: Any) -> Any:
+    # 以前のクライアントは数値のスレッドIDを送っていた
+    return str(value) if isinstance(value, int) else value
 
 
 class QueryRequest(BaseModel):
     query: str
-    thread_id: int
+    # /reporter では省略すると新しいスレッドIDを発行する
+    thread_id: Optional[str] = None
+
+    _coerce_thread_id = field_validator("thread_id", mode="before")(_thread_id_as_str)
 
 
 class PointSelectionRequest(BaseModel):
-    state: State
+    # チェックポイントがあるスレッドでは使わない（サーバー再起動前のセッションの引き継ぎ用）
+    state: Optional[State] = None
     point_selection_for_critic: PointSelection
-    thread_id: int
+    thread_id: str
     is_yes_case: Optional[bool] = None
 
+    _coerce_thread_id = field_validator("thread_id", mode="before")(_thread_id_as_str)
+
+
+async def read_point_selection_request(http_request: Request) -> PointSelectionRequest:
+    """JSON / msgpack の本文を読み、State のサーバー生成フィールドは再検証せずに組み立てる"""
+    data = await read_body(http_request)
+    try:
+        state_data = data.pop("state", None)
+        state = build_state(state_data) if state_data else None
+        return PointSelectionRequest.model_validate({**data, "state": state})
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False)) from e
+
 
-@app.post("/reporter")
-async def reporter(request: QueryRequest) -> State:
-    """初回の要点を生成するエンドポイント"""
+@app.post("/reporter", response_model=State)
+async def reporter(request: QueryRequest, http_request: Request) -> Response:
+    """初回の要点を生成するエンドポイント。State.thread_id を以降のリクエストで送り返す"""
+    thread_id = request.thread_id or graph.new_thread_id()
     try:
-        initial_state = State(query=request.query, thread_id=str(request.thread_id))
-        result = graph.invoke_node("reporter", initial_state)
-        return result
+        result = await run_in_threadpool(graph.start, thread_id, request.query)
+        return serialize(http_request, result)
+    except ThreadBusyError as e:
+        raise busy(e) from e
+    except OVERLOAD_ERRORS as e:
+        raise overloaded(e) from e
     except Exception as e:
         logging.error(f"Error in reporter node: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/explore")
-async def explore(request: PointSelectionRequest) -> State:
+@app.post("/explore", response_model=State)
+async def explore(
+    http_request: Request,
+    request: PointSelectionRequest = Depends(read_point_selection_request),
+) -> Response:
     """選択された要点の詳細を生成するエンドポイント"""
     try:
-        state = request.state
-        state.point_selection_for_critic = request.point_selection_for_critic
-        result = graph.invoke_node("explore_report", state)
-        return result
+        result = await run_in_threadpool(
+            graph.resume,
+            request.thread_id,
+            "explore_report",
+            {"point_selection_for_critic": request.point_selection_for_critic},
+            request.state,
+        )
+        return serialize(http_request, result)
+    except ThreadNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    except ThreadBusyError as e:
+        raise busy(e) from e
+    except OVERLOAD_ERRORS as e:
+        raise overloaded(e) from e
     except Exception as e:
         logging.error(f"Error in explore node: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/critic")
-async def critic(request: PointSelectionRequest) -> State:
+@app.post("/critic", response_model=State)
+async def critic(
+    http_request: Request,
+    request: PointSelectionRequest = Depends(read_point_selection_request),
+) -> Response:
     """論点を生成するエンドポイント"""
     try:
-        state = request.state
-        state.point_selection_for_critic = request.point_selection_for_critic
-        state.user_selection_of_critic = request.point_selection_for_critic
         print(
             f"Debug - Critic endpoint: Processing point_id {request.point_selection_for_critic.point_id}"
         )
-        print(
-            f"Debug - Critic endpoint: Explored content length: {len(state.explored_content) if state.explored_content else 0}"
-        )
-        print(
-            f"Debug - Critic endpoint: First 100 chars of explored content: {state.explored_content[:100] if state.explored_content else 'No content'}"
+        result = await run_in_threadpool(
+            graph.resume,
+            request.thread_id,
+            "critic",
+            {
+                "point_selection_for_critic": request.point_selection_for_critic,
+                "user_selection_of_critic": request.point_selection_for_critic,
+            },
+            request.state,
         )
-        result = graph.invoke_node("critic", state)
-        return result
+        return serialize(http_request, result)
+    except ThreadNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    except ThreadBusyError as e:
+        raise busy(e) from e
+    except OVERLOAD_ERRORS as e:
+        raise overloaded(e) from e
     except Exception as e:
         logging.error(f"Error in critic node: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/investigate_case")
-async def investigate_case(request: PointSelectionRequest) -> State:
+@app.post("/investigate_case", response_model=State)
+async def investigate_case(
+    http_request: Request,
+    request: PointSelectionRequest = Depends(read_point_selection_request),
+) -> Response:
     """Yes/Noの事例を調査するエンドポイント"""
     try:
         print("\nDebug - Investigate Case Endpoint:")
-        print(f"Request data: {request.dict()}")
-        print(f"State data: {request.state.dict()}")
+        print(f"Thread ID: {request.thread_id}")
         print(f"Point selection: {request.point_selection_for_critic}")
         print(f"Is Yes Case: {request.is_yes_case}")
 
-        state = request.state
-        state.point_selection_for_critic = request.point_selection_for_critic
-        state.is_yes_case = request.is_yes_case
-
-        print(f"Debug - State after update:")
-        print(f"Point selection: {state.point_selection_for_critic}")
-        print(f"Is Yes Case: {state.is_yes_case}")
-
-        result = graph.invoke_node("investigate_cases", state)
-        return result
+        result = await run_in_threadpool(
+            graph.resume,
+            request.thread_id,
+            "investigate_cases",
+            {
+                "point_selection_for_critic": request.point_selection_for_critic,
+                "is_yes_case": bool(request.is_yes_case),
+            },
+            request.state,
+        )
+        return serialize(http_request, result)
+    except ThreadNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    except ThreadBusyError as e:
+        raise busy(e) from e
+    except OVERLOAD_ERRORS as e:
+        raise overloaded(e) from e
     except Exception as e:
         logging.error(f"Error in investigate_cases node: {e}")
         print(f"Debug - Error occurred: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.websocket("/ws/{thread_id}")
+async def session(websocket: WebSocket, thread_id: str) -> None:
+    """選択のイベントを受け取り、トークン・要点・論点・State を順に送る WebSocket セッション"""
+    await serve_session(websocket, graph, thread_id)
+
+
+class ReportRefresh(BaseModel):
+    """差分再生成の結果
+
+    patch を base_report_id のレポートに適用すると report_id のレポートになる。
+    """
+
+    thread_id: str
+    report_id: Optional[str] = None
+    base_report_id: Optional[str] = None
+    patch: Optional[list[dict[str, Any]]] = None
+    # 前回のレポートがない場合（初回や別のトピック）は全体を返す
+    report: Optional[ReportContent] = None
+
+
+def build_refresh(
+    thread_id: str, base_id: Optional[str], report_id: Optional[str]
+) -> ReportRefresh:
+    if report_id is None:
+        return ReportRefresh(thread_id=thread_id)
+    patch = graph.report_patch(base_id, report_id)
+    if patch is None:
+        report = graph.reporter.reports.get_report(report_id)
+        return ReportRefresh(thread_id=thread_id, report_id=report_id, report=report)
+    return ReportRefresh(
+        thread_id=thread_id, report_id=report_id, base_report_id=base_id, patch=patch
+    )
+
+
+@app.post("/reporter/refresh", response_model=ReportRefresh)
+async def refresh_reporter(request: QueryRequest, http_request: Request) -> Response:
+    """同じトピックの要点を、出典が変わったものだけ生成し直して差分を返すエンドポイント"""
+    if request.thread_id is None:
+        raise HTTPException(status_code=422, detail="thread_id is required")
+    try:
+        state, base_id = await run_in_threadpool(graph.refresh, request.thread_id, request.query)
+        refresh = build_refresh(request.thread_id, base_id, state.report_id)
+        return serialize(http_request, refresh)
+    except ThreadBusyError as e:
+        raise busy(e) from e
+    except OVERLOAD_ERRORS as e:
+        raise overloaded(e) from e
+    except Exception as e:
+        logging.error(f"Error in reporter refresh: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/explore/refresh", response_model=ReportRefresh)
+async def refresh_explore(
+    http_request: Request,
+    request: PointSelectionRequest = Depends(read_point_selection_request),
+) -> Response:
+    """選択された要点の詳細レポートを差分再生成し、前回の詳細レポートとの差分を返すエンドポイント"""
+    try:
+        _, base_id, report_id = await run_in_threadpool(
+            graph.refresh_detailed_report,
+            request.thread_id,
+            {"point_selection_for_critic": request.point_selection_for_critic},
+            request.state,
+        )
+        return serialize(http_request, build_refresh(request.thread_id, base_id, report_id))
+    except ThreadNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    except ThreadBusyError as e:
+        raise busy(e) from e
+    except OVERLOAD_ERRORS as e:
+        raise overloaded(e) from e
+    except Exception as e:
+        logging.error(f"Error in explore refresh: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/threads/{thread_id}", response_model=State)
+async def get_thread(thread_id: str, http_request: Request) -> Response:
+    """スレッドの最新のチェックポイントを返すエンドポイント（セッションの再開用）"""
+    state = await run_in_threadpool(graph.get_state, thread_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"Thread {thread_id} not found")
+    return serialize(http_request, state)
+
+
+@app.get("/reports/{report_id}")
+async def get_report(report_id: str) -> ReportContent:
+    """ルートから指定レポートまでの表示中の経路だけを返すエンドポイント"""
+    if report_id not in graph.reporter.reports:
+        raise HTTPException(status_code=404, detail=f"Report with ID {report_id} not found")
+    return graph.reporter.reports.path_view(report_id)
+
+
+@app.post("/documents", status_code=202)
+async def upload_document(file: UploadFile) -> dict:
+    """PDF を受け取り、取り込みジョブを返すエンドポイント（取り込みはバックグラウンドで行う）"""
+    filename = file.filename or "document.pdf"
+    if not filename.lower().endswith(".pdf"):
+        raise HTTPException(status_code=415, detail=f"{filename} is not a PDF")
+    try:
+        path = await run_in_threadpool(ingestion.save_upload, file.file, filename)
+    except InvalidDocumentError as e:
+        raise HTTPException(status_code=e.status, detail=e.detail) from e
+    finally:
+        await file.close()
+    return ingestion.submit(path, filename).to_dict()
+
+
+@app.get("/documents/search")
+async def search_documents(query: str, k: int = 4) -> list[dict]:
+    """取り込み済みの PDF のチャンクを検索するエンドポイント"""
+    try:
+        docs = await run_in_threadpool(ingestion.search, query, k)
+    except OVERLOAD_ERRORS as e:
+        raise overloaded(e) from e
+    return [{"content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+
+
+@app.get("/documents/{job_id}")
+async def get_document_job(job_id: str) -> dict:
+    """取り込みジョブの状態と進捗（処理済みのページ数・チャンク数）を返すエンドポイント"""
+    job = ingestion.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Ingestion job {job_id} not found")
+    return job
+
+
+@app.get("/metrics")
+async def metrics() -> dict:
+    """プロバイダーごとのキュー長・待ち時間、ノードごとのLLM・検索のレイテンシ、先読みのヒット率を返す"""
+    return {
+        "scheduler": scheduler.metrics(),
+        "llm_latency": graph.hedger.metrics(),
+        "case_prefetch": graph.reporter.case_prefetcher.metrics(),
+        "documents": graph.reporter.documents.metrics(),
+        "retrieval": graph.reporter.retrieval_policy.metrics(),
+        "regeneration": graph.reporter.generations.metrics(),
+        "ingestion": ingestion.metrics(),
+    }
+
+
+def check_profile_access(request: Request) -> None:
+    """X-Profile ヘッダーが PROFILE_TOKEN と一致する場合だけ許可する（未設定なら常に拒否）"""
+    token = profiling_settings["token"]
+    if token is None or request.headers.get("x-profile") != token:
+        raise HTTPException(status_code=403, detail="Profile access denied")
+
+
+@app.get("/profiles", dependencies=[Depends(check_profile_access)])
+async def list_profiles() -> list[dict]:
+    """このワーカーで取得した直近のプロファイルの一覧"""
+    return profiles.recent()
+
+
+@app.get("/profiles/{profile_id}", dependencies=[Depends(check_profile_access)])
+async def get_profile(profile_id: str, format: str = "json") -> Response:
+    """プロファイルを返す。format=collapsed なら flamegraph / speedscope 用のテキスト"""
+    profile = await run_in_threadpool(profiles.get, profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    if format == "collapsed":
+        return Response(
+            profile["collapsed"],
+            media_type="text/plain; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{profile_id}.folded"'},
+        )
+    return Response(dumps_json(profile), media_type="application/json")
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,252 @@
+"""WebSocket でのセッション（/ws/{thread_id}）
+
+クライアントは選択のイベントだけを送り、State はサーバー側のチェックポイントに保持する。
+サーバーは LLM のトークン、解析した要点、論点、事例を順に送り、選択待ちで止まるたびに
+最新の State を送る。
+
+    → {"type": "start", "query": "..."}
+    → {"type": "select_point", "point_selection_for_critic": {...}}
+    → {"type": "select_topic", "point_selection_for_critic": {...}}
+    → {"type": "select_case", "point_selection_for_critic": {...}, "is_yes_case": true}
+    → {"type": "get_state"}
+    ← {"type": "token", "node": "reporter", "content": "..."}
+    ← {"type": "points" | "detailed_report" | "critique" | "cases", ...}
+    ← {"type": "state", "state": {...}}
+    ← {"type": "error", "status": 404, "detail": "..."}
+
+同じスレッドへの HTTP のリクエストや別の接続とは、AgentClassroom のスレッドごとのロックで
+1つずつ実行する（先のコマンドが終わらなければ status 409 のエラーを送る）。
+
+送信が追いつかないクライアントに対しては、キューが空くまでトークンを連結してまとめて送る
+（LLM を呼び出しているスレッドは止めない）。それ以外のイベントはキューが空くまで待つ。
+"""
+
+import asyncio
+import logging
+from collections import deque
+from collections.abc import Iterator
+from typing import TYPE_CHECKING, Any, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+
+from agent import PointSelection
+from graph import ThreadNotFoundError
+from hedging import DeadlineExceededError
+from scheduler import ProviderOverloadedError, QueueTimeoutError
+from serialization import dumps_json, loads_json
+from thread_locks import ThreadBusyError
+
+if TYPE_CHECKING:
+    from graph import AgentClassroom
+
+logger = logging.getLogger(__name__)
+
+# トークンを送るノード（critic は JSON を生成するので、解析後の論点だけを送る）
+TOKEN_NODES = {"reporter", "explore_report", "investigate_cases"}
+
+# 選択のイベント → 再開するノードと State に書き込むフィールド
+SELECTION_COMMANDS = {
+    "select_point": ("explore_report", ("point_selection_for_critic",)),
+    "select_topic": ("critic", ("point_selection_for_critic", "user_selection_of_critic")),
+    "select_case": ("investigate_cases", ("point_selection_for_critic",)),
+}
+
+
+class ChannelClosedError(ConnectionError):
+    """クライアントが切断した（実行中のグラフのストリームを打ち切る）"""
+
+
+class CommandError(ValueError):
+    def __init__(self, status: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+class EventChannel:
+    """グラフを実行するスレッドから WebSocket へイベントを送る、上限付きのキュー"""
+
+    def __init__(self, websocket: WebSocket, maxsize: int = 64, send_timeout: float = 30.0) -> None:
+        self.websocket = websocket
+        self.send_timeout = send_timeout
+        self.closed = False
+        self.coalesced_tokens = 0
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue(maxsize)
+        self._tokens: deque[dict[str, Any]] = deque()
+
+    def emit(self, event: dict[str, Any]) -> None:
+        """ワーカースレッドから呼ぶ。トークン以外はキューに入るまで待つ"""
+        if self.closed:
+            raise ChannelClosedError("client disconnected")
+        if event["type"] == "token":
+            self._loop.call_soon_threadsafe(self._add_token, event)
+        else:
+            asyncio.run_coroutine_threadsafe(self.put(event), self._loop).result()
+
+    def _add_token(self, event: dict[str, Any]) -> None:
+        last = self._tokens[-1] if self._tokens else None
+        if last is not None and (last["node"], last.get("model")) == (
+            event["node"],
+            event.get("model"),
+        ):
+            # まだ送れていない同じノードのトークンに連結する
+            last["content"] += event["content"]
+            self.coalesced_tokens += 1
+        else:
+            self._tokens.append(dict(event))
+        self._flush_tokens()
+
+    def _flush_tokens(self) -> None:
+        while self._tokens and not self._queue.full():
+            self._queue.put_nowait(self._tokens.popleft())
+
+    async def put(self, event: dict[str, Any]) -> None:
+        # 先に届いたトークンを追い越さないようにする
+        while self._tokens and not self.closed:
+            await self._queue.put(self._tokens.popleft())
+        if not self.closed:
+            await self._queue.put(event)
+
+    async def run_sender(self) -> None:
+        try:
+            while True:
+                event = await self._queue.get()
+                await asyncio.wait_for(
+                    self.websocket.send_text(dumps_json(event).decode()), self.send_timeout
+                )
+                self._flush_tokens()
+        except asyncio.TimeoutError:
+            logger.warning("Closing a WebSocket session whose client stopped reading")
+            await self.websocket.close(code=1013)
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self.closed = True
+        self._tokens.clear()
+        # put で待っているワーカースレッドを解放する
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+
+def graph_events(classroom: "AgentClassroom", stream: Iterator[tuple[str, Any]]) -> Iterator[dict]:
+    """LangGraph のストリームをクライアントに送るイベントに変換する"""
+    for mode, chunk in stream:
+        if mode == "messages":
+            message, metadata = chunk
+            node = metadata.get("langgraph_node")
+            content = getattr(message, "content", None)
+            if node in TOKEN_NODES and isinstance(content, str) and content:
+                yield {
+                    "type": "token",
+                    "node": node,
+                    "model": metadata.get("ls_model_name"),
+                    "content": content,
+                }
+            continue
+        for node, update in (chunk or {}).items():
+            if not isinstance(update, dict):
+                continue
+            if node == "reporter" and update.get("report_id"):
+                report = classroom.reporter.reports.get_report(update["report_id"])
+                yield {"type": "points", "report": report.model_dump()}
+            elif node == "explore_report":
+                yield {"type": "detailed_report", "content": update.get("explored_content")}
+            elif node == "critic":
+                critic_content = update.get("critic_content")
+                yield {
+                    "type": "critique",
+                    "critic_content": critic_content.model_dump()
+                    if hasattr(critic_content, "model_dump")
+                    else critic_content,
+                }
+            elif node == "investigate_cases":
+                yield {"type": "cases", "content": update.get("explored_content")}
+
+
+def command_stream(
+    classroom: "AgentClassroom", thread_id: str, message: dict[str, Any]
+) -> Optional[Iterator[tuple[str, Any]]]:
+    """クライアントのイベントに対応するグラフのストリーム（get_state なら None）"""
+    command = message.get("type")
+    if command == "get_state":
+        return None
+    if command == "start":
+        if not isinstance(message.get("query"), str) or not message["query"]:
+            raise CommandError(422, "start requires a query")
+        return classroom.stream_start(thread_id, message["query"])
+    if command not in SELECTION_COMMANDS:
+        raise CommandError(400, f"Unknown event type: {command}")
+    node_name, fields = SELECTION_COMMANDS[command]
+    try:
+        selection = PointSelection.model_validate(message.get("point_selection_for_critic"))
+    except ValidationError as e:
+        raise CommandError(422, str(e)) from e
+    values: dict[str, Any] = {name: selection for name in fields}
+    if command == "select_case":
+        values["is_yes_case"] = bool(message.get("is_yes_case"))
+    return classroom.stream_resume(thread_id, node_name, values)
+
+
+def _parse_message(raw: str) -> dict[str, Any]:
+    try:
+        message = loads_json(raw)
+    except ValueError as e:
+        raise CommandError(400, f"Invalid event: {e}") from e
+    if not isinstance(message, dict):
+        raise CommandError(400, "Event must be an object")
+    return message
+
+
+def _run_command(
+    classroom: "AgentClassroom", thread_id: str, message: dict[str, Any], channel: EventChannel
+) -> None:
+    # 送る State が他のリクエストの途中の State にならないよう、読み出しまでロックを持つ
+    with classroom.locks.hold(thread_id):
+        stream = command_stream(classroom, thread_id, message)
+        if stream is not None:
+            try:
+                for event in graph_events(classroom, stream):
+                    channel.emit(event)
+            finally:
+                stream.close()
+        state = classroom.get_state(thread_id)
+    if state is None:
+        raise ThreadNotFoundError(f"Thread {thread_id} has no checkpoint")
+    channel.emit({"type": "state", "state": state.model_dump()})
+
+
+async def serve_session(websocket: WebSocket, classroom: "AgentClassroom", thread_id: str) -> None:
+    """1つの WebSocket 接続で、クライアントのイベントを順に処理する"""
+    await websocket.accept()
+    channel = EventChannel(websocket)
+    sender = asyncio.create_task(channel.run_sender())
+    try:
+        while not channel.closed:
+            raw = await websocket.receive_text()
+            try:
+                message = _parse_message(raw)
+                await run_in_threadpool(_run_command, classroom, thread_id, message, channel)
+            except CommandError as e:
+                await channel.put({"type": "error", "status": e.status, "detail": e.detail})
+            except ThreadNotFoundError as e:
+                await channel.put({"type": "error", "status": 404, "detail": str(e)})
+            except ThreadBusyError as e:
+                await channel.put({"type": "error", "status": 409, "detail": str(e)})
+            except (QueueTimeoutError, ProviderOverloadedError, DeadlineExceededError) as e:
+                await channel.put({"type": "error", "status": 503, "detail": str(e)})
+            except ChannelClosedError:
+                break
+            except Exception as e:
+                logger.exception("Error in WebSocket session %s", thread_id)
+                await channel.put({"type": "error", "status": 500, "detail": str(e)})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        channel.close()
+        sender.cancel()
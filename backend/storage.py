@@ -0,0 +1,194 @@
+"""複数ワーカープロセスで共有するローカルストレージ（SQLite WAL モード）
+
+uvicorn --workers N や gunicorn で複数プロセスを起動しても、レポート・チェックポイント・
+キャッシュを同じ SQLite ファイル経由で共有できるようにする。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict
+from typing import Any, Optional
+
+from report_tree import LoadedReport, PointNode, ReportNode
+
+DEFAULT_DB_PATH = "agent_classroom.db"
+
+
+class SQLiteStore:
+    """名前空間付きのキー・バリューストア。接続はスレッド（とプロセス）ごとに作る"""
+
+    def __init__(self, path: str = DEFAULT_DB_PATH, busy_timeout: float = 10.0) -> None:
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        with self.transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS kv (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    updated_at REAL NOT NULL,
+                    expires_at REAL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+
+    def connection(self) -> sqlite3.Connection:
+        # fork 後に親プロセスの接続を使い回さないよう pid も確認する
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """書き込みロックを先に取るトランザクション"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        row = (
+            self.connection()
+            .execute(
+                "SELECT value, expires_at FROM kv WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            )
+            .fetchone()
+        )
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row[0]
+
+    def put(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        self.connection().execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value, updated_at, expires_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, value, now, now + ttl if ttl else None),
+        )
+
+    def add(self, namespace: str, key: str, value: bytes = b"") -> bool:
+        """キーが存在しない場合だけ書き込み、書き込めたかを返す（プロセス間での ID 確保に使う）"""
+        cursor = self.connection().execute(
+            "INSERT OR IGNORE INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, value, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    def acquire(self, namespace: str, key: str, owner: str, ttl: float) -> bool:
+        """key のリース（期限付きのロック）を取る。他の owner が期限内で持っていれば False"""
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM kv WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+            now = time.time()
+            if row is not None and row[0] != owner.encode() and row[1] > now:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, updated_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, owner.encode(), now, now + ttl),
+            )
+            return True
+
+    def release(self, namespace: str, key: str, owner: str) -> None:
+        self.connection().execute(
+            "DELETE FROM kv WHERE namespace = ? AND key = ? AND value = ?",
+            (namespace, key, owner.encode()),
+        )
+
+    def delete(self, namespace: str, key: str) -> None:
+        self.connection().execute(
+            "DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+        )
+
+    def keys(self, namespace: str) -> list[str]:
+        rows = self.connection().execute(
+            "SELECT key FROM kv WHERE namespace = ? ORDER BY key", (namespace,)
+        )
+        return [row[0] for row in rows]
+
+    def purge_expired(self) -> int:
+        cursor = self.connection().execute(
+            "DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),)
+        )
+        return cursor.rowcount
+
+    def get_json(self, namespace: str, key: str) -> Optional[Any]:
+        value = self.get(namespace, key)
+        return json.loads(value) if value is not None else None
+
+    def put_json(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self.put(namespace, key, json.dumps(value, ensure_ascii=False).encode(), ttl)
+
+
+class SQLiteReportBackend:
+    """ReportTree のノードを SQLite に保存し、他のワーカーから遅延読み込みできるようにする"""
+
+    namespace = "reports"
+
+    def __init__(self, store: SQLiteStore) -> None:
+        self.store = store
+
+    def load(self, report_id: str) -> Optional[LoadedReport]:
+        data = self.store.get_json(self.namespace, report_id)
+        if data is None:
+            return None
+        return ReportNode(**data["report"]), [PointNode(**p) for p in data["points"]]
+
+    def save(self, node: ReportNode, points: list[PointNode]) -> None:
+        self.store.put_json(
+            self.namespace,
+            node.id,
+            {"report": asdict(node), "points": [asdict(p) for p in points]},
+        )
+
+    def claim(self, report_id: str) -> bool:
+        return self.store.add("report_ids", report_id)
+
+    def link(self, report_id: str, point_node_id: str, detailed_report_id: str) -> None:
+        # 他のワーカーが同じレポートの別のポイントに結び付けた詳細レポートを消さないよう、
+        # 書き込みロックを取ってから保存済みの行を読み直して1つのポイントだけ書き換える
+        with self.store.transaction():
+            data = self.store.get_json(self.namespace, report_id)
+            if data is None:
+                raise KeyError(report_id)
+            for point in data["points"]:
+                if point["id"] == point_node_id:
+                    point["detailed_report_id"] = detailed_report_id
+            self.store.put_json(self.namespace, report_id, data)
+
+    def reserve(self, root_id: str, count: int, limit: int) -> bool:
+        with self.store.transaction():
+            size = self.store.get_json("report_tree_sizes", root_id) or 0
+            if size + count > limit:
+                return False
+            self.store.put_json("report_tree_sizes", root_id, size + count)
+            return True
+
+
+def create_store_from_env(default: Optional[str] = None) -> Optional[SQLiteStore]:
+    """AGENT_CLASSROOM_DB（未設定なら default）のファイルで共有ストアを作る
+
+    パスが空ならストアを作らず、状態はプロセス内だけに保持する。
+    """
+    path = os.getenv("AGENT_CLASSROOM_DB", default)
+    return SQLiteStore(path) if path else None
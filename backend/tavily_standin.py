@@ -0,0 +1,192 @@
+"""Tavily の /search を模したローカルの HTTP サーバーと、それを呼び出すリトリーバー
+
+ネットワークや Tavily の応答時間に左右されずに reporter / critic の流れを負荷試験できるよう、
+クエリから決定的に生成した結果を、指定したレイテンシと本文サイズで返す。
+
+    poetry run python tavily_standin.py --port 8765 --latency 0.3 --raw-content-chars 20000
+    RETRIEVER_MODE=standin TAVILY_STANDIN_URL=http://localhost:8765 poetry run uvicorn server:app
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+
+from langchain_community.retrievers import TavilySearchAPIRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STANDIN_URL = "http://localhost:8765"
+
+_SENTENCES = [
+    "各国政府は声明を発表し、事態の早期収拾を求めた。",
+    "専門家は、今回の動きが地域の安全保障環境に長期的な影響を与えると指摘している。",
+    "国際機関は緊急会合を開き、人道支援の拡充について協議した。",
+    "市場では先行きへの不透明感から、エネルギー価格が上昇した。",
+    "一方で、対話による解決を模索する動きも見られる。",
+]
+
+
+@dataclass
+class StandInConfig:
+    latency: float = 0.2  # 1リクエストあたりの平均応答時間（秒）
+    jitter: float = 0.1  # 応答時間のばらつき（±秒）
+    content_chars: int = 500
+    raw_content_chars: int = 8000
+    error_rate: float = 0.0  # この割合で 429 を返す
+
+
+def _text(rng: random.Random, chars: int) -> str:
+    parts, size = [], 0
+    while size < chars:
+        sentence = rng.choice(_SENTENCES)
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)[:chars]
+
+
+def search_response(query: str, payload: dict[str, Any], config: StandInConfig) -> dict[str, Any]:
+    """同じクエリには同じ結果を返す（本文はクエリのハッシュから生成する）"""
+    seed = int(hashlib.sha256(query.encode()).hexdigest()[:16], 16)
+    results = []
+    for i in range(int(payload.get("max_results", 5))):
+        rng = random.Random(seed + i)
+        slug = hashlib.sha256(f"{query}/{i}".encode()).hexdigest()[:12]
+        result = {
+            "title": f"{query} に関する記事 {i + 1}",
+            "url": f"https://news.example.com/{slug}",
+            "content": _text(rng, config.content_chars),
+            "score": round(1.0 - i * 0.1, 2),
+        }
+        if payload.get("include_raw_content"):
+            result["raw_content"] = _text(rng, config.raw_content_chars)
+        results.append(result)
+    return {
+        "query": query,
+        "answer": None,
+        "images": [],
+        "results": results,
+        "response_time": config.latency,
+    }
+
+
+def make_handler(config: StandInConfig) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status: int, body: dict[str, Any]) -> None:
+            data = json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                self._send(400, {"detail": {"error": "invalid JSON"}})
+                return
+            if self.path.rstrip("/") != "/search":
+                self._send(404, {"detail": {"error": f"{self.path} is not supported"}})
+                return
+            time.sleep(max(0.0, random.uniform(-config.jitter, config.jitter) + config.latency))
+            if config.error_rate and random.random() < config.error_rate:
+                self._send(429, {"detail": {"error": "rate limited by stand-in"}})
+                return
+            self._send(200, search_response(payload.get("query", ""), payload, config))
+
+        def log_message(self, format: str, *args: Any) -> None:
+            logger.debug(format, *args)
+
+    return Handler
+
+
+def serve(
+    host: str = "localhost", port: int = 8765, config: Optional[StandInConfig] = None
+) -> ThreadingHTTPServer:
+    """バックグラウンドのスレッドでサーバーを起動する（ベンチマークのスクリプトから使う）"""
+    server = ThreadingHTTPServer((host, port), make_handler(config or StandInConfig()))
+    threading.Thread(target=server.serve_forever, name="tavily-standin", daemon=True).start()
+    return server
+
+
+class StandInTavilyRetriever(TavilySearchAPIRetriever):
+    """TavilySearchAPIRetriever と同じ設定で、base_url のスタンドインサーバーに問い合わせる"""
+
+    base_url: str = DEFAULT_STANDIN_URL
+    api_key: Optional[str] = "tvly-standin"
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        from tavily import TavilyClient
+
+        client = TavilyClient(api_key=self.api_key)
+        client.base_url = self.base_url.rstrip("/")
+        response = client.search(
+            query=query,
+            max_results=self.k,
+            search_depth=self.search_depth.value,
+            include_domains=self.include_domains,
+            exclude_domains=self.exclude_domains,
+            include_raw_content=self.include_raw_content,
+            **self.kwargs,
+        )
+        # TavilySearchAPIRetriever と同じ形の Document にする
+        return [
+            Document(
+                page_content=(
+                    result.get("raw_content") or ""
+                    if self.include_raw_content
+                    else result.get("content", "")
+                ),
+                metadata={
+                    "title": result.get("title", ""),
+                    "source": result.get("url", ""),
+                    **{
+                        k: v
+                        for k, v in result.items()
+                        if k not in ("content", "title", "url", "raw_content")
+                    },
+                    "images": response.get("images"),
+                },
+            )
+            for result in response.get("results", [])
+        ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Tavily search API")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=StandInConfig.latency)
+    parser.add_argument("--jitter", type=float, default=StandInConfig.jitter)
+    parser.add_argument("--content-chars", type=int, default=StandInConfig.content_chars)
+    parser.add_argument("--raw-content-chars", type=int, default=StandInConfig.raw_content_chars)
+    parser.add_argument("--error-rate", type=float, default=StandInConfig.error_rate)
+    args = parser.parse_args()
+
+    config = StandInConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        content_chars=args.content_chars,
+        raw_content_chars=args.raw_content_chars,
+        error_rate=args.error_rate,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(config))
+    print(f"Tavily stand-in listening on http://{args.host}:{args.port} ({config})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
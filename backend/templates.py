@@ -78,3 +78,25 @@ CRITIQUE_TEMPLATE = (
     "- contentは100字以内で簡潔に記述する\n"
     "- 3つの論点同士が互いに重複しないよう、必ず異なる視点から切り込む\n"
 )
+
+REGENERATE_POINTS_TEMPLATE = '''
+        あなたは国際政治演習に参加している報告担当の生徒です。
+        以下のテーマについて、資料を元に新しい要点を箇条書きでまとめてください。
+
+        テーマ: {topic}
+
+        報告済みの要点（これらと重複しない内容にする）:
+        {existing}
+
+        資料: """
+        {context}
+        """
+
+        注意:
+        - 要点を{count}つ箇条書きで整理する
+        - 各要点は以下のマークダウン形式で記載する:
+          1. **[要点のタイトル]**  
+             [要点の詳細説明]  
+             [出典: サイト名](URL)
+        - 箇条書き以外の文章（タイトルや前置き）は出力しない
+        '''
@@ -0,0 +1,217 @@
+"""1つのセッションを複数のワーカープロセスで進めるテスト
+
+uvicorn --workers N と同じく、プロセスごとに AgentClassroom を作って同じ SQLite ファイルを共有し、
+セッションの各ステップを交互のプロセスで実行する。LLM は固定の回答を返すモデル、検索は
+tavily_standin.py のスタンドインサーバーを使うので、ネットワークには出ない。
+
+    cd backend && poetry run python -m unittest discover tests
+"""
+
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel  # noqa: E402
+
+REPORT = "\n".join(
+    f"{i}. **要点{i}**\n要点{i}の本文\n[出典: news](https://news.example.com/{i})"
+    for i in (1, 2, 3)
+)
+CRITIQUE = (
+    '{"critic_points": ['
+    + ", ".join(f'{{"title": "論点{i}", "content": "論点{i}の本文"}}' for i in (1, 2, 3))
+    + "]}"
+)
+
+
+class FixedChatModel(FakeListChatModel):
+    """critic のプロンプト（JSON で答える指示を含む）には論点を、それ以外にはレポートを返す"""
+
+    responses: list[str] = [REPORT]
+
+    def _call(
+        self, messages: list, stop: Any = None, run_manager: Any = None, **kwargs: Any
+    ) -> str:
+        prompt = str(messages[-1].content) if messages else ""
+        return CRITIQUE if "json" in prompt.lower() else REPORT
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def _worker(path: str, conn: Any) -> None:
+    """サーバーのワーカープロセスの代わり。conn から受け取ったコマンドを順に実行する"""
+    from agent import PointSelection
+    from graph import AgentClassroom
+    from retrievers import create_tavily_search_api_retriever
+    from storage import SQLiteStore
+
+    classroom = AgentClassroom(
+        FixedChatModel(),
+        create_tavily_search_api_retriever(),
+        fallback_llm=FixedChatModel(),
+        store=SQLiteStore(path),
+    )
+
+    def selection(values: dict[str, Any]) -> dict[str, Any]:
+        return {
+            name: PointSelection(**value) if isinstance(value, dict) else value
+            for name, value in values.items()
+        }
+
+    while True:
+        command, *args = conn.recv()
+        if command == "stop":
+            return
+        try:
+            if command == "start":
+                state = classroom.start(*args)
+            elif command == "resume":
+                thread_id, node_name, values = args
+                state = classroom.resume(thread_id, node_name, selection(values))
+            elif command == "refresh_detailed_report":
+                thread_id, values = args
+                state, base, detailed = classroom.refresh_detailed_report(
+                    thread_id, selection(values)
+                )
+                conn.send(("ok", {"base": base, "detailed": detailed}))
+                continue
+            conn.send(("ok", state.model_dump(mode="json")))
+        except Exception as e:  # 親プロセスでテストを失敗させる
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class MultiWorkerSessionTest(unittest.TestCase):
+    workers = 2
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        from tavily_standin import StandInConfig, serve
+
+        port = _free_port()
+        cls.standin = serve(port=port, config=StandInConfig(latency=0.0, jitter=0.0))
+        os.environ["RETRIEVER_MODE"] = "standin"
+        os.environ["TAVILY_STANDIN_URL"] = f"http://localhost:{port}"
+        os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.standin.shutdown()
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "shared.db")
+        # 各ワーカーはこのモジュール内の関数を実行するので fork で起動する
+        ctx = multiprocessing.get_context("fork")
+        self.conns, self.procs = [], []
+        for _ in range(self.workers):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_worker, args=(self.path, child), daemon=True)
+            proc.start()
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    def tearDown(self) -> None:
+        for conn, proc in zip(self.conns, self.procs):
+            conn.send(("stop",))
+            proc.join(timeout=10)
+        self.tmp.cleanup()
+
+    def call(self, worker: int, *command: Any) -> dict[str, Any]:
+        self.conns[worker].send(command)
+        return self.receive(worker)
+
+    def receive(self, worker: int) -> dict[str, Any]:
+        self.assertTrue(self.conns[worker].poll(60), f"worker {worker} did not answer")
+        status, value = self.conns[worker].recv()
+        self.assertEqual(status, "ok", value)
+        return value
+
+    def point(self, state: dict[str, Any], point_id: str) -> dict[str, Any]:
+        return {"report_id": state["report_id"], "point_id": point_id}
+
+    def fresh_tree(self) -> Any:
+        from report_tree import ReportTree
+        from storage import SQLiteReportBackend, SQLiteStore
+
+        return ReportTree(backend=SQLiteReportBackend(SQLiteStore(self.path)))
+
+    def test_session_steps_on_alternating_workers(self) -> None:
+        thread_id = "session-1"
+        state = self.call(0, "start", thread_id, "日米首脳会談")
+        self.assertTrue(state["report_id"])
+        selected = {"point_selection_for_critic": self.point(state, "1")}
+
+        # 別のワーカーが、最初のワーカーが作ったチェックポイントとレポートから再開する
+        state = self.call(1, "resume", thread_id, "explore_report", selected)
+        self.assertTrue(state["explored_content"])
+        topic = {
+            "point_selection_for_critic": self.point(state, "1"),
+            "user_selection_of_critic": self.point(state, "1"),
+        }
+        state = self.call(0, "resume", thread_id, "critic", topic)
+        self.assertEqual(len(state["critic_content"]["critic_points"]), 3)
+        case = {"point_selection_for_critic": self.point(state, "1"), "is_yes_case": True}
+        state = self.call(1, "resume", thread_id, "investigate_cases", case)
+        self.assertEqual(state["current_role"], "investigate_cases")
+
+        # どちらのワーカーからも同じ最新の State が見える
+        from graph import AgentClassroom
+        from storage import SQLiteStore
+
+        reader = AgentClassroom(FixedChatModel(), None, store=SQLiteStore(self.path))
+        latest = reader.get_state(thread_id)
+        self.assertEqual(latest.current_role, "investigate_cases")
+        self.assertEqual(latest.report_id, state["report_id"])
+        self.assertIn(state["report_id"], self.fresh_tree())
+
+    def test_concurrent_detailed_reports_on_one_report(self) -> None:
+        thread_id = "session-2"
+        state = self.call(0, "start", thread_id, "ウクライナ戦争の現状")
+        report_id = state["report_id"]
+        # 両方のワーカーがレポートを読み込んでキャッシュした状態にする
+        for worker, point_id in ((0, "1"), (1, "2")):
+            selected = {"point_selection_for_critic": self.point(state, point_id)}
+            self.call(worker, "resume", thread_id, "explore_report", selected)
+
+        # 同じレポートの別々の要点の詳細レポートを、2つのワーカーで同時に生成し直す
+        barrier = threading.Barrier(self.workers)
+        results: dict[int, dict[str, Any]] = {}
+
+        def refresh(worker: int, point_id: str) -> None:
+            selected = {"point_selection_for_critic": self.point(state, point_id)}
+            barrier.wait()
+            self.conns[worker].send(("refresh_detailed_report", thread_id, selected))
+
+        threads = [
+            threading.Thread(target=refresh, args=(worker, point_id))
+            for worker, point_id in ((0, "1"), (1, "2"))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for worker in range(self.workers):
+            results[worker] = self.receive(worker)
+
+        # 後から保存したワーカーが、もう一方の詳細レポートを古い版に戻していない
+        tree = self.fresh_tree()
+        self.assertEqual(tree.detailed_report_id(report_id, "1"), results[0]["detailed"])
+        self.assertEqual(tree.detailed_report_id(report_id, "2"), results[1]["detailed"])
+        self.assertIsNone(tree.detailed_report_id(report_id, "3"))
+        for result in results.values():
+            self.assertNotEqual(result["base"], result["detailed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+"""リクエスト単位のプロファイリングのテスト
+
+同じイベントループで別のリクエストが CPU を使っている間に1つのリクエストをプロファイルし、
+そのリクエストのスタックだけが記録されることを確かめる。
+
+    cd backend && poetry run python -m unittest discover tests
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from profiling import ProfileStore, ProfilingMiddleware, run_in_threadpool  # noqa: E402
+
+TOKEN = "secret"
+
+
+def _spin(seconds: float) -> None:
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+# GIL の切り替え間隔（5ms）より長く CPU を使い、ループの待機中以外でもサンプルされるようにする
+def spin_busy() -> None:
+    _spin(0.02)
+
+
+def spin_profiled() -> None:
+    _spin(0.02)
+
+
+def block_profiled() -> None:
+    _spin(0.1)
+
+
+def create_app(profiles: ProfileStore) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/busy")
+    async def busy(seconds: float) -> dict:
+        # ループを手放しながら CPU を使い続ける、同時に動いている別のリクエスト
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            spin_busy()
+            await asyncio.sleep(0)
+        return {}
+
+    @app.get("/work")
+    async def work() -> dict:
+        deadline = time.perf_counter() + 0.3
+        while time.perf_counter() < deadline:
+            spin_profiled()
+            await asyncio.sleep(0)
+        await run_in_threadpool(block_profiled)
+        return {}
+
+    app.add_middleware(ProfilingMiddleware, profiles=profiles, interval=0.002, token=TOKEN)
+    return app
+
+
+class ProfilingTest(unittest.TestCase):
+    def test_concurrent_request_is_not_attributed(self) -> None:
+        profiles = ProfileStore()
+        with TestClient(create_app(profiles)) as client:
+            busy = threading.Thread(
+                target=client.get, args=("/busy",), kwargs={"params": {"seconds": 1.5}}
+            )
+            busy.start()
+            time.sleep(0.1)
+            response = client.get("/work", headers={"X-Profile": TOKEN})
+            busy.join()
+
+        self.assertEqual(response.status_code, 200)
+        profile = profiles.get(response.headers["x-profile-id"])
+        collapsed = profile["collapsed"]
+        self.assertIn("spin_profiled", collapsed)
+        self.assertIn("block_profiled", collapsed)
+        self.assertNotIn("spin_busy", collapsed)
+        self.assertNotIn("busy (", collapsed)
+
+    def test_opt_in_requires_token(self) -> None:
+        profiles = ProfileStore()
+        app = FastAPI()
+        app.get("/work")(lambda: {})
+        app.add_middleware(ProfilingMiddleware, profiles=profiles)
+        with TestClient(app) as client:
+            response = client.get("/work", headers={"X-Profile": "1"})
+            self.assertNotIn("x-profile-id", response.headers)
+            response = client.get("/work", params={"profile": "1"})
+            self.assertNotIn("x-profile-id", response.headers)
+        self.assertEqual(profiles.recent(), [])
+
+        app = create_app(profiles)
+        with TestClient(app) as client:
+            response = client.get("/work", headers={"X-Profile": "wrong"})
+        self.assertNotIn("x-profile-id", response.headers)
+
+
+if __name__ == "__main__":
+    unittest.main()
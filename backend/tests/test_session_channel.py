@@ -0,0 +1,264 @@
+"""WebSocket のセッション（/ws/{thread_id}）のテスト
+
+session_channel.serve_session をマウントしたアプリに TestClient で接続し、イベントの順序、
+HTTP のリクエストと同じスレッドを取り合ったときの 409、不正なイベントへのエラー、
+送信が追いつかないときのトークンの連結を確かめる。LLM は固定の回答をストリームするモデル、
+検索は tavily_standin.py のスタンドインサーバーを使う。
+
+    cd backend && poetry run python -m unittest discover tests
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import unittest
+from collections.abc import Iterator
+from typing import Any
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import FastAPI, WebSocket  # noqa: E402
+from fastapi.concurrency import run_in_threadpool  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from langchain_core.messages import AIMessageChunk  # noqa: E402
+from langchain_core.outputs import ChatGenerationChunk  # noqa: E402
+
+from test_multiworker import REPORT, FixedChatModel, _free_port  # noqa: E402
+
+# False の間、LLM の呼び出しは set されるまで止まる（HTTP のリクエストにロックを持たせておく）
+_gate = threading.Event()
+_gate.set()
+_entered = threading.Event()
+
+
+class StreamingChatModel(FixedChatModel):
+    """FixedChatModel と同じ回答を、4文字ずつのトークンでストリームする"""
+
+    def _call(
+        self, messages: list, stop: Any = None, run_manager: Any = None, **kwargs: Any
+    ) -> str:
+        _entered.set()
+        _gate.wait()
+        return super()._call(messages, stop, run_manager, **kwargs)
+
+    def _stream(
+        self, messages: list, stop: Any = None, run_manager: Any = None, **kwargs: Any
+    ) -> Iterator[ChatGenerationChunk]:
+        text = self._call(messages, stop, run_manager, **kwargs)
+        for i in range(0, len(text), 4):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text[i : i + 4]))
+
+
+class SlowWebSocket:
+    """送信ごとに待つクライアントの代わり（トークンがキューに溜まるようにする）"""
+
+    def __init__(self, websocket: WebSocket, delay: float) -> None:
+        self._websocket = websocket
+        self._delay = delay
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._websocket, name)
+
+    async def send_text(self, data: str) -> None:
+        await asyncio.sleep(self._delay)
+        await self._websocket.send_text(data)
+
+
+def create_app(classroom: Any, send_delay: float = 0.0) -> FastAPI:
+    from session_channel import serve_session
+
+    app = FastAPI()
+
+    @app.websocket("/ws/{thread_id}")
+    async def session(websocket: WebSocket, thread_id: str) -> None:
+        if send_delay:
+            websocket = SlowWebSocket(websocket, send_delay)
+        await serve_session(websocket, classroom, thread_id)
+
+    @app.post("/explore")
+    async def explore(body: dict) -> dict:
+        # server.py の /explore と同じく、スレッドのロックを持ったまま resume する
+        state = await run_in_threadpool(
+            classroom.resume,
+            body["thread_id"],
+            "explore_report",
+            {"point_selection_for_critic": body["point_selection_for_critic"]},
+        )
+        return state.model_dump(mode="json")
+
+    return app
+
+
+class SessionChannelTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        from tavily_standin import StandInConfig, serve
+
+        port = _free_port()
+        cls.standin = serve(port=port, config=StandInConfig(latency=0.0, jitter=0.0))
+        os.environ["RETRIEVER_MODE"] = "standin"
+        os.environ["TAVILY_STANDIN_URL"] = f"http://localhost:{port}"
+        os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.standin.shutdown()
+
+    def setUp(self) -> None:
+        from graph import AgentClassroom
+        from retrievers import create_tavily_search_api_retriever
+
+        self.classroom = AgentClassroom(StreamingChatModel(), create_tavily_search_api_retriever())
+
+    def tearDown(self) -> None:
+        # 論点の事例の先読みが終わるのを待つ（スタンドインサーバーを止める前に）
+        prefetcher = self.classroom.reporter.case_prefetcher
+        deadline = time.monotonic() + 10
+        while prefetcher.metrics()["inflight"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def command(self, ws: Any, message: dict[str, Any]) -> list[dict[str, Any]]:
+        """イベントを送り、state か error が届くまでのイベントを返す"""
+        ws.send_json(message)
+        events = []
+        while True:
+            event = ws.receive_json()
+            events.append(event)
+            if event["type"] in ("state", "error"):
+                return events
+
+    def types(self, events: list[dict[str, Any]]) -> list[str]:
+        # トークンは何個に分かれて届くか決まらないので、連続するものを1つにまとめる
+        types: list[str] = []
+        for event in events:
+            if not (types and types[-1] == event["type"] == "token"):
+                types.append(event["type"])
+        return types
+
+    def start(self, ws: Any) -> tuple[list[dict[str, Any]], dict[str, Any]]:
+        events = self.command(ws, {"type": "start", "query": "日米首脳会談"})
+        report = next(e["report"] for e in events if e["type"] == "points")
+        return events, {"report_id": report["id"], "point_id": "1"}
+
+    def test_session_event_order(self) -> None:
+        with TestClient(create_app(self.classroom)) as client:
+            with client.websocket_connect("/ws/order") as ws:
+                events, point = self.start(ws)
+                self.assertEqual(self.types(events), ["token", "points", "state"])
+                self.assertEqual({e["node"] for e in events if e["type"] == "token"}, {"reporter"})
+                self.assertEqual("".join(e["content"] for e in events[:-2]), REPORT)
+                self.assertEqual(events[-1]["state"]["current_role"], "reporter")
+
+                events = self.command(
+                    ws, {"type": "select_point", "point_selection_for_critic": point}
+                )
+                self.assertEqual(self.types(events), ["token", "detailed_report", "state"])
+                self.assertEqual(events[-1]["state"]["current_role"], "explore_report")
+
+                events = self.command(
+                    ws, {"type": "select_topic", "point_selection_for_critic": point}
+                )
+                # critic は JSON を生成するので、トークンは送らずに解析した論点だけを送る
+                self.assertEqual(self.types(events), ["critique", "state"])
+                self.assertEqual(len(events[0]["critic_content"]["critic_points"]), 3)
+
+                case = {**point, "title": "論点1", "content": "論点1の本文"}
+                events = self.command(
+                    ws,
+                    {
+                        "type": "select_case",
+                        "point_selection_for_critic": case,
+                        "is_yes_case": True,
+                    },
+                )
+                self.assertEqual(self.types(events), ["token", "cases", "state"])
+                self.assertEqual(events[-1]["state"]["current_role"], "investigate_cases")
+
+                events = self.command(ws, {"type": "get_state"})
+                self.assertEqual(self.types(events), ["state"])
+
+    def test_busy_thread_returns_409(self) -> None:
+        self.classroom.locks.timeout = 0.2
+        with TestClient(create_app(self.classroom)) as client:
+            with client.websocket_connect("/ws/busy") as ws:
+                _, point = self.start(ws)
+
+                # HTTP の /explore が LLM の応答を待っている間、スレッドのロックを持ち続ける
+                _gate.clear()
+                _entered.clear()
+                response: dict[str, Any] = {}
+                body = {"thread_id": "busy", "point_selection_for_critic": point}
+                explore = threading.Thread(
+                    target=lambda: response.update(r=client.post("/explore", json=body))
+                )
+                explore.start()
+                try:
+                    self.assertTrue(_entered.wait(10))
+                    events = self.command(
+                        ws, {"type": "select_topic", "point_selection_for_critic": point}
+                    )
+                finally:
+                    _gate.set()
+                    explore.join()
+                self.assertEqual(self.types(events), ["error"])
+                self.assertEqual(events[0]["status"], 409)
+                self.assertEqual(response["r"].status_code, 200)
+
+                # ロックが外れれば同じ接続で続けられる
+                events = self.command(
+                    ws, {"type": "select_topic", "point_selection_for_critic": point}
+                )
+                self.assertEqual(self.types(events), ["critique", "state"])
+
+    def test_invalid_events(self) -> None:
+        with TestClient(create_app(self.classroom)) as client:
+            with client.websocket_connect("/ws/invalid") as ws:
+                ws.send_text("not json")
+                self.assertEqual(ws.receive_json()["status"], 400)
+                ws.send_text("[1, 2]")
+                self.assertEqual(ws.receive_json()["status"], 400)
+                self.assertEqual(self.command(ws, {"type": "bogus"})[0]["status"], 400)
+                self.assertEqual(self.command(ws, {"type": "start"})[0]["status"], 422)
+                events = self.command(
+                    ws, {"type": "select_point", "point_selection_for_critic": {"x": 1}}
+                )
+                self.assertEqual(events[0]["status"], 422)
+                # まだチェックポイントのないスレッド
+                self.assertEqual(self.command(ws, {"type": "get_state"})[0]["status"], 404)
+
+                # エラーの後も同じ接続でセッションを始められる
+                events, _ = self.start(ws)
+                self.assertEqual(events[-1]["type"], "state")
+
+    def test_tokens_are_coalesced_when_queue_is_full(self) -> None:
+        from session_channel import EventChannel
+
+        channels: list[EventChannel] = []
+
+        def channel(*args: Any, **kwargs: Any) -> EventChannel:
+            channels.append(EventChannel(*args, **{**kwargs, "maxsize": 1}))
+            return channels[-1]
+
+        app = create_app(self.classroom, send_delay=0.02)
+        with mock.patch("session_channel.EventChannel", channel):
+            with TestClient(app) as client:
+                with client.websocket_connect("/ws/coalesce") as ws:
+                    started = time.monotonic()
+                    events, _ = self.start(ws)
+
+        tokens = [e for e in events if e["type"] == "token"]
+        # 送信を待っている間に届いたトークンは、順序を保ったまま連結して送る
+        self.assertEqual("".join(e["content"] for e in tokens), REPORT)
+        self.assertEqual(self.types(events), ["token", "points", "state"])
+        self.assertGreater(channels[0].coalesced_tokens, 0)
+        self.assertLess(len(tokens), -(-len(REPORT) // 4))
+        # 1トークンずつ送っていたら chunk 数 × send_delay かかる
+        self.assertLess(time.monotonic() - started, -(-len(REPORT) // 4) * 0.02)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+"""LangGraph のスレッド（セッション）ごとの排他
+
+同じスレッドに対する2つのコマンド（HTTP と WebSocket、2つのタブなど）が、チェックポイントへの
+update_state と invoke を交互に実行しないようにする。store があれば SQLite のリースで
+他のワーカープロセスとも排他する。同じ OS スレッドからは入れ子で取得できる。
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from storage import SQLiteStore
+
+
+class ThreadBusyError(RuntimeError):
+    """別のリクエストが同じスレッドを実行していて、待ち時間内に終わらなかった"""
+
+    def __init__(self, thread_id: str, waited: float) -> None:
+        super().__init__(f"Thread {thread_id} is busy with another request ({waited:.0f}s)")
+        self.thread_id = thread_id
+        self.waited = waited
+
+
+class ThreadLocks:
+    namespace = "thread_locks"
+
+    def __init__(
+        self,
+        store: Optional["SQLiteStore"] = None,
+        timeout: float = 60.0,
+        lease: float = 300.0,
+        poll_interval: float = 0.1,
+    ) -> None:
+        self.store = store
+        self.timeout = timeout
+        # ワーカーが異常終了してもこの秒数でリースが切れる（コマンドの最大実行時間より長くする）
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._locks: dict[str, tuple[threading.Lock, int]] = {}
+        self._guard = threading.Lock()
+        self._held = threading.local()
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+
+    def _local_lock(self, thread_id: str, delta: int) -> threading.Lock:
+        # 待っている・持っている呼び出しがなくなったスレッドのロックは捨てる
+        with self._guard:
+            lock, users = self._locks.get(thread_id, (None, 0))
+            lock = lock or threading.Lock()
+            users += delta
+            if users > 0:
+                self._locks[thread_id] = (lock, users)
+            else:
+                self._locks.pop(thread_id, None)
+            return lock
+
+    def _acquire_lease(self, thread_id: str, deadline: float, started: float) -> None:
+        while not self.store.acquire(self.namespace, thread_id, self._owner, self.lease):
+            if time.monotonic() >= deadline:
+                raise ThreadBusyError(thread_id, time.monotonic() - started)
+            time.sleep(self.poll_interval)
+
+    @contextmanager
+    def hold(self, thread_id: str) -> Iterator[None]:
+        """thread_id のコマンドの実行中に持つ（timeout 秒で取れなければ ThreadBusyError）
+
+        入れ子の判定は OS スレッド単位なので、ブロック内のストリームは同じスレッドで読み切る。
+        """
+        held: dict[str, int] = self._held.__dict__.setdefault("counts", {})
+        if held.get(thread_id):
+            held[thread_id] += 1
+            try:
+                yield
+            finally:
+                held[thread_id] -= 1
+            return
+
+        started = time.monotonic()
+        deadline = started + self.timeout
+        lock = self._local_lock(thread_id, +1)
+        try:
+            if not lock.acquire(timeout=self.timeout):
+                raise ThreadBusyError(thread_id, time.monotonic() - started)
+            try:
+                if self.store is not None:
+                    self._acquire_lease(thread_id, deadline, started)
+                held[thread_id] = 1
+                try:
+                    yield
+                finally:
+                    held.pop(thread_id, None)
+                    if self.store is not None:
+                        self.store.release(self.namespace, thread_id, self._owner)
+            finally:
+                lock.release()
+        finally:
+            self._local_lock(thread_id, -1)
@@ -1,3 +1,5 @@
+from collections.abc import Iterator
+
 import pdfplumber
 from langchain_community.vectorstores.utils import Document, filter_complex_metadata
 from langchain_text_splitters import CharacterTextSplitter
@@ -16,3 +18,17 @@ def text_to_documents(text: str) -> list[Document]:
     text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
     split_docs = text_splitter.split_documents([docs])
     return filter_complex_metadata(split_docs)
+
+
+def iter_pdf_pages(pdf_path: str) -> Iterator[tuple[int, str]]:
+    """(ページ番号, テキスト) を1ページずつ返す。処理済みのページはキャッシュを解放する"""
+    with pdfplumber.open(pdf_path) as pdf:
+        for number, page in enumerate(pdf.pages, 1):
+            text = page.extract_text() or ""
+            page.close()
+            yield number, text
+
+
+def count_pdf_pages(pdf_path: str) -> int:
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
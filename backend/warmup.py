@@ -0,0 +1,240 @@
+"""授業前のトピックのウォームアップ
+
+授業で扱うトピックが決まっていれば、初回のレポート、各要点の詳細レポートと論点、論点ごとの
+Yes/No の事例の検索を事前に実行し、共有ストア（AGENT_CLASSROOM_DB）に保存しておく。
+サーバーは同じトピック・要点への要求をウォームキャッシュから返すので、授業中は LLM と検索を
+待たずに済む。
+
+    poetry run python warmup.py 日米首脳会談 "ウクライナ戦争の現状" --workers 2 --max-llm-calls 60
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Optional, TypeVar
+
+from agent import CriticAgent, CriticContent, ReportContent, ReporterAgent, ReporterPoint
+from hedging import WARM_NAMESPACE, WARM_TTL, HedgedExecutor, ResponseCache, warming
+from prefetch import expand_case_queries
+from report_tree import ReportTree
+from scheduler import Priority, create_default_scheduler, priority
+
+if TYPE_CHECKING:
+    from langchain_core.language_models import BaseChatModel
+
+    from storage import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Warmup:
+    """トピックごとのレポート・詳細レポート・論点・事例の検索を BATCH 優先度で事前に実行する
+
+    max_llm_calls / max_searches を超えたら残りのステップは実行せずにスキップする。
+    refresh=True なら、ウォームキャッシュにある回答も生成し直す。
+    """
+
+    def __init__(
+        self,
+        reporter: ReporterAgent,
+        critic: CriticAgent,
+        workers: int = 2,
+        max_llm_calls: Optional[int] = None,
+        max_searches: Optional[int] = None,
+        ttl: float = WARM_TTL,
+        refresh: bool = False,
+        progress: Callable[[str], None] = print,
+    ) -> None:
+        self.reporter = reporter
+        self.critic = critic
+        self.scheduler = reporter.scheduler
+        self.max_llm_calls = max_llm_calls
+        self.max_searches = max_searches
+        self.ttl = ttl
+        self.refresh = refresh
+        self.progress = progress
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="warmup")
+        self._lock = threading.Lock()
+        self._counters = {"total": 0, "done": 0, "skipped": 0, "errors": 0}
+
+    def usage(self) -> dict[str, int]:
+        """このプロセスで実行した LLM の呼び出し・検索の回数"""
+        metrics = self.scheduler.metrics()
+        return {
+            "llm_calls": metrics.get("llm", {}).get("admitted", 0),
+            "searches": metrics.get("tavily", {}).get("admitted", 0),
+        }
+
+    def _over_budget(self, uses: Iterable[str]) -> bool:
+        usage = self.usage()
+        limits = {"llm_calls": self.max_llm_calls, "searches": self.max_searches}
+        return any(limits[name] is not None and usage[name] >= limits[name] for name in uses)
+
+    def _add_total(self, steps: int) -> None:
+        with self._lock:
+            self._counters["total"] += steps
+
+    def _finish(self, label: str, outcome: str) -> None:
+        with self._lock:
+            self._counters["done"] += 1
+            done, total = self._counters["done"], self._counters["total"]
+        self.progress(f"[{done}/{total}] {label}: {outcome}")
+
+    def _skip(self, label: str, reason: str) -> None:
+        with self._lock:
+            self._counters["skipped"] += 1
+        self._finish(label, f"skipped ({reason})")
+
+    def _step(self, label: str, uses: tuple[str, ...], fn: Callable[[], T]) -> Optional[T]:
+        if self._over_budget(uses):
+            self._skip(label, "budget")
+            return None
+        started = time.monotonic()
+        try:
+            # 授業中のリクエストと同じプロセスで動かしても、対話的な呼び出しを先に通す
+            with warming(self.refresh), priority(Priority.BATCH):
+                result = fn()
+        except Exception as e:
+            with self._lock:
+                self._counters["errors"] += 1
+            logger.warning("Warm-up step %r failed: %s", label, e)
+            self._finish(label, f"failed ({e})")
+            return None
+        self._finish(label, f"ok ({time.monotonic() - started:.1f}s)")
+        return result
+
+    def _prefetch_cases(self, critique: CriticContent) -> int:
+        queries = expand_case_queries(p.title for p in critique.critic_points)
+        futures = self.reporter.case_prefetcher.prefetch(queries, ttl=self.ttl)
+        wait(futures)
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+        return len(futures)
+
+    def _warm_point(self, topic: str, report: ReportContent, point: ReporterPoint) -> None:
+        label = f"{topic} / {point.title}"
+        self._step(
+            f"{label}: detailed report",
+            ("llm_calls", "searches"),
+            lambda: self.reporter.generate_detailed_report(report.id, point.id),
+        )
+        critique = self._step(
+            f"{label}: critique",
+            ("llm_calls",),
+            lambda: self.critic.generate_critique(title=point.title, content=point.content),
+        )
+        if critique is None:
+            self._skip(f"{label}: Yes/No cases", "no critique")
+            return
+        self._step(f"{label}: Yes/No cases", ("searches",), lambda: self._prefetch_cases(critique))
+
+    def _warm_topic(self, topic: str) -> list[Future]:
+        text = self._step(
+            f"{topic}: report",
+            ("llm_calls", "searches"),
+            lambda: self.reporter.generate_report(topic),
+        )
+        if text is None:
+            return []
+        report = self.reporter.parse_report_output(text, topic)
+        # 要点ごとに 詳細レポート・論点・事例の検索 の3ステップ
+        self._add_total(3 * len(report.points))
+        return [
+            self._executor.submit(self._warm_point, topic, report, point) for point in report.points
+        ]
+
+    def run(self, topics: list[str]) -> dict[str, Any]:
+        started = time.monotonic()
+        self._add_total(len(topics))
+        topic_futures = [self._executor.submit(self._warm_topic, topic) for topic in topics]
+        wait([future for tf in topic_futures for future in tf.result()])
+        with self._lock:
+            counters = dict(self._counters)
+        nodes = self.reporter.hedger.metrics().values()
+        warm_hits = sum(node.get("warm_hits", 0) for node in nodes)
+        return {
+            "topics": len(topics),
+            **counters,
+            **self.usage(),
+            "warm_hits": warm_hits,
+            "elapsed_seconds": round(time.monotonic() - started, 1),
+        }
+
+
+def create_warmup(
+    llm: "BaseChatModel",
+    fallback_llm: Optional["BaseChatModel"],
+    store: "SQLiteStore",
+    ttl: float = WARM_TTL,
+    **kwargs: Any,
+) -> Warmup:
+    """サーバーと同じ store のキャッシュに書き込む Warmup を作る
+
+    レポートの木はプロセス内だけに持ち、ウォームアップ用のレポートを共有ストアに残さない。
+    """
+    scheduler = create_default_scheduler()
+    hedger = HedgedExecutor(
+        cache=ResponseCache(store=store, models=[CriticContent]),
+        warm=ResponseCache(store=store, namespace=WARM_NAMESPACE, ttl=ttl, models=[CriticContent]),
+    )
+    reporter = ReporterAgent(llm, scheduler, fallback_llm, hedger, ReportTree(), store=store)
+    critic = CriticAgent(llm, scheduler, fallback_llm, hedger)
+    return Warmup(reporter, critic, ttl=ttl, **kwargs)
+
+
+def read_topics(topics: list[str], path: Optional[str]) -> list[str]:
+    if path:
+        with open(path, encoding="utf-8") as f:
+            lines = [line.strip() for line in f]
+        topics = topics + [line for line in lines if line and not line.startswith("#")]
+    return list(dict.fromkeys(topics))
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from langchain_google_vertexai import ChatVertexAI
+
+    from storage import DEFAULT_DB_PATH, create_store_from_env
+
+    parser = argparse.ArgumentParser(description="Precompute reports and cases for class topics")
+    parser.add_argument("topics", nargs="*", help="トピック（授業で入力するクエリと同じ文字列）")
+    parser.add_argument("--file", help="1行に1トピックを書いたファイル")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-llm-calls", type=int, default=None)
+    parser.add_argument("--max-searches", type=int, default=None)
+    parser.add_argument("--ttl-hours", type=float, default=WARM_TTL / 3600)
+    parser.add_argument(
+        "--refresh", action="store_true", help="ウォームキャッシュにある回答も生成し直す"
+    )
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.WARNING)
+    topics = read_topics(args.topics, args.file)
+    if not topics:
+        parser.error("no topics given")
+    store = create_store_from_env(DEFAULT_DB_PATH)
+    if store is None:
+        parser.error("AGENT_CLASSROOM_DB must point to the database the server uses")
+
+    warmup = create_warmup(
+        ChatVertexAI(model_name="gemini-1.5-flash"),
+        ChatVertexAI(model_name=os.getenv("FALLBACK_MODEL_NAME", "gemini-1.5-flash-8b")),
+        store,
+        ttl=args.ttl_hours * 3600,
+        workers=args.workers,
+        max_llm_calls=args.max_llm_calls,
+        max_searches=args.max_searches,
+        refresh=args.refresh,
+        progress=lambda line: print(line, file=sys.stderr, flush=True),
+    )
+    summary = warmup.run(topics)
+    print(summary)
@@ -78,8 +78,8 @@ const DiscussionContainer: React.FC = () => {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
-          query: state.query,
-          thread_id: 1
+          // 新しい質問ごとにサーバーがスレッドIDを発行し、レスポンスの thread_id で返す
+          query: state.query
         }),
       });
 
@@ -245,7 +245,7 @@ const DiscussionContainer: React.FC = () => {
           report_id: state.report_id,
           point_id: pointId
         },
-        thread_id: 1
+        thread_id: state.thread_id
       };
 
       const response = await fetch('http://localhost:8000/explore', {
@@ -337,7 +337,7 @@ const DiscussionContainer: React.FC = () => {
           title: point.title,
           content: point.content
         },
-        thread_id: 1,
+        thread_id: state.thread_id,
         title: point.title,
         content: point.content
       };
@@ -421,7 +421,7 @@ const DiscussionContainer: React.FC = () => {
           title: point.title,
           content: point.content
         },
-        thread_id: 1,
+        thread_id: state.thread_id,
         is_yes_case: isYesCase
       };
 